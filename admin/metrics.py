@@ -0,0 +1,124 @@
+"""
+Dashboard metrics service for the admin panel.
+
+Computes every number and chart series shown on the admin dashboard with
+one query for the live scalar totals and a few reads of the daily fact
+tables (see utils.daily_facts) for revenue, the 30-day series and the poem
+type breakdown, and memoizes the result for a short time, so repeated
+dashboard loads and JSON polling don't hit the database at all. The HTML
+and JSON dashboard views share this service.
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import func, select, case
+from models import db, User, Creation, UserSession
+from utils.cache import LRUCache
+from utils import daily_facts
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# How long computed dashboard metrics are reused before being recomputed
+DASHBOARD_METRICS_TTL = int(os.environ.get("DASHBOARD_METRICS_TTL", "60"))
+
+# Number of days in the activity charts (plus today)
+ACTIVITY_DAYS = 30
+
+_metrics_cache = LRUCache(max_entries=1, default_ttl=DASHBOARD_METRICS_TTL)
+
+
+def _count_if(condition):
+    return func.sum(case((condition, 1), else_=0))
+
+
+def _scalar_totals(one_day_ago):
+    """Fetch every scalar dashboard total in a single SELECT of scalar subqueries."""
+    totals = {
+        'total_users': select(func.count(User.id)),
+        'active_premium': select(_count_if(User.is_premium == True)),
+        'verified_users': select(_count_if(User.is_email_verified == True)),
+        'total_creations': select(func.count(Creation.id)),
+        'total_downloads': select(func.coalesce(func.sum(Creation.download_count), 0)),
+        'downloaded_creations': select(_count_if(Creation.is_downloaded == True)),
+        'active_sessions': select(_count_if((UserSession.session_start >= one_day_ago)
+                                            & UserSession.session_end.is_(None))),
+        'avg_session_duration': select(func.coalesce(func.avg(UserSession.duration_seconds), 0)),
+        'total_session_seconds': select(func.coalesce(func.sum(UserSession.duration_seconds), 0)),
+    }
+
+    row = db.session.execute(select(*(query.scalar_subquery().label(name)
+                                      for name, query in totals.items()))).mappings().one()
+    # SUM over an empty table is NULL
+    return {key: (value or 0) for key, value in row.items()}
+
+
+def compute_dashboard_metrics():
+    """
+    Compute the admin dashboard metrics from the database.
+
+    Returns:
+        dict: JSON-serializable totals, rates and chart series
+    """
+    now = datetime.utcnow()
+    thirty_days_ago = now - timedelta(days=ACTIVITY_DAYS)
+    one_day_ago = now - timedelta(days=1)
+
+    totals = _scalar_totals(one_day_ago)
+    total_users = totals['total_users']
+    total_creations = totals['total_creations']
+
+    # Revenue and chart series come from the daily fact tables and cover whole days
+    first_day = thirty_days_ago.date()
+    _, recent_revenue = daily_facts.revenue_summary(first_day, now.date())
+    creations_series = daily_facts.daily_creations(first_day, now.date())
+    active_users_series = daily_facts.daily_active_users(first_day, now.date())
+    poem_types_data = daily_facts.creation_breakdown('poem_type')
+
+    return {
+        # Basic metrics
+        'total_users': total_users,
+        'active_premium': totals['active_premium'],
+        'total_creations': total_creations,
+        'verified_users': totals['verified_users'],
+        'verified_percent': (totals['verified_users'] / total_users * 100) if total_users > 0 else 0,
+        'premium_percent': (totals['active_premium'] / total_users * 100) if total_users > 0 else 0,
+        'recent_revenue': recent_revenue,
+
+        # Enhanced metrics
+        'total_downloads': totals['total_downloads'],
+        'download_rate': (totals['downloaded_creations'] / total_creations * 100) if total_creations > 0 else 0,
+        'active_sessions': totals['active_sessions'],
+        'avg_session_minutes': float(totals['avg_session_duration']) / 60,
+        'total_session_hours': float(totals['total_session_seconds']) / 3600,
+        'total_time_saved_hours': daily_facts.total_time_saved_minutes() / 60,
+
+        # Chart data
+        'activity_dates': [day.strftime('%b %d') for day, _ in creations_series],
+        'active_users_data': [count for _, count in active_users_series],
+        'poems_created_data': [int(count) for _, count in creations_series],
+        'poem_types_labels': [pt[0] for pt in poem_types_data],
+        'poem_types_counts': [int(pt[1]) for pt in poem_types_data],
+
+        'generated_at': now.isoformat()
+    }
+
+
+def get_dashboard_metrics(refresh=False):
+    """
+    Return the dashboard metrics, recomputing them at most every DASHBOARD_METRICS_TTL seconds.
+
+    Args:
+        refresh (bool): Recompute now instead of using the memoized result
+
+    Returns:
+        dict: See compute_dashboard_metrics()
+    """
+    if not refresh:
+        metrics = _metrics_cache.get('dashboard')
+        if metrics is not None:
+            return metrics
+
+    metrics = compute_dashboard_metrics()
+    _metrics_cache.set('dashboard', metrics)
+    return metrics
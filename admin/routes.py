@@ -5,12 +5,17 @@ from datetime import datetime, timedelta
 from flask import render_template, request, redirect, url_for, session, flash, jsonify, current_app
 from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy import desc, func
+from sqlalchemy.orm import undefer_group
 from models import db, User, Creation, Membership, Transaction, AdminUser, AdminRole, AdminLog
 from admin import admin_bp
+from utils import daily_facts
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# Transactions listed on the financial page (totals cover the whole range)
+FINANCIAL_TRANSACTION_LIMIT = int(os.environ.get("FINANCIAL_TRANSACTION_LIMIT", "200"))
+
 def wants_json():
     """Check if client prefers JSON response"""
     # Check Accept header or if request content type is JSON
@@ -175,177 +180,30 @@ def logout():
 @admin_bp.route('/')
 @admin_required
 def dashboard():
-    # Basic metrics for dashboard
-    total_users = User.query.count()
-    active_premium = User.query.filter_by(is_premium=True).count()
-    total_creations = Creation.query.count()
-    verified_users = User.query.filter_by(is_email_verified=True).count()
-    
-    # Date ranges
-    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    one_day_ago = datetime.utcnow() - timedelta(days=1)
-    
-    # Verification percentage
-    verified_percent = (verified_users / total_users * 100) if total_users > 0 else 0
-    
-    # Premium conversion rate
-    premium_percent = (active_premium / total_users * 100) if total_users > 0 else 0
-    
-    # Revenue data (last 30 days)
-    recent_transactions = Transaction.query.filter(
-        Transaction.created_at >= thirty_days_ago,
-        Transaction.status == 'completed'
-    ).all()
-    
-    recent_revenue = sum(t.amount for t in recent_transactions)
-    
-    # Download statistics
-    total_downloads = db.session.query(func.sum(Creation.download_count)).scalar() or 0
-    downloaded_creations = Creation.query.filter(Creation.is_downloaded == True).count()
-    download_rate = (downloaded_creations / total_creations * 100) if total_creations > 0 else 0
-    
-    # Session statistics
-    from models import UserSession
-    
-    active_sessions = UserSession.query.filter(
-        UserSession.session_start >= one_day_ago,
-        UserSession.session_end.is_(None)
-    ).count()
-    
-    # Avg session duration (for completed sessions)
-    avg_session_duration = db.session.query(
-        func.avg(UserSession.duration_seconds)
-    ).filter(
-        UserSession.duration_seconds.isnot(None)
-    ).scalar() or 0
-    
-    avg_session_minutes = avg_session_duration / 60
-    
-    # Total session time (hours)
-    total_session_seconds = db.session.query(
-        func.sum(UserSession.duration_seconds)
-    ).filter(
-        UserSession.duration_seconds.isnot(None)
-    ).scalar() or 0
-    
-    total_session_hours = total_session_seconds / 3600
-    
-    # Time saved estimate (hours)
-    total_time_saved = db.session.query(
-        func.sum(Creation.time_saved_minutes)
-    ).scalar() or 0
-    
-    total_time_saved_hours = total_time_saved / 60
-    
-    # Chart data - user activity over 30 days
-    activity_dates = []
-    active_users_data = []
-    poems_created_data = []
-    
-    current_date = thirty_days_ago.date()
-    end_date = datetime.utcnow().date()
-    
-    while current_date <= end_date:
-        # Format date for display
-        activity_dates.append(current_date.strftime('%b %d'))
-        
-        # Count users active on this day
-        day_start = datetime.combine(current_date, datetime.min.time())
-        day_end = datetime.combine(current_date, datetime.max.time())
-        
-        active_users = UserSession.query.filter(
-            UserSession.session_start.between(day_start, day_end)
-        ).with_entities(UserSession.user_id).distinct().count()
-        
-        # Count poems created on this day
-        day_poems = Creation.query.filter(
-            Creation.created_at.between(day_start, day_end)
-        ).count()
-        
-        active_users_data.append(active_users)
-        poems_created_data.append(day_poems)
-        
-        current_date += timedelta(days=1)
-    
-    # Poem types distribution
-    poem_types_data = db.session.query(
-        Creation.poem_type,
-        func.count(Creation.id)
-    ).filter(
-        Creation.poem_type.isnot(None)
-    ).group_by(
-        Creation.poem_type
-    ).all()
-    
-    poem_types_labels = [pt[0] for pt in poem_types_data]
-    poem_types_counts = [pt[1] for pt in poem_types_data]
-    
+    from admin.metrics import get_dashboard_metrics
+
+    # Totals and chart series are memoized briefly; ?refresh=1 recomputes them
+    metrics = get_dashboard_metrics(refresh=request.args.get('refresh') == '1')
+
     # Recent activity for admin logs
     recent_activity = AdminLog.query.order_by(AdminLog.timestamp.desc()).limit(10).all()
     
     if wants_json():
-        return jsonify({
-            # Basic metrics
-            'total_users': total_users,
-            'active_premium': active_premium,
-            'total_creations': total_creations,
-            'verified_users': verified_users,
-            'verified_percent': verified_percent,
-            'premium_percent': premium_percent,
-            'recent_revenue': float(recent_revenue),
-            'recent_activity': [{
-                'id': log.id,
-                'admin_id': log.admin_id,
-                'action': log.action,
-                'entity_type': log.entity_type,
-                'entity_id': log.entity_id,
-                'details': log.details,
-                'ip_address': log.ip_address,
-                'timestamp': log.timestamp.isoformat() if log.timestamp else None
-            } for log in recent_activity],
-            
-            # Enhanced metrics
-            'total_downloads': total_downloads,
-            'download_rate': download_rate,
-            'active_sessions': active_sessions,
-            'avg_session_minutes': avg_session_minutes,
-            'total_session_hours': total_session_hours,
-            'total_time_saved_hours': total_time_saved_hours,
-            
-            # Chart data
-            'activity_dates': activity_dates,
-            'active_users_data': active_users_data, 
-            'poems_created_data': poems_created_data,
-            'poem_types_labels': poem_types_labels,
-            'poem_types_counts': poem_types_counts
-        })
+        return jsonify(dict(metrics, recent_activity=[{
+            'id': log.id,
+            'admin_id': log.admin_id,
+            'action': log.action,
+            'entity_type': log.entity_type,
+            'entity_id': log.entity_id,
+            'details': log.details,
+            'ip_address': log.ip_address,
+            'timestamp': log.timestamp.isoformat() if log.timestamp else None
+        } for log in recent_activity]))
     else:
         return render_template(
             'admin/dashboard.html',
-            # Basic metrics
-            total_users=total_users,
-            active_premium=active_premium,
-            total_creations=total_creations,
-            verified_users=verified_users,
-            verified_percent=verified_percent,
-            premium_percent=premium_percent,
-            recent_revenue=recent_revenue,
             recent_activity=recent_activity,
-            
-            # Enhanced metrics
-            total_downloads=total_downloads,
-            download_rate=download_rate,
-            active_sessions=active_sessions,
-            avg_session_minutes=avg_session_minutes,
-            total_session_hours=total_session_hours,
-            total_time_saved_hours=total_time_saved_hours,
-            
-            # Chart data
-            activity_dates=activity_dates,
-            active_users_data=active_users_data, 
-            poems_created_data=poems_created_data,
-            poem_types_labels=poem_types_labels,
-            poem_types_counts=poem_types_counts
+            **metrics
         )
 
 # User Management
@@ -442,8 +300,12 @@ def users():
 def user_detail(user_id):
     user = User.query.get_or_404(user_id)
     
-    # Get user creations
-    creations = Creation.query.filter_by(user_id=user_id).order_by(Creation.created_at.desc()).all()
+    # Get user creations (heavy payload columns only on explicit request)
+    include_payload = request.args.get('include') == 'images'
+    query = Creation.query.filter_by(user_id=user_id)
+    if include_payload:
+        query = query.options(undefer_group('payload'))
+    creations = query.order_by(Creation.created_at.desc()).all()
     
     # Get user transactions
     transactions = Transaction.query.filter_by(user_id=user_id).order_by(Transaction.created_at.desc()).all()
@@ -459,29 +321,10 @@ def user_detail(user_id):
     
     if wants_json():
         # Convert creations to JSON format
-        creations_data = []
-        for creation in creations:
-            creation_data = {
-                'id': creation.id,
-                'user_id': creation.user_id,
-                'image_data': creation.image_data or '',
-                'analysis_results': creation.analysis_results,
-                'poem_text': creation.poem_text,
-                'frame_style': creation.frame_style,
-                'final_image_data': creation.final_image_data,
-                'poem_type': creation.poem_type,
-                'emphasis': creation.emphasis,
-                'poem_length': creation.poem_length,
-                'time_saved_minutes': creation.time_saved_minutes or 0,
-                'created_at': creation.created_at.isoformat() if creation.created_at else None,
-                'share_code': creation.share_code,
-                'is_downloaded': creation.is_downloaded or False,
-                'download_count': creation.download_count or 0,
-                'view_count': creation.view_count or 0,
-                'last_viewed_at': creation.last_viewed_at.isoformat() if creation.last_viewed_at else None,
-                'last_downloaded_at': creation.last_downloaded_at.isoformat() if creation.last_downloaded_at else None
-            }
-            creations_data.append(creation_data)
+        creations_data = [
+            creation.to_dict(include_payload=include_payload)
+            for creation in creations
+        ]
         
         # Convert transactions to JSON format
         transactions_data = []
@@ -749,35 +592,20 @@ def financial():
         start_date = datetime.utcnow() - timedelta(days=30)
         end_date = datetime.utcnow()
     
-    # Get completed transactions in date range
-    transactions = Transaction.query.filter(
-        Transaction.created_at.between(start_date, end_date),
-        Transaction.status == 'completed'
-    ).order_by(Transaction.created_at.desc()).all()
-    
-    # Calculate summary metrics
-    total_revenue = sum(t.amount for t in transactions)
-    transaction_count = len(transactions)
+    # Summary and chart come from the daily revenue facts
+    transaction_count, total_revenue = daily_facts.revenue_summary(start_date.date(), end_date.date())
     avg_transaction = total_revenue / transaction_count if transaction_count > 0 else 0
-    
-    # Group by day for chart
-    daily_revenue = {}
-    current_date = start_date
-    while current_date <= end_date:
-        day_str = current_date.strftime('%Y-%m-%d')
-        daily_revenue[day_str] = 0
-        current_date += timedelta(days=1)
-    
-    for t in transactions:
-        day_str = t.created_at.strftime('%Y-%m-%d')
-        if day_str in daily_revenue:
-            daily_revenue[day_str] += t.amount
-    
-    # Convert to sorted list for chart
+
     revenue_data = [
-        {'date': k, 'amount': float(v)}  # Ensure amount is a float for JSON serialization
-        for k, v in sorted(daily_revenue.items())
+        {'date': day.strftime('%Y-%m-%d'), 'amount': float(amount)}  # Ensure amount is a float for JSON serialization
+        for day, amount in daily_facts.daily_revenue(start_date.date(), end_date.date())
     ]
+
+    # Only the most recent transactions are listed
+    transactions = Transaction.query.filter(
+        Transaction.created_at.between(start_date, end_date),
+        Transaction.status == 'completed'
+    ).order_by(Transaction.created_at.desc()).limit(FINANCIAL_TRANSACTION_LIMIT).all()
     
     # We don't need to set the tojson filter as it's built into Flask
     
@@ -797,74 +625,21 @@ def financial():
 @admin_required
 @permission_required('view_analytics')
 def analytics():
-    # Get poem type distribution
-    poem_types = db.session.query(
-        Creation.poem_type, 
-        func.count(Creation.id)
-    ).filter(
-        Creation.poem_type.isnot(None)
-    ).group_by(
-        Creation.poem_type
-    ).all()
-    
-    # Get frame style distribution
-    frame_styles = db.session.query(
-        Creation.frame_style, 
-        func.count(Creation.id)
-    ).filter(
-        Creation.frame_style.isnot(None)
-    ).group_by(
-        Creation.frame_style
-    ).all()
-    
-    # Get poem length distribution
-    poem_lengths = db.session.query(
-        Creation.poem_length, 
-        func.count(Creation.id)
-    ).filter(
-        Creation.poem_length.isnot(None)
-    ).group_by(
-        Creation.poem_length
-    ).all()
-    
-    # Calculate total time saved
-    total_time_saved = db.session.query(
-        func.sum(Creation.time_saved_minutes)
-    ).filter(
-        Creation.time_saved_minutes.isnot(None)
-    ).scalar() or 0
+    # Distributions and totals come from the daily creation facts
+    poem_types = daily_facts.creation_breakdown('poem_type')
+    frame_styles = daily_facts.creation_breakdown('frame_style')
+    poem_lengths = daily_facts.creation_breakdown('poem_length')
+    total_time_saved = daily_facts.total_time_saved_minutes()
     
     # Format for display
     hours_saved = total_time_saved // 60
     minutes_saved = total_time_saved % 60
     
     # Daily poem generation over last 30 days
-    thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-    daily_creations = db.session.query(
-        func.date(Creation.created_at),
-        func.count(Creation.id)
-    ).filter(
-        Creation.created_at >= thirty_days_ago
-    ).group_by(
-        func.date(Creation.created_at)
-    ).all()
-    
-    # Convert to dict for easy chart rendering
-    daily_data = {}
-    current_date = thirty_days_ago.date()
     end_date = datetime.utcnow().date()
-    
-    while current_date <= end_date:
-        daily_data[current_date.isoformat()] = 0
-        current_date += timedelta(days=1)
-    
-    for date, count in daily_creations:
-        daily_data[date.isoformat()] = count
-    
-    # Convert to sorted list for chart
     creation_data = [
-        {'date': k, 'count': v} 
-        for k, v in sorted(daily_data.items())
+        {'date': day.isoformat(), 'count': int(count)}
+        for day, count in daily_facts.daily_creations(end_date - timedelta(days=30), end_date)
     ]
     
     return render_template(
@@ -884,10 +659,10 @@ def analytics():
 @permission_required('view_analytics')
 def visitors():
     """View visitor statistics and analytics."""
-    from utils.visitor_tracking import update_visitor_stats, get_page_popularity, get_referrer_stats
+    from utils.visitor_tracking import get_current_visitor_stats, get_page_popularity, get_referrer_stats
     
-    # Update the visitor statistics
-    stats = update_visitor_stats()
+    # Read the precomputed visitor statistics (kept current by the background rollup)
+    stats = get_current_visitor_stats()
     
     # Get daily, monthly, and yearly stats
     daily_stats = stats['daily']
@@ -941,6 +716,64 @@ def visitors():
         yearly_visitors=yearly_visitors
     )
 
+@admin_bp.route('/visitors/uniques')
+@admin_required
+@permission_required('view_analytics')
+def visitor_uniques():
+    """Estimate unique visitors for any date range, site-wide or for one page or referrer."""
+    from utils.visitor_tracking import count_unique_visitors, get_unique_breakdown, get_sketch_error, SKETCH_PRECISION
+
+    try:
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if request.args.get('end') else datetime.utcnow().date()
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d').date() if request.args.get('start') else end - timedelta(days=29)
+    except ValueError:
+        return jsonify({'error': 'Dates must be in YYYY-MM-DD format'}), 400
+    if start > end:
+        return jsonify({'error': 'start must not be after end'}), 400
+
+    dimension = request.args.get('dimension', 'site')
+    if dimension not in SKETCH_PRECISION:
+        return jsonify({'error': f"dimension must be one of {', '.join(SKETCH_PRECISION)}"}), 400
+
+    result = {'start': start.isoformat(), 'end': end.isoformat(), 'dimension': dimension}
+    if dimension == 'site' or request.args.get('value') is not None:
+        result.update(count_unique_visitors(start, end, dimension, request.args.get('value', '')))
+        if dimension != 'site':
+            result['value'] = request.args.get('value')
+    else:
+        limit = min(request.args.get('limit', 10, type=int), 100)
+        result['top'] = [{'value': value, 'visits': visits, 'unique_visitors': uniques}
+                         for value, visits, uniques in get_unique_breakdown(dimension, start, end, limit)]
+        result['relative_error'] = round(get_sketch_error(dimension), 4)
+    return jsonify(result)
+
+# Runtime metrics
+@admin_bp.route('/metrics')
+@admin_required
+@permission_required('view_analytics')
+def metrics():
+    """Expose runtime cache metrics as JSON."""
+    from utils.cache import get_cache_stats
+    from utils.image_analyzer import get_phash_index_stats
+    from utils.http_client import get_http_stats
+    from utils.visitor_tracking import get_visit_buffer_stats
+    from utils.creation_counters import get_counter_stats
+    from utils.renderer import get_font_cache_stats
+    from utils.frames import get_frame_cache_stats
+    from utils.ingest import get_ingest_stats
+
+    return jsonify({
+        'caches': get_cache_stats(),
+        'phash_index': get_phash_index_stats(),
+        'http': get_http_stats(),
+        'visitor_buffer': get_visit_buffer_stats(),
+        'creation_counters': get_counter_stats(),
+        'renderer_fonts': get_font_cache_stats(),
+        'frames': get_frame_cache_stats(),
+        'ingest': get_ingest_stats(),
+        'generated_at': datetime.utcnow().isoformat()
+    })
+
 # Admin User Management
 @admin_bp.route('/admins')
 @admin_required
@@ -2,45 +2,64 @@ import os
 import logging
 import functools
 import secrets
-from datetime import datetime, timedelta
+import hashlib
+from datetime import datetime
 import jwt
 import time
-from flask import Flask, render_template, request, jsonify, session, make_response, redirect, url_for, flash, current_app, g, Response
+from flask import Flask, Request, render_template, request, jsonify, session, make_response, redirect, url_for, flash, current_app, g, Response, stream_with_context
 from flask_mail import Mail, Message
 import base64
+import binascii
+import io
+import tempfile
 import uuid
 import json
 import string
 import random
 import re
 import stripe
+import click
 from typing import Union, Tuple
 from stripe.error import StripeError
+from sqlalchemy import or_, and_, event, inspect, func, exists
+from sqlalchemy.orm import joinedload, undefer_group, load_only, object_session, Session as SASession
+from concurrent.futures import ProcessPoolExecutor
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from werkzeug.security import generate_password_hash, check_password_hash
-from utils.image_analyzer import analyze_image
-from utils.poem_generator import generate_poem
-from utils.image_manipulator import create_framed_image
+from werkzeug.exceptions import RequestEntityTooLarge
+from utils.image_analyzer import (analyze_image, get_image_phash, set_analysis_loader,
+                                  set_phash_candidate_loader)
+from utils.perceptual_hash import hash_chunks, hex_to_hash, STORED_CHUNK_LAYOUT
+from utils.poem_generator import generate_poem, stream_poem
+from utils.async_pipeline import run_pipeline, pipeline_available
+from utils.job_queue import (job_handler, enqueue, make_idempotency_key, run_worker,
+                             stream_job_events)
+from utils.image_manipulator import create_framed_image, generate_derivatives
+from utils.frames import preload_frames
+from utils.ingest import normalize_upload
 from utils.sendgrid_mail import send_email
+from utils.blob_store import get_blob_store, is_valid_blob_key, guess_image_mimetype, BlobNotFound
+from utils.db_schema import ensure_columns, ensure_nullable, ensure_indexes
+from utils.response_cache import get_response_cache
+from utils.cache import LRUCache
+from utils.creation_counters import record_view, record_download
+from utils import visitor_partitions, daily_facts
 from models import db, Creation, User, Membership, Transaction, ContactMessage, AdminUser, AdminRole, AdminLog
-from models import SiteVisitor, VisitorLog, VisitorStats
+from models import SiteVisitor, VisitorLog, VisitorStats, VisitorSketch, RollupWatermark, Job, ImageHashChunk
 from utils.membership import (create_default_plans, get_user_plan,
                               check_poem_type_access, check_frame_access,
                               process_payment, get_user_creations,
                               get_available_poem_types, get_available_frames,
                               check_poem_length_access,
                               get_available_poem_lengths)
-from utils.visitor_tracking import track_visitor, update_visitor_stats
+from utils.visitor_tracking import record_visit, update_visitor_stats
 
 # Set up logging first so we can use it everywhere
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Simple in-memory cache for shared views
-_view_cache = {}
-
 def wants_json():
     """Check if client prefers JSON response"""
     # Check Accept header or if request content type is JSON
@@ -50,42 +69,58 @@ def wants_json():
             request.headers.get('Accept', '').find('application/json') > -1)
 
 
-def cache_view(timeout=3600):  # Default cache of 1 hour
-    """Cache decorator for view functions"""
+def wants_image_payload():
+    """
+    Check if a JSON response should inline base64 image data.
+
+    The mobile app decodes image_data/final_image_data itself, so JSON
+    responses keep them by default. Clients that load images from the
+    returned URLs pass ?include=urls to leave them (and their queries) out.
+    """
+    return wants_json() and request.args.get('include') != 'urls'
+
+
+def cache_view(timeout=3600, tags=None):  # Default cache of 1 hour
+    """
+    Cache decorator for view functions.
+
+    Responses are cached per path, query string, negotiated format (JSON or
+    HTML) and logged-in user, in the bounded response cache shared by all
+    workers (see utils.response_cache).
+
+    Args:
+        timeout (int): Seconds a cached response is served
+        tags (callable, optional): Called with the view's arguments; returns
+            the invalidation tags of the response (see invalidate_creation_views)
+    """
 
     def decorator(f):
 
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
-            # Create a cache key from the function name and arguments
-            # For shared views, this would be the share_code
-            cache_key = f"{f.__name__}:{str(kwargs)}"
-
-            # Try to get from cache first
-            cached_response = _view_cache.get(cache_key)
-            if cached_response:
-                expiry_time, response = cached_response
-                if datetime.now() < expiry_time:
-                    logger.debug(f"Cache hit for {cache_key}")
-                    return response
-                # Remove expired cache entries
-                del _view_cache[cache_key]
-
-            # Generate the response
-            response = f(*args, **kwargs)
-
-            # Cache the response if it's not an error
-            if isinstance(response, tuple):
-                # Response with status code
-                if response[1] == 200:
-                    _view_cache[cache_key] = (datetime.now() +
-                                              timedelta(seconds=timeout),
-                                              response)
-            else:
-                # Regular response
-                _view_cache[cache_key] = (datetime.now() +
-                                          timedelta(seconds=timeout), response)
-
+            # Requests that would read or change per-request session state render fresh
+            if request.method != 'GET' or session.get('_flashes'):
+                return f(*args, **kwargs)
+
+            cache = get_response_cache()
+            variant = ('json' if wants_json() else 'html', session.get('user_id'))
+            cache_key = cache.make_key(request.path,
+                                       request.args.items(multi=True),
+                                       variant,
+                                       tags(**kwargs) if tags else ())
+
+            cached_response = cache.get(cache_key)
+            if cached_response is not None:
+                logger.debug(f"Cache hit for {request.path}")
+                # Responses carrying an ETag or Last-Modified answer revalidations with a 304
+                return cached_response.make_conditional(request)
+
+            response = make_response(f(*args, **kwargs))
+            # A view that changed the session (e.g. logged someone in) is specific to this client
+            if not session.modified:
+                cache.set(cache_key, response, timeout)
+            if response.status_code == 200:
+                response.make_conditional(request)
             return response
 
         return wrapper
@@ -93,13 +128,89 @@ def cache_view(timeout=3600):  # Default cache of 1 hour
     return decorator
 
 
+def invalidate_creation_views(*share_codes):
+    """Invalidate the cached gallery and the cached shared pages of the given share codes."""
+    get_response_cache().invalidate('gallery', *[f"shared:{code}" for code in share_codes if code])
+
+
+@event.listens_for(Creation, 'after_insert')
+@event.listens_for(Creation, 'after_update')
+@event.listens_for(Creation, 'after_delete')
+def _track_creation_change(mapper, connection, target):
+    """Remember changed creations so their cached views are invalidated once the change commits."""
+    changed = object_session(target).info.setdefault('changed_share_codes', set())
+    changed.add(target.share_code)
+    # A creation that just got its public share code also stops being reachable under the old one
+    changed.update(inspect(target).attrs.share_code.history.deleted or ())
+
+
+def _hash_chunk_rows(creation_id, image_phash):
+    return [{'creation_id': creation_id, 'position': position, 'chunk': chunk}
+            for position, chunk in hash_chunks(hex_to_hash(image_phash), STORED_CHUNK_LAYOUT)]
+
+
+@event.listens_for(Creation, 'after_insert')
+@event.listens_for(Creation, 'after_update')
+def _index_creation_phash(mapper, connection, target):
+    """Keep a creation's rows in the near-duplicate index in step with its perceptual hash."""
+    if not inspect(target).attrs.image_phash.history.has_changes():
+        return
+    table = ImageHashChunk.__table__
+    connection.execute(table.delete().where(table.c.creation_id == target.id))
+    if target.image_phash:
+        connection.execute(table.insert(), _hash_chunk_rows(target.id, target.image_phash))
+
+
+@event.listens_for(Creation, 'after_delete')
+def _unindex_creation_phash(mapper, connection, target):
+    # SQLite doesn't enforce the cascade unless foreign keys are switched on
+    table = ImageHashChunk.__table__
+    connection.execute(table.delete().where(table.c.creation_id == target.id))
+
+
+@event.listens_for(SASession, 'after_commit')
+def _invalidate_changed_creations(db_session):
+    changed = db_session.info.pop('changed_share_codes', None)
+    if changed:
+        invalidate_creation_views(*changed)
+
+
+@event.listens_for(SASession, 'after_rollback')
+def _forget_changed_creations(db_session):
+    db_session.info.pop('changed_share_codes', None)
+
+
+# Multipart file parts larger than this are spooled to a temporary file
+UPLOAD_SPOOL_THRESHOLD = int(os.environ.get("UPLOAD_SPOOL_THRESHOLD", str(512 * 1024)))
+
+# Largest accepted upload (after base64 decoding for JSON uploads)
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+
+
+class SpoolingRequest(Request):
+    """Request that keeps uploaded files in memory only up to UPLOAD_SPOOL_THRESHOLD."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD, mode='rb+')
+
+
 # Initialize Flask app
 app = Flask(__name__)
+app.request_class = SpoolingRequest
+# Reject bodies that can't hold a valid upload before reading them (base64 adds a third)
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get("MAX_CONTENT_LENGTH", str(MAX_UPLOAD_BYTES * 3 // 2)))
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key")
 stripe.api_key = os.environ.get("STRIPE_SECRET_KEY")
 stripe.api_version = "2023-08-16"
 STRIPE_PUBLISHABLE_KEY = os.environ.get("STRIPE_PUBLISHABLE_KEY")
 
+# Browser and shared-cache (CDN) lifetimes of anonymous /shared/<share_code> responses
+SHARED_VIEW_MAX_AGE = int(os.environ.get("SHARED_VIEW_MAX_AGE", "300"))
+SHARED_VIEW_SHARED_MAX_AGE = int(os.environ.get("SHARED_VIEW_SHARED_MAX_AGE", "3600"))
+
+# Share code -> creation id lookups kept in memory for counter beacons
+SHARE_CODE_CACHE_SIZE = int(os.environ.get("SHARE_CODE_CACHE_SIZE", "10000"))
+
 # Register admin blueprint
 from admin import admin_bp
 app.register_blueprint(admin_bp)
@@ -125,51 +236,135 @@ db.init_app(app)
 # Create all database tables if they don't exist
 try:
     with app.app_context():
+        # On PostgreSQL visitor_log is created as a monthly partitioned table
+        visitor_partitions.prepare_storage()
         db.create_all()
+        ensure_columns(Creation, ['image_key', 'final_image_key', 'derivative_keys', 'image_phash', 'updated_at'])
+        ensure_nullable(Creation, ['image_data'])
+        ensure_indexes(Creation)
+        ensure_columns(VisitorStats, ['duration_total', 'duration_count'])
+        ensure_columns(VisitorLog, ['referrer'])
+        ensure_columns(VisitorSketch, ['visits'])
+        visitor_partitions.ensure_partitions()
         logger.info("Database tables created successfully")
 except Exception as e:
     logger.error(f"Error creating database tables: {str(e)}", exc_info=True)
 
+
+def load_creation_analysis(image_key):
+    """
+    Load persisted analysis results for an original image, used for near-duplicate reuse.
+
+    Called from the async pipeline's executor threads as well as from requests,
+    so it runs in an application context of its own.
+    """
+    with app.app_context():
+        creation = Creation.query.options(load_only(Creation.id, Creation.analysis_results)).filter(
+            Creation.image_key == image_key,
+            Creation.analysis_results.isnot(None)
+        ).order_by(Creation.id.desc()).first()
+        return creation.analysis_results if creation else None
+
+
+def load_phash_candidates(chunks):
+    """
+    Load (perceptual hash, image key) of stored creations sharing a hash chunk, used for near-duplicate reuse.
+
+    Like load_creation_analysis, this runs in an application context of its own.
+    """
+    with app.app_context():
+        return db.session.query(Creation.image_phash, Creation.image_key).join(
+            ImageHashChunk, ImageHashChunk.creation_id == Creation.id
+        ).filter(
+            or_(*(and_(ImageHashChunk.position == position, ImageHashChunk.chunk == chunk)
+                  for position, chunk in chunks)),
+            Creation.image_key.isnot(None)
+        ).distinct().all()
+
+
+set_analysis_loader(load_creation_analysis)
+set_phash_candidate_loader(load_phash_candidates)
+
+# Decode the frame assets once, before the first render needs them
+try:
+    logger.info(f"Loaded {preload_frames()} frame assets")
+except Exception as e:
+    logger.error(f"Error loading frame assets: {str(e)}", exc_info=True)
+
+# Index the perceptual hashes of creations stored before the near-duplicate index was
+# kept in the database; later changes are indexed as they are flushed
+try:
+    with app.app_context():
+        watermark = db.session.get(RollupWatermark, 'image_hash_chunk')
+        last_id = watermark.position if watermark else 0
+        indexed = 0
+        while True:
+            batch = db.session.query(Creation.id, Creation.image_phash).filter(
+                Creation.id > last_id,
+                Creation.image_phash.isnot(None),
+                ~exists().where(ImageHashChunk.creation_id == Creation.id)
+            ).order_by(Creation.id.asc()).limit(5000).all()
+            if not batch:
+                break
+            db.session.execute(ImageHashChunk.__table__.insert(), [
+                row for creation_id, image_phash in batch for row in _hash_chunk_rows(creation_id, image_phash)])
+            db.session.commit()
+            last_id = batch[-1][0]
+            indexed += len(batch)
+        last_id = max(last_id, db.session.query(func.max(Creation.id)).scalar() or 0)
+        if watermark is None:
+            db.session.add(RollupWatermark(name='image_hash_chunk', position=last_id))
+        else:
+            watermark.position = last_id
+        db.session.commit()
+        logger.info(f"Indexed {indexed} stored perceptual hashes for near-duplicate search")
+except Exception as e:
+    logger.error(f"Error indexing perceptual hashes: {str(e)}", exc_info=True)
+
+# The admin pages read the daily fact tables, so fill them before the first refresh
+try:
+    with app.app_context():
+        if db.session.get(RollupWatermark, daily_facts.WATERMARK_NAME) is None:
+            start, end, rows = daily_facts.backfill_facts()
+            logger.info(f"Backfilled daily facts for {start} to {end} ({rows} rows)")
+except Exception as e:
+    logger.error(f"Error backfilling daily facts: {str(e)}", exc_info=True)
+
+# Beacons sent by pages that are already tracked, so they aren't visits themselves
+COUNTER_BEACON_ENDPOINTS = {'record_shared_view', 'record_shared_download'}
+
+
 # Set up visitor tracking
 @app.before_request
 def before_request():
-    # Skip static files, admin routes, and API routes
-    if not request.path.startswith('/static') and not request.path.startswith('/admin') and not request.path.startswith('/api'):
+    # Skip static files, admin routes, API routes and counter beacons
+    if (not request.path.startswith('/static') and not request.path.startswith('/admin')
+            and not request.path.startswith('/api') and request.endpoint not in COUNTER_BEACON_ENDPOINTS):
         # Store request start time for calculating duration
         g.start_time = time.time()
-        
-        # Track the visitor
-        user_id = session.get('user_id')
+
+@app.after_request
+def after_request(response):
+    # Visits are buffered in memory and written to the database in the background
+    if hasattr(g, 'start_time'):
         try:
-            visitor_id, is_new_visitor = track_visitor(user_id)
-            g.visitor_id = visitor_id
-            g.is_new_visitor = is_new_visitor
+            record_visit(session.get('user_id'), time_spent_seconds=time.time() - g.start_time)
         except Exception as e:
+            # Continue serving the response even if tracking fails
             logger.error(f"Error tracking visitor: {str(e)}", exc_info=True)
-            # Continue processing the request even if tracking fails
-            g.visitor_id = None
-            g.is_new_visitor = False
 
-@app.after_request
-def after_request(response):
-    # Skip static files, admin routes, and API routes
-    if hasattr(g, 'start_time') and hasattr(g, 'visitor_id') and g.visitor_id:
+    # Shared pages count views with a beacon from the page itself (see record_shared_view),
+    # which also covers copies served by the response cache, browsers and CDNs. API
+    # clients run no script, so JSON responses are counted here, cached or not.
+    if (request.endpoint == 'view_shared_creation' and response.status_code in (200, 304)
+            and response.mimetype == 'application/json'):
         try:
-            # Calculate time spent on the page
-            time_spent = int((time.time() - g.start_time) * 1000)  # in milliseconds
-            
-            # Update the visitor log with time spent
-            visitor_log = VisitorLog.query.filter_by(
-                visitor_id=g.visitor_id,
-                page_visited=request.path
-            ).order_by(VisitorLog.timestamp.desc()).first()
-            
-            if visitor_log:
-                visitor_log.time_spent_seconds = time_spent / 1000  # convert to seconds
-                db.session.commit()
+            creation_id = creation_id_for_share_code(request.view_args['share_code'])
+            if creation_id is not None:
+                record_view(creation_id)
         except Exception as e:
-            logger.error(f"Error updating visitor time spent: {str(e)}", exc_info=True)
-    
+            logger.error(f"Error counting shared view: {str(e)}", exc_info=True)
+
     return response
 
 # Schedule daily visitor stats update
@@ -183,6 +378,78 @@ def update_daily_visitor_stats():
         except Exception as e:
             logger.error(f"Error updating visitor stats: {str(e)}", exc_info=True)
 
+@app.cli.command("rollup-visitor-stats")
+@click.option("--rebuild", is_flag=True,
+              help="Rebuild the rollups from the retained visit log; periods before it are kept")
+def rollup_visitor_stats(rebuild):
+    """Roll visits recorded since the last run into the visitor statistics"""
+    with app.app_context():
+        if rebuild:
+            RollupWatermark.query.filter(RollupWatermark.name.in_(['visitor_log', 'site_visitor'])).delete(
+                synchronize_session=False)
+            db.session.commit()
+        stats = update_visitor_stats()
+        for name, row in stats.items():
+            print(f"{name}: {row.unique_visitors} unique visitors, {row.total_visits} visits")
+
+@app.cli.command("partition-visitor-log")
+def partition_visitor_log():
+    """Convert visitor_log into monthly partitions (PostgreSQL) and create upcoming partitions"""
+    with app.app_context():
+        if not visitor_partitions.uses_native_partitions():
+            print(f"{db.engine.dialect.name} has no native partitioning; visitor_log stays a single table")
+            return
+        copied = visitor_partitions.migrate_to_partitions()
+        if copied is not None:
+            print(f"Migrated {copied} visitor log rows into monthly partitions")
+        created = visitor_partitions.ensure_partitions()
+        print(f"Created {len(created)} new partitions")
+
+
+@app.cli.command("visitor-log-retention")
+@click.option("--months", default=visitor_partitions.VISITOR_LOG_RETENTION_MONTHS, show_default=True,
+              help="Months of visitor log to keep, including the current month")
+@click.option("--archive-dir", default=visitor_partitions.VISITOR_LOG_ARCHIVE_DIR, show_default=True,
+              help="Directory for archived months")
+@click.option("--format", "file_format", type=click.Choice(['csv', 'parquet']), default='csv', show_default=True,
+              help="Archive format (csv writes CSV.gz; parquet requires pyarrow)")
+@click.option("--compact/--no-compact", default=True, show_default=True,
+              help="Reclaim space after dropping rows")
+@click.option("--dry-run", is_flag=True, help="Only list the months that would be archived and dropped")
+def visitor_log_retention(months, archive_dir, file_format, compact, dry_run):
+    """Archive visitor log months older than the retention period, then drop them"""
+    with app.app_context():
+        processed = visitor_partitions.apply_retention(months, archive_dir, file_format, dry_run)
+        for month, path, rows in processed:
+            if dry_run:
+                print(f"Would archive and drop {month:%Y-%m}")
+            else:
+                print(f"Archived {rows} rows for {month:%Y-%m} to {path} and dropped them")
+        if processed and compact and not dry_run:
+            visitor_partitions.compact()
+        visitor_partitions.ensure_partitions()
+
+
+@app.cli.command("refresh-daily-facts")
+@click.option("--lookback-days", default=daily_facts.DAILY_FACTS_LOOKBACK_DAYS, show_default=True,
+              help="Days before the last refresh to recompute")
+def refresh_daily_facts(lookback_days):
+    """Update the daily fact tables read by the admin pages (schedule every few minutes)"""
+    with app.app_context():
+        start, end, rows = daily_facts.refresh_facts(lookback_days)
+        print(f"Rebuilt daily facts for {start} to {end} ({rows} rows)")
+
+
+@app.cli.command("backfill-daily-facts")
+@click.option("--since", default=None, help="First day to rebuild (YYYY-MM-DD); defaults to all history")
+def backfill_daily_facts(since):
+    """Rebuild the daily fact tables from the raw creation, transaction and session tables"""
+    with app.app_context():
+        start = datetime.strptime(since, '%Y-%m-%d').date() if since else None
+        start, end, rows = daily_facts.backfill_facts(start)
+        print(f"Rebuilt daily facts for {start} to {end} ({rows} rows)")
+
+
 # For development purposes, initialize with some data if tables are empty
 @app.cli.command("init-visitor-data")
 def init_visitor_data():
@@ -201,6 +468,160 @@ def init_visitor_data():
             logger.error(f"Error initializing visitor data: {str(e)}", exc_info=True)
 
 
+@app.cli.command("migrate-image-blobs")
+@click.option("--batch-size", default=50, show_default=True, help="Creations to migrate per transaction")
+def migrate_image_blobs(batch_size):
+    """Move legacy base64 image columns into the blob store in batches"""
+    with app.app_context():
+        ensure_columns(Creation, ['image_key', 'final_image_key'])
+        ensure_nullable(Creation, ['image_data'])
+
+        store = get_blob_store()
+        migrated = 0
+        last_id = 0
+
+        while True:
+            # Walk the table by primary key so each batch is a cheap range scan
+            batch = Creation.query.filter(
+                Creation.id > last_id,
+                or_(
+                    and_(Creation.image_key.is_(None), Creation.image_data.isnot(None)),
+                    and_(Creation.final_image_key.is_(None), Creation.final_image_data.isnot(None))
+                )
+            ).order_by(Creation.id.asc()).limit(batch_size).all()
+
+            if not batch:
+                break
+
+            for creation in batch:
+                try:
+                    if creation.image_data and not creation.image_key:
+                        creation.image_key = store.put(base64.b64decode(creation.image_data))
+                        creation.image_data = None
+                    if creation.final_image_data and not creation.final_image_key:
+                        creation.final_image_key = store.put(base64.b64decode(creation.final_image_data))
+                        creation.final_image_data = None
+                    migrated += 1
+                except Exception as e:
+                    logger.error(f"Error migrating images for creation {creation.id}: {str(e)}", exc_info=True)
+                last_id = creation.id
+
+            db.session.commit()
+            # Drop the loaded rows so memory stays flat across batches
+            db.session.expunge_all()
+            logger.info(f"Migrated images up to creation {last_id} ({migrated} creations so far)")
+
+        print(f"Migrated images for {migrated} creations")
+
+
+@app.cli.command("backfill-derivatives")
+@click.option("--batch-size", default=50, show_default=True, help="Creations to process per batch")
+@click.option("--workers", default=os.cpu_count() or 2, show_default=True, help="Worker processes for resizing")
+def backfill_derivatives(batch_size, workers):
+    """Generate thumbnail derivatives for existing creations"""
+    with app.app_context():
+        ensure_columns(Creation, ['derivative_keys'])
+
+        processed = 0
+        last_id = 0
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                batch = Creation.query.filter(
+                    Creation.id > last_id,
+                    Creation.derivative_keys.is_(None),
+                    or_(Creation.final_image_key.isnot(None), Creation.final_image_data.isnot(None))
+                ).order_by(Creation.id.asc()).limit(batch_size).all()
+
+                if not batch:
+                    break
+
+                # Read source images in this process, resize them in the pool
+                futures = {}
+                for creation in batch:
+                    last_id = creation.id
+                    try:
+                        futures[creation.id] = executor.submit(generate_derivatives, creation.get_final_image_bytes())
+                    except Exception as e:
+                        logger.error(f"Error reading final image for creation {creation.id}: {str(e)}")
+
+                for creation in batch:
+                    future = futures.get(creation.id)
+                    if future is None:
+                        continue
+                    try:
+                        creation.set_derivatives(future.result())
+                        processed += 1
+                    except Exception as e:
+                        logger.error(f"Error generating derivatives for creation {creation.id}: {str(e)}")
+
+                db.session.commit()
+                db.session.expunge_all()
+                logger.info(f"Generated derivatives up to creation {last_id} ({processed} creations so far)")
+
+        print(f"Generated derivatives for {processed} creations")
+
+
+@app.cli.command("backfill-image-phash")
+@click.option("--batch-size", default=200, show_default=True, help="Creations to hash per transaction")
+def backfill_image_phash(batch_size):
+    """Compute perceptual hashes for existing creations so they can be matched as near-duplicates"""
+    with app.app_context():
+        ensure_columns(Creation, ['image_phash'])
+
+        hashed = 0
+        last_id = 0
+
+        while True:
+            batch = Creation.query.filter(
+                Creation.id > last_id,
+                Creation.image_phash.is_(None),
+                Creation.image_key.isnot(None)
+            ).order_by(Creation.id.asc()).limit(batch_size).all()
+
+            if not batch:
+                break
+
+            for creation in batch:
+                last_id = creation.id
+                try:
+                    creation.image_phash = get_image_phash(creation.get_image_bytes())
+                    hashed += 1
+                except Exception as e:
+                    logger.error(f"Error hashing image for creation {creation.id}: {str(e)}")
+
+            db.session.commit()
+            db.session.expunge_all()
+            logger.info(f"Hashed images up to creation {last_id} ({hashed} creations so far)")
+
+        print(f"Computed perceptual hashes for {hashed} creations")
+
+
+@app.cli.command("run-worker")
+@click.option("--poll-interval", default=0.5, show_default=True, help="Seconds to wait when the queue is empty")
+@click.option("--burst", is_flag=True, help="Exit once the queue is empty")
+def run_worker_command(poll_interval, burst):
+    """Process background jobs (poem generation and final image rendering)"""
+    with app.app_context():
+        try:
+            processed = run_worker(poll_interval=poll_interval, burst=burst)
+            print(f"Processed {processed} jobs")
+        except KeyboardInterrupt:
+            logger.info("Job worker stopped")
+
+
+@app.template_global()
+def creation_image_url(creation, final=True, size=None):
+    """Return a URL for a creation's image, falling back to a data URI for legacy rows."""
+    if final and size and creation.derivative_keys:
+        return creation.get_derivative_url(size)
+    key = creation.final_image_key if final else creation.image_key
+    if key:
+        return url_for('serve_blob', key=key)
+    data = creation.final_image_data if final else creation.image_data
+    return f"data:image/jpeg;base64,{data}" if data else ''
+
+
 # Routes
 @app.route('/')
 def index():
@@ -230,121 +651,142 @@ def index():
         return render_template('index.html', user=user)
 
 
-@app.route('/analyze-image', methods=['POST'])
-def analyze_image_route() -> Union[Response, Tuple[Response, int]]:
-    """Analyze the uploaded image using Google Cloud Vision AI."""
-    try:
-        # Log request content type to help debug
-        logger.info(f"Request content type: {request.content_type}")
+def read_image_upload():
+    """
+    Read the uploaded image from a multipart form or a JSON body with base64 data.
+
+    The raw upload is handled once: multipart files are decoded from their
+    (possibly disk-spooled) stream, and JSON uploads are base64-decoded straight
+    from the body without intermediate copies. The image is then normalized
+    (see utils.ingest), and every later stage (analysis, hashing, storage,
+    rendering) uses the normalized bytes. The other fields of a JSON body are
+    left in g.upload_json.
+
+    Returns:
+        tuple: (image_bytes, file_size, None) on success, or
+        (None, 0, (response, status)) if the upload is missing or invalid
+    """
+    # Log request content type to help debug
+    logger.info(f"Request content type: {request.content_type}")
 
-        # Image can be in form data or direct JSON post with base64
-        image_file = None
-        image_data = None
-        file_size = 0
+    too_large = (jsonify({
+        'error':
+        'Image size exceeds the 5MB limit. Please choose a smaller image.'
+    }), 400)
 
-        if request.content_type and 'multipart/form-data' in request.content_type:
-            # Handle form uploads
-            if 'image' not in request.files:
-                logger.error("No image file in multipart request")
-                return jsonify(
-                    {'error': 'No image uploaded. Please try again.'}), 400
+    # Image can be in form data or direct JSON post with base64
+    image_source = None
+    filename = None
+    file_size = 0
 
-            image_file = request.files['image']
+    if request.content_type and 'multipart/form-data' in request.content_type:
+        # Handle form uploads
+        try:
+            files = request.files
+        except RequestEntityTooLarge:
+            return None, 0, too_large
+
+        if 'image' not in files:
+            logger.error("No image file in multipart request")
+            return None, 0, (jsonify(
+                {'error': 'No image uploaded. Please try again.'}), 400)
+
+        image_file = files['image']
+        filename = image_file.filename
+
+        if filename == '':
+            logger.error("Empty filename in uploaded file")
+            return None, 0, (jsonify(
+                {'error': 'No image selected. Please try again.'}), 400)
+
+        # Log received file type
+        logger.info(f"Received image type: {image_file.content_type}")
+
+        # Check file size - limit to 5MB
+        image_source = image_file.stream
+        image_source.seek(0, os.SEEK_END)
+        file_size = image_source.tell()
+        logger.info(f"Upload file size: {file_size/1024/1024:.2f}MB")
+
+    elif request.content_type and 'application/json' in request.content_type:
+        # Handle direct JSON posts with base64 data
+        try:
+            # Don't cache the raw body; only the parsed fields are needed
+            json_data = request.get_json(cache=False)
 
-            if image_file.filename == '':
-                logger.error("Empty filename in uploaded file")
-                return jsonify(
-                    {'error': 'No image selected. Please try again.'}), 400
+            if not json_data or 'image' not in json_data:
+                logger.error("No image data in JSON request")
+                return None, 0, (jsonify(
+                    {'error':
+                     'No image data provided. Please try again.'}), 400)
 
-            # Log received file type
-            logger.info(f"Received image type: {image_file.content_type}")
+            # Take the base64 string out of the body so it can be freed once decoded
+            encoded = json_data.pop('image').encode('ascii')
+            g.upload_json = json_data
 
-            # Check file size - limit to 5MB
-            image_file.seek(0, os.SEEK_END)
-            file_size = image_file.tell()
-            logger.info(f"Upload file size: {file_size/1024/1024:.2f}MB")
+            # Skip a data URL prefix ("data:image/jpeg;base64,") if present
+            start = encoded.find(b',', 0, 256) + 1
 
-            # Reset file pointer for processing
-            image_file.seek(0)
+            # Check size of base64 data
+            estimated_size = (len(encoded) - start) * 3 / 4  # Rough estimation
+            logger.info(
+                f"Estimated upload size from base64: {estimated_size/1024/1024:.2f}MB"
+            )
 
-            # Read image data
-            image_data = base64.b64encode(image_file.read()).decode('utf-8')
+            if estimated_size > MAX_UPLOAD_BYTES:
+                return None, 0, too_large
 
-        elif request.content_type and 'application/json' in request.content_type:
-            # Handle direct JSON posts with base64 data
-            try:
-                json_data = request.get_json()
-
-                if not json_data or 'image' not in json_data:
-                    logger.error("No image data in JSON request")
-                    return jsonify(
-                        {'error':
-                         'No image data provided. Please try again.'}), 400
-
-                # Get the base64 image string, removing data URL prefix if present
-                base64_image = json_data['image']
-                if ',' in base64_image:
-                    base64_image = base64_image.split(',')[1]
-
-                # Check size of base64 data
-                estimated_size = len(base64_image) * 3 / 4  # Rough estimation
-                file_size = estimated_size
-                logger.info(
-                    f"Estimated upload size from base64: {estimated_size/1024/1024:.2f}MB"
-                )
+            # Decode through a memoryview so the prefix is skipped without copying
+            image_source = binascii.a2b_base64(memoryview(encoded)[start:])
+            del encoded
+            file_size = len(image_source)
+            filename = "mobile_upload.jpg"
 
-                if estimated_size > 5 * 1024 * 1024:  # 5MB limit
-                    return jsonify({
-                        'error':
-                        'Image size exceeds the 5MB limit. Please choose a smaller image.'
-                    }), 400
+        except RequestEntityTooLarge:
+            return None, 0, too_large
+        except Exception as e:
+            logger.error(f"Error processing JSON image data: {str(e)}",
+                         exc_info=True)
+            return None, 0, (jsonify(
+                {'error': 'Invalid image data. Please try again.'}), 400)
+    else:
+        logger.error(f"Unsupported content type: {request.content_type}")
+        return None, 0, (jsonify(
+            {'error': 'Unsupported upload method. Please try again.'}), 400)
 
-                # Store the base64 data
-                image_data = base64_image
+    # Check file size - limit to 5MB (final check)
+    if file_size > MAX_UPLOAD_BYTES:
+        return None, 0, too_large
 
-                # Create a file-like object for analysis
-                import io
-                image_bytes = base64.b64decode(base64_image)
-                image_file = io.BytesIO(image_bytes)
-                # Add a placeholder filename attribute for logging
-                image_file.filename = "mobile_upload.jpg"
+    try:
+        image_bytes = normalize_upload(image_source)
+    except ValueError as e:
+        logger.warning(f"Rejected upload {filename}: {str(e)}")
+        return None, 0, (jsonify(
+            {'error': 'This file is not an image we can read. Please try a JPEG or PNG.'}), 400)
 
-            except Exception as e:
-                logger.error(f"Error processing JSON image data: {str(e)}",
-                             exc_info=True)
-                return jsonify(
-                    {'error': 'Invalid image data. Please try again.'}), 400
-        else:
-            logger.error(f"Unsupported content type: {request.content_type}")
-            return jsonify(
-                {'error': 'Unsupported upload method. Please try again.'}), 400
+    return image_bytes, file_size, None
 
-        # Check file size - limit to 5MB (final check)
-        if file_size > 5 * 1024 * 1024:  # 5MB limit
-            return jsonify({
-                'error':
-                'Image size exceeds the 5MB limit. Please choose a smaller image.'
-            }), 400
+
+@app.route('/analyze-image', methods=['POST'])
+def analyze_image_route() -> Union[Response, Tuple[Response, int]]:
+    """Analyze the uploaded image using Google Cloud Vision AI."""
+    try:
+        image_bytes, file_size, upload_error = read_image_upload()
+        if upload_error:
+            return upload_error
 
         # Generate a shorter unique ID for this analysis
         analysis_id = str(uuid.uuid4()).split('-')[0]
 
-        # Reset file pointer and read image data
-        image_file.seek(0)
-
-        # Some mobile browsers may send strange content types
-        # Store original data regardless
-        image_data = base64.b64encode(image_file.read()).decode('utf-8')
-
         # Analyze the image using Google Cloud Vision AI
-        image_file.seek(0)
         logger.info(
-            f"Analyzing image: {image_file.filename} ({file_size/1024:.1f} KB)"
+            f"Analyzing image ({file_size/1024:.1f} KB uploaded, {len(image_bytes)/1024:.1f} KB normalized)"
         )
 
         try:
             # Get raw analysis results from Google Vision API
-            analysis_results = analyze_image(image_file)
+            analysis_results = analyze_image(io.BytesIO(image_bytes))
 
             # Check if we got valid analysis results
             if not analysis_results or '_error' in analysis_results:
@@ -366,6 +808,10 @@ def analyze_image_route() -> Union[Response, Tuple[Response, int]]:
                 'Error analyzing image. Please try again with a different image.'
             }), 500
 
+        # Store the original image in the blob store once, outside the retry loop
+        image_key = get_blob_store().put(image_bytes)
+        image_phash = get_image_phash(image_bytes)
+
         # Create a temporary creation in the database with retry mechanism
         max_retries = 3
         retry_count = 0
@@ -379,7 +825,8 @@ def analyze_image_route() -> Union[Response, Tuple[Response, int]]:
                 user_id = session.get('user_id')
 
                 temp_creation = Creation()
-                temp_creation.image_data = image_data
+                temp_creation.image_key = image_key
+                temp_creation.image_phash = image_phash
                 temp_creation.analysis_results = analysis_results
                 temp_creation.share_code = f"temp{analysis_id}"
                 temp_creation.user_id = user_id
@@ -424,6 +871,208 @@ def analyze_image_route() -> Union[Response, Tuple[Response, int]]:
             {'error': 'An unexpected error occurred. Please try again.'}), 500
 
 
+def poem_options_from_request(data):
+    """
+    Extract poem generation options from a request payload.
+
+    Args:
+        data (dict): The JSON payload sent by the client
+
+    Returns:
+        dict: Keyword arguments for generate_poem
+    """
+    # Get user preferences from the request
+    poem_type = data.get('poemType', 'general verse')
+    poem_length = data.get('poemLength', 'short')
+    emphasis = data.get('emphasis', [])
+    is_regeneration = data.get('isRegeneration', False)
+
+    # Get structured custom prompt info if provided
+    custom_prompt = data.get('customPrompt', {})
+    custom_category = custom_prompt.get('category', '')
+
+    # Check if we're using structured prompt format
+    if custom_category == 'structured':
+        # Extract structured fields
+        name = custom_prompt.get('name', '')
+        place = custom_prompt.get('place', '')
+        emotion = custom_prompt.get('emotion', '')
+        action = custom_prompt.get('action', '')
+        additional = custom_prompt.get('additional', '')
+
+        # Combine structured fields into a formatted prompt
+        structured_terms = []
+        if name:
+            structured_terms.append(f"Name: {name}")
+        if place:
+            structured_terms.append(f"Place: {place}")
+        if emotion:
+            structured_terms.append(f"Emotion: {emotion}")
+        if action:
+            structured_terms.append(f"Action: {action}")
+        if additional:
+            structured_terms.append(f"Additional details: {additional}")
+
+        custom_terms = "; ".join(structured_terms)
+        logger.debug(f"Structured prompt created: {custom_terms}")
+    else:
+        # Legacy format - single text field
+        custom_terms = custom_prompt.get('terms', '')
+
+    # The category only applies when custom terms were given
+    if not custom_terms:
+        custom_category = ''
+
+    return {
+        'poem_type': poem_type,
+        'poem_length': poem_length,
+        'emphasis': emphasis,
+        'custom_terms': custom_terms,
+        'custom_category': custom_category,
+        'is_regeneration': is_regeneration
+    }
+
+
+def estimate_time_saved(poem_length):
+    """Estimate the minutes a user saved by not writing a poem of the given length."""
+    # Calculate time saved based on poem length
+    if poem_length == 'short':
+        time_saved_minutes = 25  # Average 25 minutes saved for short poems (4-6 lines)
+    elif poem_length == 'medium':
+        time_saved_minutes = 90  # Average 90 minutes (1.5 hours) saved for medium poems (10-12 lines)
+    elif poem_length == 'long':
+        time_saved_minutes = 180  # Average 180 minutes (3 hours) saved for long poems (20+ lines)
+    else:
+        time_saved_minutes = 45  # Default to 45 minutes if length is unknown
+
+    return time_saved_minutes
+
+
+def generate_creation_poem(creation, poem_options):
+    """
+    Generate a poem for a creation's analysis and store it with its preferences.
+
+    Args:
+        creation (Creation): The temporary creation holding the analysis
+        poem_options (dict): Options from poem_options_from_request()
+
+    Returns:
+        str: The generated poem
+    """
+    # Generate the poem using the LLM with custom prompt if provided
+    poem = generate_poem(creation.analysis_results, **poem_options)
+    store_creation_poem(creation, poem, poem_options)
+    return poem
+
+
+def store_creation_poem(creation, poem, poem_options):
+    """Save a generated poem and its preferences on a temporary creation."""
+    # Update the temporary creation with the poem and time saved data
+    creation.poem_text = poem
+    creation.poem_type = poem_options['poem_type']
+    creation.emphasis = poem_options['emphasis']
+    creation.poem_length = poem_options['poem_length']
+    creation.time_saved_minutes = estimate_time_saved(poem_options['poem_length'])
+
+    db.session.commit()
+
+
+def render_creation_final_image(creation, frame_style):
+    """
+    Render a creation's framed final image, store it and assign a share code.
+
+    Args:
+        creation (Creation): The creation with an image and poem
+        frame_style (str): The selected frame style
+
+    Returns:
+        bytes: The encoded final image
+    """
+    # Create the framed image with the poem
+    final_image = create_framed_image(
+        creation.get_image_bytes(),
+        creation.poem_text,
+        frame_style)
+
+    # Generate a unique share code
+    share_code = ''.join(
+        random.choices(string.ascii_uppercase + string.digits, k=10))
+
+    # Create the final creation by updating the temporary one
+    creation.frame_style = frame_style
+    creation.set_final_image(final_image)
+    try:
+        creation.set_derivatives(generate_derivatives(final_image))
+    except Exception as derivative_error:
+        # Derivatives are an optimization; the backfill command can regenerate them
+        logger.error(f"Error generating image derivatives: {str(derivative_error)}", exc_info=True)
+        creation.derivative_keys = None
+    creation.share_code = share_code
+    db.session.commit()
+
+    return final_image
+
+
+def wants_background_job(data):
+    """Check if the client asked for the work to run as a background job."""
+    return bool(data.get('async')) or 'respond-async' in request.headers.get('Prefer', '')
+
+
+def job_idempotency(data, job_type, *parts):
+    """
+    Pick the idempotency key for a job submission.
+
+    A client-supplied key (Idempotency-Key header or idempotencyKey field)
+    also deduplicates against finished jobs. Without one, a key derived from
+    the inputs only collapses duplicate submissions while a job is in flight,
+    so a deliberate regeneration later still runs.
+    """
+    client_key = request.headers.get('Idempotency-Key') or data.get('idempotencyKey')
+    if client_key:
+        return {'idempotency_key': make_idempotency_key(job_type, client_key), 'reuse_finished': True}
+    return {'idempotency_key': make_idempotency_key(job_type, *parts), 'reuse_finished': False}
+
+
+def serialize_job(job):
+    """Serialize a job for clients, adding URLs for rendered images."""
+    data = job.to_dict()
+    result = data.get('result') or {}
+    if result.get('finalImageKey'):
+        data['result'] = dict(result, finalImageUrl=url_for('serve_blob', key=result['finalImageKey']))
+    return data
+
+
+def job_accepted_response(job):
+    """Build the 202 response returned when work is queued."""
+    return jsonify(dict(serialize_job(job),
+                        success=True,
+                        statusUrl=url_for('job_status', job_id=job.id),
+                        eventsUrl=url_for('job_events', job_id=job.id))), 202
+
+
+@job_handler('generate_poem')
+def generate_poem_job(payload):
+    """Background job: generate and store the poem for a creation."""
+    creation = db.session.get(Creation, payload['creation_id'])
+    if not creation:
+        raise ValueError('Analysis data not found')
+    return {'poem': generate_creation_poem(creation, payload['poem_options'])}
+
+
+@job_handler('create_final_image')
+def create_final_image_job(payload):
+    """Background job: render the final framed image for a creation."""
+    creation = db.session.get(Creation, payload['creation_id'])
+    if not creation or not (creation.image_key or creation.image_data) or not creation.poem_text:
+        raise ValueError('Image or poem data not found')
+    render_creation_final_image(creation, payload['frame_style'])
+    return {
+        'shareCode': creation.share_code,
+        'creationId': creation.id,
+        'finalImageKey': creation.final_image_key
+    }
+
+
 @app.route('/generate-poem', methods=['POST'])
 def generate_poem_route():
     """Generate a poem based on image analysis and user preferences."""
@@ -441,84 +1090,19 @@ def generate_poem_route():
         if not temp_creation:
             return jsonify({'error': 'Analysis data not found'}), 400
 
-        # Get analysis results from the database
-        analysis_results = temp_creation.analysis_results
-
         # Get user preferences from the request
-        poem_type = data.get('poemType', 'general verse')
-        poem_length = data.get('poemLength', 'short')
-        emphasis = data.get('emphasis', [])
-        is_regeneration = data.get('isRegeneration', False)
-
-        # Get structured custom prompt info if provided
-        custom_prompt = data.get('customPrompt', {})
-        custom_category = custom_prompt.get('category', '')
-
-        # Check if we're using structured prompt format
-        if custom_category == 'structured':
-            # Extract structured fields
-            name = custom_prompt.get('name', '')
-            place = custom_prompt.get('place', '')
-            emotion = custom_prompt.get('emotion', '')
-            action = custom_prompt.get('action', '')
-            additional = custom_prompt.get('additional', '')
-
-            # Combine structured fields into a formatted prompt
-            structured_terms = []
-            if name:
-                structured_terms.append(f"Name: {name}")
-            if place:
-                structured_terms.append(f"Place: {place}")
-            if emotion:
-                structured_terms.append(f"Emotion: {emotion}")
-            if action:
-                structured_terms.append(f"Action: {action}")
-            if additional:
-                structured_terms.append(f"Additional details: {additional}")
-
-            custom_terms = "; ".join(structured_terms)
-            logger.debug(f"Structured prompt created: {custom_terms}")
-        else:
-            # Legacy format - single text field
-            custom_terms = custom_prompt.get('terms', '')
-
-        # Generate the poem using the LLM with custom prompt if provided
-        if custom_terms:
-            # Pass the custom prompt data to the poem generator
-            poem = generate_poem(analysis_results,
-                                 poem_type,
-                                 poem_length,
-                                 emphasis,
-                                 custom_terms=custom_terms,
-                                 custom_category=custom_category,
-                                 is_regeneration=is_regeneration)
-        else:
-            # Generate poem without custom prompt
-            poem = generate_poem(analysis_results,
-                                 poem_type,
-                                 poem_length,
-                                 emphasis,
-                                 is_regeneration=is_regeneration)
-
-        # Calculate time saved based on poem length
-        time_saved_minutes = 0
-        if poem_length == 'short':
-            time_saved_minutes = 25  # Average 25 minutes saved for short poems (4-6 lines)
-        elif poem_length == 'medium':
-            time_saved_minutes = 90  # Average 90 minutes (1.5 hours) saved for medium poems (10-12 lines)
-        elif poem_length == 'long':
-            time_saved_minutes = 180  # Average 180 minutes (3 hours) saved for long poems (20+ lines)
-        else:
-            time_saved_minutes = 45  # Default to 45 minutes if length is unknown
+        poem_options = poem_options_from_request(data)
 
-        # Update the temporary creation with the poem and time saved data
-        temp_creation.poem_text = poem
-        temp_creation.poem_type = poem_type
-        temp_creation.emphasis = emphasis
-        temp_creation.poem_length = poem_length
-        temp_creation.time_saved_minutes = time_saved_minutes
+        # Optionally hand the work to a background worker and return a job ID
+        if wants_background_job(data):
+            job, _ = enqueue('generate_poem',
+                             {'creation_id': temp_creation.id, 'poem_options': poem_options},
+                             **job_idempotency(data, 'generate_poem', temp_creation.id, poem_options),
+                             user_id=session.get('user_id'),
+                             creation_id=temp_creation.id)
+            return job_accepted_response(job)
 
-        db.session.commit()
+        poem = generate_creation_poem(temp_creation, poem_options)
 
         return jsonify({'success': True, 'poem': poem})
 
@@ -527,6 +1111,121 @@ def generate_poem_route():
         return jsonify({'error': f'Failed to generate poem: {str(e)}'}), 500
 
 
+@app.route('/generate-poem/stream', methods=['POST'])
+def generate_poem_stream_route():
+    """
+    Generate a poem and stream it to the client as server-sent events.
+
+    Takes the same JSON body as /generate-poem. Sends 'token' events with
+    raw text as the model produces it, then a 'done' event with the cleaned
+    poem (which replaces the streamed text) once it has been saved.
+    """
+    data = request.get_json(silent=True) or {}
+    analysis_id = data.get('analysisId')
+
+    if not analysis_id or f'temp_creation_id_{analysis_id}' not in session:
+        return jsonify({'error': 'Invalid or expired analysis ID'}), 400
+
+    temp_creation = Creation.query.get(session[f'temp_creation_id_{analysis_id}'])
+    if not temp_creation:
+        return jsonify({'error': 'Analysis data not found'}), 400
+
+    poem_options = poem_options_from_request(data)
+    creation_id = temp_creation.id
+    analysis_results = temp_creation.analysis_results
+    # Don't hold a pooled connection while the model is generating
+    db.session.close()
+
+    def events():
+        try:
+            for kind, text in stream_poem(analysis_results, **poem_options):
+                if kind == 'token':
+                    yield f"event: token\ndata: {json.dumps({'text': text})}\n\n"
+                    continue
+                creation = db.session.get(Creation, creation_id)
+                if creation:
+                    store_creation_poem(creation, text, poem_options)
+                yield f"event: done\ndata: {json.dumps({'success': True, 'poem': text})}\n\n"
+        except Exception as e:
+            logger.error(f"Error streaming poem: {str(e)}", exc_info=True)
+            db.session.rollback()
+            yield f"event: error\ndata: {json.dumps({'error': 'Failed to generate poem'})}\n\n"
+
+    return Response(stream_with_context(events()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/analyze-and-generate', methods=['POST'])
+def analyze_and_generate_route():
+    """Analyze the uploaded image and generate its poem in a single round trip."""
+    try:
+        image_bytes, file_size, upload_error = read_image_upload()
+        if upload_error:
+            return upload_error
+
+        # Poem preferences come in the JSON body, or as a JSON 'options' form field
+        if request.content_type and 'multipart/form-data' in request.content_type:
+            data = json.loads(request.form.get('options') or '{}')
+        else:
+            data = g.get('upload_json') or {}
+        poem_options = poem_options_from_request(data)
+
+        analysis_id = str(uuid.uuid4()).split('-')[0]
+        logger.info(f"Running analysis pipeline for {len(image_bytes)/1024:.1f} KB image")
+
+        def store_image():
+            # Runs while the Vision request is in flight
+            return get_blob_store().put(image_bytes), get_image_phash(image_bytes)
+
+        if pipeline_available():
+            analysis_results, poem, (image_key, image_phash) = run_pipeline(
+                image_bytes, poem_options, prepare=store_image, postprocess=deduplicate_elements)
+        else:
+            # Without an async HTTP client, run the same steps synchronously
+            analysis_results = analyze_image(io.BytesIO(image_bytes))
+            poem = None
+            if analysis_results and '_error' not in analysis_results:
+                analysis_results = deduplicate_elements(analysis_results)
+                poem = generate_poem(analysis_results, **poem_options)
+            image_key, image_phash = store_image()
+
+        if poem is None:
+            error_msg = (analysis_results or {}).get('_error', 'Unknown error during image analysis')
+            logger.error(f"Image analysis failed: {error_msg}")
+            return jsonify({'error': f'Error analyzing image: {error_msg}'}), 500
+
+        temp_creation = Creation()
+        temp_creation.image_key = image_key
+        temp_creation.image_phash = image_phash
+        temp_creation.analysis_results = analysis_results
+        temp_creation.share_code = f"temp{analysis_id}"
+        temp_creation.user_id = session.get('user_id')
+        temp_creation.poem_text = poem
+        temp_creation.poem_type = poem_options['poem_type']
+        temp_creation.emphasis = poem_options['emphasis']
+        temp_creation.poem_length = poem_options['poem_length']
+        temp_creation.time_saved_minutes = estimate_time_saved(poem_options['poem_length'])
+        db.session.add(temp_creation)
+        db.session.commit()
+
+        # Same session contract as /analyze-image, so /generate-poem and
+        # /create-final-image keep working with this analysis ID
+        session[f'temp_creation_id_{analysis_id}'] = temp_creation.id
+
+        return jsonify({
+            'success': True,
+            'analysisId': analysis_id,
+            'results': analysis_results,
+            'poem': poem
+        })
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error in analysis pipeline: {str(e)}", exc_info=True)
+        return jsonify({'error': 'Error analyzing image. Please try again.'}), 500
+
+
 @app.route('/create-final-image', methods=['POST'])
 def create_final_image_route():
     """Create the final framed image with the poem."""
@@ -542,36 +1241,39 @@ def create_final_image_route():
         temp_creation_id = session[f'temp_creation_id_{analysis_id}']
         temp_creation = Creation.query.get(temp_creation_id)
 
-        if not temp_creation or not temp_creation.image_data or not temp_creation.poem_text:
+        if not temp_creation or not (temp_creation.image_key or temp_creation.image_data) or not temp_creation.poem_text:
             return jsonify({'error': 'Image or poem data not found'}), 400
 
         # Get the frame selection from the request
         frame_style = data.get('frameStyle', 'classic')
-
-        # Create the framed image with the poem
-        final_image = create_framed_image(
-            base64.b64decode(temp_creation.image_data),
-            temp_creation.poem_text)
-
-        # Convert the final image to base64 for sending to the client
-        final_image_base64 = base64.b64encode(final_image).decode('utf-8')
-
-        # Generate a unique share code
-        share_code = ''.join(
-            random.choices(string.ascii_uppercase + string.digits, k=10))
-
-        # Create the final creation by updating the temporary one
-        temp_creation.frame_style = frame_style
-        temp_creation.final_image_data = final_image_base64
-        temp_creation.share_code = share_code
-        db.session.commit()
-
-        return jsonify({
+        # Premium frames are now rendered into the image, so enforce the plan here too
+        if not check_frame_access(session.get('user_id'), frame_style):
+            logger.info(f"Frame style {frame_style} requires premium; using classic")
+            frame_style = 'classic'
+
+        # Optionally hand the rendering to a background worker and return a job ID
+        if wants_background_job(data):
+            job, _ = enqueue('create_final_image',
+                             {'creation_id': temp_creation.id, 'frame_style': frame_style},
+                             **job_idempotency(data, 'create_final_image', temp_creation.id,
+                                               frame_style, temp_creation.poem_text),
+                             user_id=session.get('user_id'),
+                             creation_id=temp_creation.id)
+            return job_accepted_response(job)
+
+        final_image = render_creation_final_image(temp_creation, frame_style)
+
+        # The image is served from the blob store; the mobile app still expects
+        # it inline, so only clients that pass ?include=urls skip the base64
+        result = {
             'success': True,
-            'finalImage': final_image_base64,
-            'shareCode': share_code,
+            'finalImageUrl': url_for('serve_blob', key=temp_creation.final_image_key),
+            'shareCode': temp_creation.share_code,
             'creationId': temp_creation.id
-        })
+        }
+        if request.args.get('include') != 'urls':
+            result['finalImage'] = base64.b64encode(final_image).decode('utf-8')
+        return jsonify(result)
 
     except Exception as e:
         logger.error(f"Error creating final image: {str(e)}", exc_info=True)
@@ -579,12 +1281,34 @@ def create_final_image_route():
                         f'Failed to create final image: {str(e)}'}), 500
 
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Poll the status and result of a background job."""
+    job = db.session.get(Job, job_id)
+    if not job or (job.user_id and job.user_id != session.get('user_id')):
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(serialize_job(job))
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Stream a background job's status changes and result as server-sent events."""
+    job = db.session.get(Job, job_id)
+    if not job or (job.user_id and job.user_id != session.get('user_id')):
+        return jsonify({'error': 'Job not found'}), 404
+    db.session.close()
+
+    return Response(stream_with_context(stream_job_events(job_id, serialize_job)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/shared/<share_code>')
-@cache_view(timeout=3600)
+@cache_view(timeout=3600, tags=lambda share_code: [f"shared:{share_code}"])
 def view_shared_creation(share_code):
     """View a shared creation by its share code."""
     try:
-        # Look up the creation in the database and join with user table
+        # Heavy payload columns stay deferred, so revalidations never load them
         creation = Creation.query.filter_by(share_code=share_code).first()
 
         if not creation:
@@ -594,6 +1318,16 @@ def view_shared_creation(share_code):
                 'error.html',
                 message="Creation not found or no longer available"), 404
 
+        # JSON clients get the base64 images unless they ask for URLs only
+        include_payload = wants_image_payload()
+
+        # The validator covers the content and everything else the representation depends on
+        variant = ('json' if wants_json() else 'html', include_payload, session.get('user_id'))
+        variant_hash = hashlib.sha256(json.dumps(variant).encode('utf-8')).hexdigest()[:12]
+        etag = f"{creation.content_hash()}-{variant_hash}"
+        if request.if_none_match.contains_weak(etag):
+            return shared_creation_headers(make_response('', 304), creation, etag)
+
         # Get the creator's username if available
         creator_username = None
         if creation.user_id:
@@ -603,33 +1337,15 @@ def view_shared_creation(share_code):
 
         if wants_json():
             # Return JSON format for API clients
-            creation_data = {
-                'id': creation.id,
-                'user_id': creation.user_id,
-                'creator_username': creator_username,
-                'image_data': creation.image_data or '',
-                'analysis_results': creation.analysis_results,
-                'poem_text': creation.poem_text,
-                'frame_style': creation.frame_style,
-                'final_image_data': creation.final_image_data,
-                'poem_type': creation.poem_type,
-                'emphasis': creation.emphasis,
-                'poem_length': creation.poem_length,
-                'time_saved_minutes': creation.time_saved_minutes or 0,
-                'created_at': creation.created_at.isoformat() if creation.created_at else None,
-                'share_code': creation.share_code,
-                'is_downloaded': creation.is_downloaded or False,
-                'download_count': creation.download_count or 0,
-                'view_count': creation.view_count or 0,
-                'last_viewed_at': creation.last_viewed_at.isoformat() if creation.last_viewed_at else None,
-                'last_downloaded_at': creation.last_downloaded_at.isoformat() if creation.last_downloaded_at else None
-            }
-            return jsonify(creation_data)
+            creation_data = creation.to_dict(include_payload=include_payload)
+            creation_data['creator_username'] = creator_username
+            response = jsonify(creation_data)
         else:
             # Render the shared creation template for web browsers
-            return render_template('shared.html',
-                                   creation=creation,
-                                   creator_username=creator_username)
+            response = make_response(render_template('shared.html',
+                                                     creation=creation,
+                                                     creator_username=creator_username))
+        return shared_creation_headers(response, creation, etag)
 
     except Exception as e:
         logger.error(f"Error viewing shared creation: {str(e)}", exc_info=True)
@@ -640,47 +1356,75 @@ def view_shared_creation(share_code):
             message="An error occurred while loading this creation"), 500
 
 
+def shared_creation_headers(response, creation, etag):
+    """Set the validators and caching policy of a shared creation response."""
+    response.set_etag(etag, weak=True)
+    response.last_modified = creation.last_modified
+    if session.get('user_id'):
+        # Logged-in pages show the visitor's own navigation
+        response.headers['Cache-Control'] = 'private, no-cache'
+    else:
+        # Anonymous views are the same for everyone, so a CDN or proxy can serve them
+        response.headers['Cache-Control'] = (f"public, max-age={SHARED_VIEW_MAX_AGE}, "
+                                             f"s-maxage={SHARED_VIEW_SHARED_MAX_AGE}")
+    response.vary.add('Accept')
+    return response
+
+
+# Share codes never change once assigned, so their creation ids can be cached
+_share_code_ids = LRUCache(max_entries=SHARE_CODE_CACHE_SIZE)
+
+
+def creation_id_for_share_code(share_code):
+    """Return the id of the creation with a share code, or None."""
+    creation_id = _share_code_ids.get(share_code)
+    if creation_id is None:
+        creation_id = db.session.query(Creation.id).filter_by(share_code=share_code).scalar()
+        if creation_id is not None:
+            _share_code_ids.set(share_code, creation_id)
+    return creation_id
+
+
+@app.route('/shared/<share_code>/view', methods=['POST'])
+def record_shared_view(share_code):
+    """Count a view of a shared creation (sent as a beacon by the shared page once it loads)."""
+    creation_id = creation_id_for_share_code(share_code)
+    if creation_id is None:
+        return jsonify({'error': 'Not found'}), 404
+    record_view(creation_id)
+    return '', 204
+
+
+@app.route('/shared/<share_code>/download', methods=['POST'])
+def record_shared_download(share_code):
+    """Count a download of a creation (sent as a beacon by the download button)."""
+    creation_id = creation_id_for_share_code(share_code)
+    if creation_id is None:
+        return jsonify({'error': 'Not found'}), 404
+    record_download(creation_id)
+    return '', 204
+
+
 @app.route('/gallery')
-@cache_view(timeout=300)  # Cache gallery for 5 minutes
+@cache_view(timeout=300, tags=lambda: ['gallery'])  # Cache gallery for 5 minutes
 def gallery():
     """View a gallery of recent creations."""
     try:
-        # Get the most recent 20 creations
-        creations = Creation.query.order_by(
-            Creation.created_at.desc()).limit(20).all()
+        # Heavy payload columns are deferred unless a JSON client needs the base64 images
+        include_payload = wants_image_payload()
+
+        # Get the most recent 20 creations, loading creators in the same query
+        query = Creation.query.options(joinedload(Creation.user))
+        if include_payload:
+            query = query.options(undefer_group('payload'))
+        creations = query.order_by(Creation.created_at.desc()).limit(20).all()
 
         if wants_json():
             # Convert creations to JSON format
             creations_data = []
             for creation in creations:
-                # Get creator username if available
-                creator_username = None
-                if creation.user_id:
-                    creator = User.query.get(creation.user_id)
-                    if creator:
-                        creator_username = creator.username
-
-                creation_data = {
-                    'id': creation.id,
-                    'user_id': creation.user_id,
-                    'creator_username': creator_username,
-                    'image_data': creation.image_data or '',
-                    'analysis_results': creation.analysis_results,
-                    'poem_text': creation.poem_text,
-                    'frame_style': creation.frame_style,
-                    'final_image_data': creation.final_image_data,
-                    'poem_type': creation.poem_type,
-                    'emphasis': creation.emphasis,
-                    'poem_length': creation.poem_length,
-                    'time_saved_minutes': creation.time_saved_minutes or 0,
-                    'created_at': creation.created_at.isoformat() if creation.created_at else None,
-                    'share_code': creation.share_code,
-                    'is_downloaded': creation.is_downloaded or False,
-                    'download_count': creation.download_count or 0,
-                    'view_count': creation.view_count or 0,
-                    'last_viewed_at': creation.last_viewed_at.isoformat() if creation.last_viewed_at else None,
-                    'last_downloaded_at': creation.last_downloaded_at.isoformat() if creation.last_downloaded_at else None
-                }
+                creation_data = creation.to_dict(include_payload=include_payload)
+                creation_data['creator_username'] = creation.user.username if creation.user else None
                 creations_data.append(creation_data)
 
             return jsonify({
@@ -700,6 +1444,43 @@ def gallery():
             message="An error occurred while loading the gallery"), 500
 
 
+@app.route('/blobs/<key>')
+def serve_blob(key):
+    """Serve image bytes from the content-addressed blob store."""
+    if not is_valid_blob_key(key):
+        return jsonify({'error': 'Not found'}), 404
+
+    try:
+        data = get_blob_store().get(key)
+    except BlobNotFound:
+        return jsonify({'error': 'Not found'}), 404
+
+    # Blob content never changes for a given key, so it can be cached forever
+    response = make_response(data)
+    response.headers['Content-Type'] = guess_image_mimetype(data)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.set_etag(key)
+    return response.make_conditional(request)
+
+
+@app.route('/creations/<int:creation_id>/image/<size>')
+def creation_image(creation_id, size):
+    """
+    Redirect a derivative URL issued before derivatives were linked as blobs.
+
+    Only URLs whose version parameter matches the creation's current derivative
+    resolve, so the route can't be used to enumerate creations by id.
+    """
+    creation = Creation.query.options(
+        load_only(Creation.id, Creation.derivative_keys)
+    ).filter_by(id=creation_id).first()
+    derivative = (creation.derivative_keys or {}).get(size) if creation else None
+    if not derivative or request.args.get('v') != derivative['key'][:12]:
+        return jsonify({'error': 'Not found'}), 404
+
+    return redirect(url_for('serve_blob', key=derivative['key']), 301)
+
+
 # Authentication and Membership Routes
 
 
@@ -1291,8 +2072,9 @@ def profile():
             return jsonify({'error': 'User not found'}), 404
         return redirect(url_for('login'))
 
-    # Get user's creations
-    user_creations = get_user_creations(user_id, limit=20)
+    # Get user's creations (heavy payload columns only for JSON clients that need them)
+    include_payload = wants_image_payload()
+    user_creations = get_user_creations(user_id, limit=20, include_payload=include_payload)
 
     # Get user's membership plan
     plan = get_user_plan(user_id)
@@ -1302,29 +2084,10 @@ def profile():
 
     if wants_json():
         # Convert creations to JSON format
-        creations_data = []
-        for creation in user_creations:
-            creation_data = {
-                'id': creation.id,
-                'user_id': creation.user_id,
-                'image_data': creation.image_data or '',
-                'analysis_results': creation.analysis_results,
-                'poem_text': creation.poem_text,
-                'frame_style': creation.frame_style,
-                'final_image_data': creation.final_image_data,
-                'poem_type': creation.poem_type,
-                'emphasis': creation.emphasis,
-                'poem_length': creation.poem_length,
-                'time_saved_minutes': creation.time_saved_minutes or 0,
-                'created_at': creation.created_at.isoformat() if creation.created_at else None,
-                'share_code': creation.share_code,
-                'is_downloaded': creation.is_downloaded or False,
-                'download_count': creation.download_count or 0,
-                'view_count': creation.view_count or 0,
-                'last_viewed_at': creation.last_viewed_at.isoformat() if creation.last_viewed_at else None,
-                'last_downloaded_at': creation.last_downloaded_at.isoformat() if creation.last_downloaded_at else None
-            }
-            creations_data.append(creation_data)
+        creations_data = [
+            creation.to_dict(include_payload=include_payload)
+            for creation in user_creations
+        ]
 
         return jsonify({
             'user': {
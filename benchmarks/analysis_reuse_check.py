@@ -0,0 +1,80 @@
+"""
+Check that the async pipeline reuses persisted analyses of near-duplicate uploads.
+
+Stores a creation with its analysis in a scratch SQLite database and blob
+store, as another process would, then sends a re-encoded copy of its image
+through run_pipeline with an empty analysis cache and near-duplicate index,
+against the fake Vision/Gemini server from pipeline_benchmark. The match and
+the analysis have to come from the database: the check fails if the pipeline
+calls Vision.
+
+Usage:
+    python benchmarks/analysis_reuse_check.py
+"""
+import os
+import sys
+import io
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipeline_benchmark import FakeUpstreamHandler, start_fake_upstream, make_images  # noqa: E402
+
+STORED_ANALYSIS = {"labels": [{"description": "Harbor", "score": 0.95}], "objects": [], "faces": [],
+                   "landmarks": [], "colors": [], "safe_search": {}}
+
+
+def reencode(image, quality):
+    from PIL import Image
+    output = io.BytesIO()
+    Image.open(io.BytesIO(image)).save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def main():
+    server = start_fake_upstream(0)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    scratch = tempfile.mkdtemp(prefix="analysis_reuse_")
+
+    # Point the app at the fake server and scratch storage before importing it
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(scratch, 'check.db')}",
+        "BLOB_STORE_BACKEND": "local",
+        "BLOB_STORE_PATH": os.path.join(scratch, "blobs"),
+        "GOOGLE_API_KEY": "AIzaFakeCheckKey",
+        "GEMINI_API_KEY": "fake-check-key",
+        "VISION_API_URL": f"{base_url}/v1/images:annotate",
+        "GEMINI_API_URL": f"{base_url}/v1beta/models/fake:generateContent",
+        "GEMINI_API_URL_FALLBACK": f"{base_url}/v1/models/fake:generateContent",
+        "CACHE_BACKEND_URL": "",
+    })
+    import logging
+    logging.disable(logging.WARNING)
+    from app import app
+    from models import db, Creation
+    from utils.blob_store import get_blob_store
+    from utils.image_analyzer import get_image_phash
+    from utils.async_pipeline import run_pipeline
+
+    original = make_images(1)[0]
+    with app.app_context():
+        image_key = get_blob_store().put(original)
+        image_phash = get_image_phash(original)
+        db.session.add(Creation(image_key=image_key, image_phash=image_phash, analysis_results=STORED_ANALYSIS,
+                                poem_text="stored", created_at=datetime.utcnow()))
+        db.session.commit()
+
+    poem_options = {"poem_type": "love", "poem_length": "short", "emphasis": [],
+                    "custom_terms": "", "custom_category": "", "is_regeneration": True}
+    analysis, poem, _ = run_pipeline(reencode(original, 70), poem_options)
+    server.shutdown()
+
+    reused = FakeUpstreamHandler.vision_requests == 0 and analysis.get("labels") == STORED_ANALYSIS["labels"]
+    print(f"near-duplicate upload: {FakeUpstreamHandler.vision_requests} Vision requests, "
+          f"analysis {'reused' if reused else 'NOT reused'}")
+    sys.exit(0 if reused and poem else 1)
+
+
+if __name__ == "__main__":
+    main()
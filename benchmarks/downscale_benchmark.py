@@ -0,0 +1,125 @@
+"""
+Benchmark reduced-scale decoding of large uploads for the renderer.
+
+Creates a synthetic phone-sized JPEG (4032x3024 by default) and compares:
+
+  * full:  full decode, then a single LANCZOS resize to the render width
+           (the previous renderer)
+  * draft: decode_for_size() (JPEG DCT-scaled decode) followed by a
+           resize with reducing_gap (integer reduce, then a small LANCZOS)
+
+For each it reports the median time and the peak RSS of a fresh process, and
+it reports the difference between the two outputs (PSNR and mean absolute
+error per channel), which should stay within --tolerance dB of identical.
+
+Usage:
+    python benchmarks/downscale_benchmark.py --size 4032x3024 --repeat 5
+"""
+import os
+import sys
+import io
+import json
+import math
+import time
+import argparse
+import resource
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RENDER_WIDTH = 960
+
+
+def make_photo(width, height, path):
+    """Write a detailed synthetic photo (gradients, edges and noise) as a JPEG."""
+    from PIL import Image, ImageDraw, ImageFilter
+    base = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    img = Image.merge("RGB", (base, noise, base.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    draw = ImageDraw.Draw(img)
+    for i in range(0, width, max(width // 60, 1)):
+        draw.line([(i, 0), (width - i, height)], fill=(255 - i % 256, i % 256, 128), width=3)
+    img = img.filter(ImageFilter.SMOOTH)
+    img.save(path, format="JPEG", quality=92)
+
+
+def resize(path, mode):
+    from PIL import Image, ImageOps
+    from utils.renderer import decode_for_size, oriented_size, RESAMPLE_REDUCING_GAP
+    with open(path, "rb") as f:
+        data = f.read()
+    img = Image.open(io.BytesIO(data))
+    width, height = oriented_size(img)
+    size = (RENDER_WIDTH, int(height * RENDER_WIDTH / width))
+    if mode == "full":
+        img = ImageOps.exif_transpose(img)
+        return img.resize(size, Image.LANCZOS)
+    img = decode_for_size(img, *size)
+    return img.resize(size, Image.LANCZOS, reducing_gap=RESAMPLE_REDUCING_GAP)
+
+
+def child(path, mode, repeat):
+    """Run one mode in this (fresh) process and print its timings and peak RSS."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        resize(path, mode)
+        samples.append(time.perf_counter() - start)
+    print(json.dumps({"ms": statistics.median(samples) * 1000, "peak_mb": peak_rss_kb() / 1024}))
+
+
+def peak_rss_kb():
+    # ru_maxrss survives exec on Linux, so it would include the parent's peak; VmHWM doesn't
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def compare(a, b):
+    from PIL import ImageChops, ImageStat
+    diff = ImageChops.difference(a.convert("RGB"), b.convert("RGB"))
+    stat = ImageStat.Stat(diff)
+    mse = sum(stat.sum2) / (len(stat.sum2) * a.width * a.height)
+    psnr = float("inf") if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+    return psnr, [round(value, 2) for value in stat.mean]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", default="4032x3024")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=35.0, help="Minimum acceptable PSNR in dB")
+    parser.add_argument("--child", nargs=2, metavar=("PATH", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.child[1], args.repeat)
+        return
+
+    width, height = (int(value) for value in args.size.split("x"))
+    path = os.path.join(os.environ.get("TMPDIR", "/tmp"), f"downscale_benchmark_{width}x{height}.jpg")
+    make_photo(width, height, path)
+    print(f"{width}x{height} JPEG ({os.path.getsize(path) / 1e6:.1f} MB) -> {RENDER_WIDTH}px, "
+          f"median of {args.repeat} runs")
+
+    for mode in ("full", "draft"):
+        output = subprocess.run([sys.executable, __file__, "--repeat", str(args.repeat), "--child", path, mode],
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{mode:>6}: {result['ms']:7.1f} ms  peak RSS {result['peak_mb']:6.1f} MB")
+
+    psnr, mean_error = compare(resize(path, "full"), resize(path, "draft"))
+    verdict = "within" if psnr >= args.tolerance else "OUTSIDE"
+    print(f"quality: PSNR {psnr:.1f} dB, mean abs error per channel {mean_error} "
+          f"({verdict} the {args.tolerance:.0f} dB tolerance)")
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
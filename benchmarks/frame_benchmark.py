@@ -0,0 +1,86 @@
+"""
+Benchmark frame compositing per frame style.
+
+For every style it reports the time to frame a rendered image:
+
+  * first: the first frame at this width (asset scaling and slicing)
+  * warm:  later frames at the same width and varying heights, which
+           only stretch the cached side strips
+  * full:  a complete render_poem_image() call with that frame
+
+Usage:
+    python benchmarks/frame_benchmark.py --width 1000 --repeat 10 [--save-dir /tmp/frames]
+"""
+import os
+import sys
+import io
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+POEM = "\n".join([
+    "Light folds over the harbor wall,",
+    "gulls stitch the morning to the sea,",
+    "and every boat that leaves the shore",
+    "carries a little of the day with it.",
+])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=1000, help="Width of the rendered image")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--save-dir", help="Write one framed sample per style here")
+    args = parser.parse_args()
+
+    import logging
+    logging.disable(logging.WARNING)
+    from PIL import Image
+    from utils import frames
+    from utils.renderer import render_poem_image
+
+    start = time.perf_counter()
+    loaded = frames.preload_frames()
+    print(f"Decoded {loaded} frame assets in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    photo = io.BytesIO()
+    Image.new("RGB", (args.width, args.width * 3 // 4), (90, 140, 200)).save(photo, format="JPEG")
+    photo = photo.getvalue()
+
+    heights = [int(args.width * ratio) for ratio in (1.0, 1.3, 1.6, 2.0)]
+    styles = sorted(frames.FRAME_ASSETS) + ['modern', 'polaroid', 'shadow', 'none']
+
+    print(f"{'style':>14}  {'first':>8}  {'warm':>8}  {'full':>8}")
+    for style in styles:
+        frames._slices.clear()
+        image = Image.new("RGB", (args.width, heights[0]), (255, 255, 255))
+        start = time.perf_counter()
+        frames.apply_frame(image, style)
+        first_ms = (time.perf_counter() - start) * 1000
+
+        samples = []
+        for i in range(args.repeat):
+            image = Image.new("RGB", (args.width, heights[i % len(heights)]), (255, 255, 255))
+            start = time.perf_counter()
+            frames.apply_frame(image, style)
+            samples.append((time.perf_counter() - start) * 1000)
+
+        full = []
+        for _ in range(max(args.repeat // 3, 1)):
+            start = time.perf_counter()
+            output = render_poem_image(photo, POEM, style)
+            full.append((time.perf_counter() - start) * 1000)
+
+        if args.save_dir:
+            os.makedirs(args.save_dir, exist_ok=True)
+            with open(os.path.join(args.save_dir, f"{style}.jpg"), "wb") as f:
+                f.write(output)
+
+        print(f"{style:>14}  {first_ms:>6.2f}ms  {statistics.median(samples):>6.2f}ms  "
+              f"{statistics.median(full):>6.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
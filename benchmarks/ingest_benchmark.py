@@ -0,0 +1,77 @@
+"""
+Benchmark upload normalization and what it saves downstream.
+
+Creates a synthetic phone photo (4032x3024 JPEG with an EXIF orientation by
+default) and reports:
+
+  * ingest:  the one-off cost of normalize_upload()
+  * payload: the stored size and the base64 Vision request body, raw vs normalized
+  * render:  render_poem_image() from the raw upload vs the normalized one
+
+Usage:
+    python benchmarks/ingest_benchmark.py --size 4032x3024 --repeat 5
+"""
+import os
+import sys
+import io
+import time
+import base64
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+POEM = "Light folds over the harbor wall,\ngulls stitch the morning to the sea."
+
+
+def make_upload(width, height):
+    from PIL import Image, ImageDraw, ImageFilter
+    base = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    img = Image.merge("RGB", (base, noise, base.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    draw = ImageDraw.Draw(img)
+    for i in range(0, width, max(width // 60, 1)):
+        draw.line([(i, 0), (width - i, height)], fill=(255 - i % 256, i % 256, 128), width=3)
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: rotate 90 CW, as phones in portrait write it
+    output = io.BytesIO()
+    img.filter(ImageFilter.SMOOTH).save(output, format="JPEG", quality=92, exif=exif.tobytes())
+    return output.getvalue()
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", default="4032x3024")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    import logging
+    logging.disable(logging.WARNING)
+    from utils.ingest import normalize_upload, UPLOAD_MAX_EDGE, UPLOAD_FORMAT
+    from utils.renderer import render_poem_image
+
+    width, height = (int(value) for value in args.size.split("x"))
+    raw = make_upload(width, height)
+    normalized = normalize_upload(raw)
+    print(f"{width}x{height} upload -> {UPLOAD_FORMAT} capped at {UPLOAD_MAX_EDGE}px, median of {args.repeat} runs")
+
+    print(f"ingest:  {timed(lambda: normalize_upload(raw), args.repeat):7.1f} ms (once per upload)")
+    print(f"payload: stored {len(raw) / 1e6:5.2f} MB -> {len(normalized) / 1e6:5.2f} MB, "
+          f"Vision body {len(base64.b64encode(raw)) / 1e6:5.2f} MB -> "
+          f"{len(base64.b64encode(normalized)) / 1e6:5.2f} MB")
+    raw_ms = timed(lambda: render_poem_image(raw, POEM), args.repeat)
+    normalized_ms = timed(lambda: render_poem_image(normalized, POEM), args.repeat)
+    print(f"render:  {raw_ms:7.1f} ms -> {normalized_ms:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
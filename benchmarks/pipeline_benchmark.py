@@ -0,0 +1,180 @@
+"""
+Benchmark the two-step (synchronous) flow against the async pipeline.
+
+Starts a local fake Vision/Gemini server that answers every request after a
+fixed delay, points the analyzer and poem generator at it, and then runs the
+same number of analyze + generate requests through:
+
+  * sync:  analyze_image() then generate_poem() on a pool of worker threads,
+           the way two blocking Flask requests are served today
+  * async: run_pipeline() called from the same pool of worker threads
+  * loop:  every request submitted to the pipeline event loop at once,
+           showing its capacity when not bounded by request threads
+
+Usage:
+    python benchmarks/pipeline_benchmark.py --requests 200 --workers 8 --delay 0.5
+"""
+import os
+import sys
+import io
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+VISION_RESPONSE = {
+    "responses": [{
+        "labelAnnotations": [{"description": "Beach", "score": 0.97}, {"description": "Sky", "score": 0.93}],
+        "localizedObjectAnnotations": [{"name": "Person", "score": 0.88}],
+        "imagePropertiesAnnotation": {"dominantColors": {"colors": [
+            {"color": {"red": 30, "green": 120, "blue": 200}, "score": 0.6}]}},
+        "safeSearchAnnotation": {"adult": "VERY_UNLIKELY", "medical": "UNLIKELY", "violence": "VERY_UNLIKELY"}
+    }]
+}
+
+GEMINI_RESPONSE = {
+    "candidates": [{"content": {"parts": [{"text": "Waves fold light\nunder a wide sky,\nsalt on the wind\nand you nearby."}]}}]
+}
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    """Answers Vision annotate and Gemini generateContent requests after a delay."""
+
+    protocol_version = "HTTP/1.1"
+    delay = 0.5
+    vision_requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.delay)
+        if "annotate" in self.path:
+            FakeUpstreamHandler.vision_requests += 1
+        payload = VISION_RESPONSE if "annotate" in self.path else GEMINI_RESPONSE
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_upstream(delay):
+    """Start the fake server on a free port and return it."""
+    FakeUpstreamHandler.delay = delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeUpstreamHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_images(count):
+    """Create distinct small JPEGs so the analysis cache never hits."""
+    from PIL import Image
+    images = []
+    for i in range(count):
+        img = Image.new("RGB", (640, 480), (i % 256, (i * 7) % 256, (i * 13) % 256))
+        img.putpixel((i % 640, (i // 640) % 480), (255 - i % 256, 0, 0))
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=85)
+        images.append(buf.getvalue())
+    random.shuffle(images)
+    return images
+
+
+def run(label, func, images, workers):
+    latencies = []
+
+    def timed(image):
+        start = time.perf_counter()
+        func(image)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(timed, images))
+    report(label, latencies, time.perf_counter() - start)
+
+
+def report(label, latencies, elapsed):
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{label:>6}: {len(latencies) / elapsed:7.2f} req/s  "
+          f"p50={statistics.median(latencies) * 1000:7.1f} ms  p95={p95 * 1000:7.1f} ms  "
+          f"total={elapsed:6.2f} s")
+
+
+def run_on_loop(label, images, poem_options):
+    from utils.async_pipeline import analyze_and_generate, _get_loop
+
+    async def timed(image):
+        start = time.perf_counter()
+        await analyze_and_generate(image, poem_options)
+        return time.perf_counter() - start
+
+    async def run_all():
+        return await asyncio.gather(*(timed(image) for image in images))
+
+    start = time.perf_counter()
+    latencies = asyncio.run_coroutine_threadsafe(run_all(), _get_loop()).result()
+    report(label, list(latencies), time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent request threads")
+    parser.add_argument("--delay", type=float, default=0.5, help="Fake upstream latency in seconds")
+    args = parser.parse_args()
+
+    server = start_fake_upstream(args.delay)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    # Point the app modules at the fake server before importing them
+    os.environ.update({
+        "GOOGLE_API_KEY": "AIzaFakeBenchmarkKey",
+        "GEMINI_API_KEY": "fake-benchmark-key",
+        "VISION_API_URL": f"{base_url}/v1/images:annotate",
+        "GEMINI_API_URL": f"{base_url}/v1beta/models/fake:generateContent",
+        "GEMINI_API_URL_FALLBACK": f"{base_url}/v1/models/fake:generateContent",
+        "PHASH_MATCH_THRESHOLD": "-1",
+        "CACHE_BACKEND_URL": "",
+    })
+    import logging
+    logging.disable(logging.WARNING)
+    from utils.image_analyzer import analyze_image
+    from utils.poem_generator import generate_poem
+    from utils.async_pipeline import run_pipeline
+
+    poem_options = {"poem_type": "love", "poem_length": "short", "emphasis": [],
+                    "custom_terms": "", "custom_category": "", "is_regeneration": True}
+
+    def sync_flow(image):
+        results = analyze_image(io.BytesIO(image))
+        generate_poem(results, **poem_options)
+
+    def async_flow(image):
+        run_pipeline(image, poem_options)
+
+    print(f"{args.requests} requests, {args.workers} workers, {args.delay * 1000:.0f} ms upstream latency")
+    # Each flow gets its own images so neither benefits from the other's cache entries
+    n = args.requests
+    images = make_images(n * 3)
+    run("sync", sync_flow, images[:n], args.workers)
+    run("async", async_flow, images[n:2 * n], args.workers)
+    run_on_loop("loop", images[2 * n:], poem_options)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
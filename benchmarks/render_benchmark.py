@@ -0,0 +1,102 @@
+"""
+Benchmark the final image renderer against poem length.
+
+For each poem length it reports:
+
+  * wrap:   wrapping the poem by measuring growing prefixes with
+            font.getlength() (the previous approach) against wrap_line()
+            with cached glyph advances
+  * cold:   a full render with empty font caches
+  * warm:   a full render with the font and glyph caches filled
+
+Usage:
+    python benchmarks/render_benchmark.py --width 3000 --repeat 5
+"""
+import os
+import sys
+import io
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ("light river stone morning quiet golden whisper across the meadow and over "
+         "hills where shadows gather softly beneath an open evening sky").split()
+
+
+def make_photo(width):
+    from PIL import Image
+    img = Image.new("RGB", (width, width * 3 // 4), (90, 140, 200))
+    for i in range(0, width, 40):
+        img.paste((200, 120 + i % 100, 60), (i, 0, i + 20, img.height))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def make_poem(lines, rng):
+    return "\n".join(" ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 12))) for _ in range(lines))
+
+
+def prefix_wrap(line, font, max_width):
+    """Wrap by measuring the whole candidate line each time a word is added."""
+    lines, current = [], []
+    for word in line.split():
+        if font.getlength(' '.join(current + [word])) <= max_width:
+            current.append(word)
+        else:
+            if current:
+                lines.append(' '.join(current))
+            current = [word]
+    if current:
+        lines.append(' '.join(current))
+    return lines
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=3000, help="Width of the test photo")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--lengths", default="4,8,16,32,64", help="Poem lengths in lines")
+    args = parser.parse_args()
+
+    import logging
+    logging.disable(logging.WARNING)
+    from utils import renderer
+
+    rng = random.Random(42)
+    photo = make_photo(args.width)
+    metrics = renderer.get_font(32)
+    max_width = renderer.MAX_RENDER_WIDTH * 0.84
+
+    print(f"{args.width}px photo, median of {args.repeat} runs, font: {renderer._find_font_path() or 'default'}")
+    print(f"{'lines':>5}  {'prefix wrap':>11}  {'cached wrap':>11}  {'cold render':>11}  {'warm render':>11}")
+    for length in [int(value) for value in args.lengths.split(",")]:
+        poem = make_poem(length, rng)
+        raw_lines = poem.split("\n")
+
+        prefix_ms = timed(lambda: [prefix_wrap(line, metrics.font, max_width) for line in raw_lines], args.repeat)
+        cached_ms = timed(lambda: [renderer.wrap_line(line, metrics, max_width) for line in raw_lines], args.repeat)
+
+        def cold():
+            renderer._fonts.clear()
+            renderer.render_poem_image(photo, poem)
+
+        cold_ms = timed(cold, args.repeat)
+        warm_ms = timed(lambda: renderer.render_poem_image(photo, poem), args.repeat)
+        print(f"{length:>5}  {prefix_ms:>9.2f}ms  {cached_ms:>9.2f}ms  {cold_ms:>9.1f}ms  {warm_ms:>9.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Benchmark peak memory of the upload path, from request body to Vision request.
+
+Builds a phone-sized JPEG just under the 5MB upload limit and runs each mode
+in a fresh process. It reports the time and the peak RSS added on top of the
+process baseline, which approximates the peak RSS of one request:
+
+  * json-before:      the previous JSON path (cached body, split() of the data
+                      URL, b64decode, BytesIO + read(), json.dumps of the
+                      Vision request plus a second dump for the debug log)
+  * json-after:       uncached body, prefix skipped with a memoryview,
+                      a2b_base64, Vision body spliced from bytes
+  * multipart-before: file part read() into memory before normalizing
+  * multipart-after:  file part decoded from its spooled temporary file
+
+Usage:
+    python benchmarks/upload_memory_benchmark.py --size 3600x2700 --repeat 3
+"""
+import os
+import sys
+import io
+import json
+import time
+import base64
+import binascii
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MODES = ("json-before", "json-after", "multipart-before", "multipart-after")
+SPOOL_THRESHOLD = 512 * 1024
+
+
+def make_upload(width, height, path):
+    from PIL import Image, ImageDraw, ImageFilter
+    base = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    img = Image.merge("RGB", (base, noise, base.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    draw = ImageDraw.Draw(img)
+    for i in range(0, width, max(width // 60, 1)):
+        draw.line([(i, 0), (width - i, height)], fill=(255 - i % 256, i % 256, 128), width=3)
+    img.filter(ImageFilter.SMOOTH).save(path, format="JPEG", quality=88)
+
+
+def status_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def json_before(body):
+    from utils.ingest import normalize_upload
+    from utils.image_analyzer import VISION_FEATURES
+    json_data = json.loads(body)
+    base64_image = json_data['image']
+    if ',' in base64_image:
+        base64_image = base64_image.split(',')[1]
+    image_file = io.BytesIO(base64.b64decode(base64_image))
+    normalized = normalize_upload(image_file.read())
+    request_data = {"requests": [{"image": {"content": base64.b64encode(normalized).decode('utf-8')},
+                                  "features": VISION_FEATURES}]}
+    len(json.dumps(request_data))
+    return json.dumps(request_data).encode('utf-8')
+
+
+def json_after(body):
+    from utils.ingest import normalize_upload
+    from utils.image_analyzer import build_vision_request
+    json_data = json.loads(body)
+    del body
+    encoded = json_data.pop('image').encode('ascii')
+    start = encoded.find(b',', 0, 256) + 1
+    image_bytes = binascii.a2b_base64(memoryview(encoded)[start:])
+    del encoded
+    return build_vision_request(normalize_upload(image_bytes))
+
+
+def multipart(path, spooled):
+    from utils.ingest import normalize_upload
+    from utils.image_analyzer import build_vision_request
+    stream = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD, mode='rb+')
+    with open(path, "rb") as f:
+        while chunk := f.read(64 * 1024):
+            stream.write(chunk)
+    stream.seek(0)
+    normalized = normalize_upload(stream if spooled else stream.read())
+    return build_vision_request(normalized)
+
+
+def child(path, mode, repeat):
+    """Run one mode in this (fresh) process and print its timing and peak RSS growth."""
+    import logging
+    import importlib
+    logging.disable(logging.WARNING)
+    # Load the modules before the baseline is taken, so their import isn't counted as request memory
+    for module in ("utils.ingest", "utils.image_analyzer"):
+        importlib.import_module(module)
+
+    with open(path, "rb") as f:
+        upload = f.read()
+    baseline = status_kb("VmRSS")
+
+    samples = []
+    for _ in range(repeat):
+        body = None
+        if mode.startswith("json"):
+            # The body a client posts; the server holds it once it has read the request
+            body = json.dumps({"image": "data:image/jpeg;base64," + base64.b64encode(upload).decode('ascii'),
+                               "poemType": "free verse"}).encode()
+        start = time.perf_counter()
+        if mode == "json-before":
+            json_before(body)
+        elif mode == "json-after":
+            # Hand over the only reference, as get_json(cache=False) does
+            bodies = [body]
+            body = None
+            json_after(bodies.pop())
+        else:
+            multipart(path, mode == "multipart-after")
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    print(json.dumps({"ms": samples[len(samples) // 2] * 1000,
+                      "peak_mb": (status_kb("VmHWM") - baseline) / 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", default="3600x2700")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--child", nargs=2, metavar=("PATH", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.child[1], args.repeat)
+        return
+
+    width, height = (int(value) for value in args.size.split("x"))
+    path = os.path.join(os.environ.get("TMPDIR", "/tmp"), f"upload_benchmark_{width}x{height}.jpg")
+    make_upload(width, height, path)
+    print(f"{width}x{height} JPEG upload ({os.path.getsize(path) / 1e6:.1f} MB), median of {args.repeat} runs")
+
+    for mode in MODES:
+        output = subprocess.run([sys.executable, __file__, "--repeat", str(args.repeat), "--child", path, mode],
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{mode:>16}: {result['ms']:7.1f} ms  peak RSS +{result['peak_mb']:6.1f} MB")
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
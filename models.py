@@ -4,10 +4,14 @@ import jwt
 import time
 import string
 import random
+import base64
+import json
+import hashlib
 from typing import Optional, Union
 from flask_sqlalchemy import SQLAlchemy
-from flask import current_app
+from flask import current_app, url_for
 from werkzeug.security import generate_password_hash, check_password_hash
+from utils.blob_store import get_blob_store
 
 # Initialize SQLAlchemy
 db = SQLAlchemy()
@@ -266,11 +270,19 @@ class Creation(db.Model):
     # User relationship (can be null for anonymous users)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
 
-    # Store the original image data (encoded as base64)
-    image_data = db.Column(db.Text, nullable=False)
+    # Legacy storage for the original image data (encoded as base64).
+    # New rows keep the bytes in the blob store and only set image_key.
+    # Heavy columns are deferred into the 'payload' group so list queries skip them.
+    image_data = db.deferred(db.Column(db.Text, nullable=True), group='payload')
+
+    # Content-addressed blob store key for the original image
+    image_key = db.Column(db.String(64), nullable=True, index=True)
+
+    # Perceptual hash (64-bit dHash as hex) of the original image, for near-duplicate lookup
+    image_phash = db.Column(db.String(16), nullable=True)
 
     # Store the analysis results from Google Vision API
-    analysis_results = db.Column(db.JSON, nullable=True)
+    analysis_results = db.deferred(db.Column(db.JSON, nullable=True), group='payload')
 
     # Store the generated poem
     poem_text = db.Column(db.Text, nullable=True)
@@ -278,8 +290,14 @@ class Creation(db.Model):
     # Store the frame style used
     frame_style = db.Column(db.String(50), nullable=True)
 
-    # Store the final creation image data (encoded as base64)
-    final_image_data = db.Column(db.Text, nullable=True)
+    # Legacy storage for the final creation image data (encoded as base64)
+    final_image_data = db.deferred(db.Column(db.Text, nullable=True), group='payload')
+
+    # Content-addressed blob store key for the final creation image
+    final_image_key = db.Column(db.String(64), nullable=True)
+
+    # Resized derivatives of the final image: {size: {'key', 'mimetype', 'width', 'height'}}
+    derivative_keys = db.Column(db.JSON, nullable=True)
 
     # Store poem preferences
     poem_type = db.Column(db.String(50), nullable=True)
@@ -292,6 +310,9 @@ class Creation(db.Model):
     # Store creation timestamp
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Last change to the creation's content (counter flushes leave it untouched)
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
+
     # Store a unique share code for public sharing
     share_code = db.Column(db.String(50), unique=True, nullable=True)
     
@@ -323,18 +344,162 @@ class Creation(db.Model):
             return code
         return self.share_code
         
+    def set_image(self, image_bytes):
+        """Store the original image in the blob store and record its key."""
+        self.image_key = get_blob_store().put(image_bytes)
+        self.image_data = None
+        return self.image_key
+
+    def set_final_image(self, image_bytes):
+        """Store the final framed image in the blob store and record its key."""
+        self.final_image_key = get_blob_store().put(image_bytes)
+        self.final_image_data = None
+        return self.final_image_key
+
+    def set_derivatives(self, derivatives):
+        """Store generated derivatives in the blob store and record their keys."""
+        store = get_blob_store()
+        self.derivative_keys = {
+            name: {
+                'key': store.put(derivative['data']),
+                'mimetype': derivative['mimetype'],
+                'width': derivative['width'],
+                'height': derivative['height']
+            }
+            for name, derivative in derivatives.items()
+        }
+        return self.derivative_keys
+
+    def get_image_bytes(self):
+        """Return the original image bytes, reading legacy base64 rows if needed."""
+        if self.image_key:
+            return get_blob_store().get(self.image_key)
+        if self.image_data:
+            return base64.b64decode(self.image_data)
+        return None
+
+    def get_final_image_bytes(self):
+        """Return the final image bytes, reading legacy base64 rows if needed."""
+        if self.final_image_key:
+            return get_blob_store().get(self.final_image_key)
+        if self.final_image_data:
+            return base64.b64decode(self.final_image_data)
+        return None
+
+    def get_image_base64(self):
+        """Return the original image as a base64 string for API responses."""
+        if self.image_key:
+            return base64.b64encode(self.get_image_bytes()).decode('utf-8')
+        return self.image_data or ''
+
+    def get_final_image_base64(self):
+        """Return the final image as a base64 string for API responses."""
+        if self.final_image_key:
+            return base64.b64encode(self.get_final_image_bytes()).decode('utf-8')
+        return self.final_image_data
+
+    def get_image_url(self, final=True):
+        """Return the blob URL for the final (or original) image, if it has been migrated."""
+        key = self.final_image_key if final else self.image_key
+        return url_for('serve_blob', key=key) if key else None
+
+    def get_derivative_url(self, size):
+        """Return the URL for a resized derivative, falling back to the full final image."""
+        derivative = (self.derivative_keys or {}).get(size)
+        if derivative:
+            # Derivatives are content-addressed blobs like the images themselves
+            return url_for('serve_blob', key=derivative['key'])
+        return self.get_image_url()
+
+    @property
+    def last_modified(self):
+        """When the creation's content last changed (rows older than updated_at fall back to created_at)."""
+        return self.updated_at or self.created_at
+
+    def content_hash(self):
+        """
+        Return a hash of the creation's published content, for HTTP validators.
+
+        Images are covered by their content-addressed blob keys (legacy rows
+        without keys by their modification time), so the hash is computed
+        without loading any payload column. View and download counts are not
+        part of the content.
+        """
+        parts = [
+            self.id, self.share_code, self.poem_text, self.frame_style, self.poem_type,
+            self.poem_length, self.emphasis, self.image_key, self.final_image_key,
+            sorted(derivative['key'] for derivative in (self.derivative_keys or {}).values()),
+            None if self.final_image_key else self.last_modified
+        ]
+        data = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()[:32]
+
+    def to_dict(self, include_payload=False):
+        """
+        Serialize the creation for JSON list responses.
+
+        Lightweight columns and image URLs are always included; the base64
+        images and analysis results are added when include_payload is set
+        (see wants_image_payload in app.py).
+        Counters include increments that haven't been flushed yet.
+        """
+        from utils.creation_counters import merged_counts
+        counts = merged_counts(self)
+        data = {
+            'id': self.id,
+            'user_id': self.user_id,
+            'image_url': self.get_image_url(final=False),
+            'final_image_url': self.get_image_url(),
+            'thumbnail_url': self.get_derivative_url('sm'),
+            'image_urls': {size: self.get_derivative_url(size) for size in (self.derivative_keys or {})},
+            'poem_text': self.poem_text,
+            'frame_style': self.frame_style,
+            'poem_type': self.poem_type,
+            'emphasis': self.emphasis,
+            'poem_length': self.poem_length,
+            'time_saved_minutes': self.time_saved_minutes or 0,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'share_code': self.share_code,
+            'is_downloaded': counts['is_downloaded'],
+            'download_count': counts['download_count'],
+            'view_count': counts['view_count'],
+            'last_viewed_at': counts['last_viewed_at'].isoformat() if counts['last_viewed_at'] else None,
+            'last_downloaded_at': counts['last_downloaded_at'].isoformat() if counts['last_downloaded_at'] else None
+        }
+        if include_payload:
+            data['image_data'] = self.get_image_base64()
+            data['final_image_data'] = self.get_final_image_base64()
+            data['analysis_results'] = self.analysis_results
+        return data
+
     def increment_download_count(self):
-        """Increment the download count for this creation."""
-        self.download_count += 1
-        self.is_downloaded = True
-        self.last_downloaded_at = datetime.utcnow()
-        return self.download_count
+        """Record a download of this creation (buffered; see utils.creation_counters)."""
+        from utils.creation_counters import record_download, merged_counts
+        record_download(self.id)
+        return merged_counts(self)['download_count']
         
     def increment_view_count(self):
-        """Increment the view count for this creation."""
-        self.view_count += 1
-        self.last_viewed_at = datetime.utcnow()
-        return self.view_count
+        """Record a view of this creation (buffered; see utils.creation_counters)."""
+        from utils.creation_counters import record_view, merged_counts
+        record_view(self.id)
+        return merged_counts(self)['view_count']
+
+
+class ImageHashChunk(db.Model):
+    """
+    One chunk of a creation's perceptual hash, for near-duplicate search.
+
+    Each image_phash is stored as the chunks of utils.perceptual_hash
+    STORED_CHUNK_LAYOUT, so any process can find the stored hashes near an
+    upload by looking up its chunks, without holding every hash in memory.
+    """
+    creation_id = db.Column(db.Integer, db.ForeignKey('creation.id', ondelete="CASCADE"), primary_key=True)
+    position = db.Column(db.SmallInteger, primary_key=True)
+    chunk = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_image_hash_chunk_position_chunk', 'position', 'chunk'),
+    )
 
 
 class ContactMessage(db.Model):
@@ -516,6 +681,7 @@ class VisitorLog(db.Model):
     page_visited = db.Column(db.String(255), nullable=False)
     session_id = db.Column(db.String(64), nullable=True)
     time_spent_seconds = db.Column(db.Integer, nullable=True)
+    referrer = db.Column(db.String(255), nullable=True)
 
     visitor = db.relationship('SiteVisitor', backref='visits', lazy=True)
 
@@ -531,13 +697,15 @@ class VisitorLog(db.Model):
         page_visited: str,
         session_id: Optional[str] = None,
         time_spent_seconds: Optional[int] = None,
-        timestamp: Optional[datetime] = None
+        timestamp: Optional[datetime] = None,
+        referrer: Optional[str] = None
     ):
         self.visitor_id = visitor_id
         self.page_visited = page_visited
         self.session_id = session_id
         self.time_spent_seconds = time_spent_seconds
         self.timestamp = timestamp or datetime.utcnow()
+        self.referrer = referrer
 
     def __repr__(self):
         return f'<VisitorLog {self.id}>'
@@ -555,6 +723,9 @@ class VisitorStats(db.Model):
     new_visitors = db.Column(db.Integer, default=0)
     returning_visitors = db.Column(db.Integer, default=0)
     average_duration = db.Column(db.Float, nullable=True)  # in seconds
+    # Running totals behind average_duration, maintained by the incremental rollup
+    duration_total = db.Column(db.Float, default=0.0)
+    duration_count = db.Column(db.Integer, default=0)
     
     # Add indexes and unique constraint
     __table_args__ = (
@@ -671,3 +842,129 @@ class VisitorStats(db.Model):
                 }
             }
         }
+
+
+class Job(db.Model):
+    """Model for background jobs (poem generation, final image rendering)."""
+    id = db.Column(db.String(36), primary_key=True)
+    job_type = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # 'queued', 'running', 'succeeded', 'failed'
+    payload = db.Column(db.JSON, nullable=True)
+    result = db.Column(db.JSON, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+
+    # Jobs with the same key are deduplicated instead of being run twice
+    idempotency_key = db.Column(db.String(128), nullable=True)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    creation_id = db.Column(db.Integer, db.ForeignKey('creation.id', ondelete="CASCADE"), nullable=True)
+
+    attempts = db.Column(db.Integer, default=0)
+    locked_by = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_job_status_created', 'status', 'created_at'),
+        db.Index('ix_job_idempotency_key', 'idempotency_key'),
+    )
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.job_type} {self.status}>'
+
+    @property
+    def is_finished(self):
+        return self.status in ('succeeded', 'failed')
+
+    def to_dict(self):
+        """Serialize the job for status polling and event streams."""
+        return {
+            'jobId': self.id,
+            'type': self.job_type,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'createdAt': self.created_at.isoformat() if self.created_at else None,
+            'finishedAt': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+class VisitorSketch(db.Model):
+    """HyperLogLog sketch of the distinct visitors seen in a period"""
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(10), nullable=False)  # 'day', 'month', 'year'
+    date = db.Column(db.Date, nullable=False)  # Start of the period
+    dimension = db.Column(db.String(20), nullable=False, default='site')
+    value = db.Column(db.String(255), nullable=False, default='')
+    registers = db.Column(db.LargeBinary, nullable=False)
+    visits = db.Column(db.Integer, default=0)  # Visits counted into the sketch
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('period', 'date', 'dimension', 'value', name='uq_visitor_sketch_key'),
+        db.Index('ix_visitor_sketch_dimension_date', 'dimension', 'period', 'date'),
+    )
+
+    def __repr__(self):
+        return f'<VisitorSketch {self.period} {self.date} {self.dimension}:{self.value}>'
+
+
+class RollupWatermark(db.Model):
+    """Position up to which an incremental rollup has processed its source table"""
+    name = db.Column(db.String(50), primary_key=True)
+    position = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<RollupWatermark {self.name}={self.position}>'
+
+
+class DailyCreationFact(db.Model):
+    """Creations per day broken down by poem type, poem length and frame style"""
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False)
+    # Missing values are stored as '' so the unique constraint covers them
+    poem_type = db.Column(db.String(50), nullable=False, default='')
+    poem_length = db.Column(db.String(20), nullable=False, default='')
+    frame_style = db.Column(db.String(50), nullable=False, default='')
+    creations = db.Column(db.Integer, nullable=False, default=0)
+    time_saved_minutes = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('date', 'poem_type', 'poem_length', 'frame_style', name='uq_daily_creation_fact'),
+        db.Index('ix_daily_creation_fact_date', 'date'),
+    )
+
+    def __repr__(self):
+        return f'<DailyCreationFact {self.date} {self.poem_type}/{self.poem_length}/{self.frame_style}>'
+
+
+class DailyRevenueFact(db.Model):
+    """Transaction count and amount per day and transaction status"""
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    transactions = db.Column(db.Integer, nullable=False, default=0)
+    amount = db.Column(db.Float, nullable=False, default=0.0)
+
+    __table_args__ = (
+        db.UniqueConstraint('date', 'status', name='uq_daily_revenue_fact'),
+        db.Index('ix_daily_revenue_fact_date', 'date'),
+    )
+
+    def __repr__(self):
+        return f'<DailyRevenueFact {self.date} {self.status}>'
+
+
+class DailySessionFact(db.Model):
+    """User sessions started per day with distinct users and total duration"""
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False, unique=True)
+    sessions = db.Column(db.Integer, nullable=False, default=0)
+    active_users = db.Column(db.Integer, nullable=False, default=0)
+    completed_sessions = db.Column(db.Integer, nullable=False, default=0)
+    duration_seconds = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DailySessionFact {self.date}>'
@@ -806,22 +806,52 @@ document.addEventListener('DOMContentLoaded', function() {
             additional: customPromptInput ? customPromptInput.value.trim() : ''
         };
 
-        // Send the request to generate a poem
-        fetch('/generate-poem', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                analysisId: state.analysisId,
-                poemType: poemType,
-                poemLength: poemLength,
-                emphasis: state.selectedEmphasis,
-                customPrompt: customPromptData,
-                isRegeneration: isRegeneration
-            })
+        const payload = {
+            analysisId: state.analysisId,
+            poemType: poemType,
+            poemLength: poemLength,
+            emphasis: state.selectedEmphasis,
+            customPrompt: customPromptData,
+            isRegeneration: isRegeneration
+        };
+
+        let shownStep = false;
+        function showPoemStep() {
+            if (shownStep) {
+                return;
+            }
+            shownStep = true;
+
+            // Hide loading indicator
+            loadingPoem.classList.add('d-none');
+
+            // Copy the image to the poem step
+            poemStepImage.src = uploadedImage.src;
+
+            // Move to the next step - only if this isn't a regeneration
+            if (!isRegeneration) {
+                goToStep(3);
+            }
+        }
+
+        // Stream the poem as it is written, falling back to the regular endpoint
+        streamPoem(payload, function(text) {
+            if (!shownStep) {
+                generatedPoem.textContent = '';
+                showPoemStep();
+            }
+            generatedPoem.textContent += text;
+        })
+        .catch(error => {
+            console.warn('Poem streaming unavailable, using regular request:', error);
+            return fetch('/generate-poem', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify(payload)
+            }).then(response => response.json());
         })
-        .then(response => response.json())
         .then(data => {
             // Hide loading indicator
             loadingPoem.classList.add('d-none');
@@ -838,16 +868,9 @@ document.addEventListener('DOMContentLoaded', function() {
                 return;
             }
 
-            // Display the generated poem
+            // Display the generated poem (the cleaned-up final text replaces the streamed text)
             generatedPoem.textContent = data.poem;
-
-            // Copy the image to the poem step
-            poemStepImage.src = uploadedImage.src;
-
-            // Move to the next step - only if this isn't a regeneration
-            if (!isRegeneration) {
-                goToStep(3);
-            }
+            showPoemStep();
         })
         .catch(error => {
             console.error('Error generating poem:', error);
@@ -858,6 +881,76 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    // Request a poem from the streaming endpoint, calling onToken with each chunk of text.
+    // Resolves with the final {poem} (or {error}) payload; rejects if streaming isn't available
+    // so the caller can fall back to /generate-poem.
+    function streamPoem(payload, onToken) {
+        if (!window.ReadableStream || !window.TextDecoder) {
+            return Promise.reject(new Error('Streaming not supported'));
+        }
+
+        return fetch('/generate-poem/stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Accept': 'text/event-stream'
+            },
+            body: JSON.stringify(payload)
+        })
+        .then(response => {
+            const contentType = response.headers.get('Content-Type') || '';
+            if (!contentType.includes('text/event-stream')) {
+                // Validation errors come back as regular JSON
+                return response.json();
+            }
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let result = null;
+
+            function handleEvent(block) {
+                let event = 'message';
+                let data = '';
+                block.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) {
+                        event = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        data += line.slice(5).trim();
+                    }
+                });
+                if (!data) {
+                    return;
+                }
+                const message = JSON.parse(data);
+                if (event === 'token') {
+                    onToken(message.text);
+                } else if (event === 'done' || event === 'error') {
+                    result = message;
+                }
+            }
+
+            function read() {
+                return reader.read().then(({ done, value }) => {
+                    if (value) {
+                        buffer += decoder.decode(value, { stream: true });
+                        let boundary;
+                        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                            handleEvent(buffer.slice(0, boundary));
+                            buffer = buffer.slice(boundary + 2);
+                        }
+                    }
+                    if (done) {
+                        return result || { error: 'The poem stream ended unexpectedly. Please try again.' };
+                    }
+                    return read();
+                });
+            }
+
+            return read();
+        });
+    }
+
     // Generate the poem - initial generation
     generatePoemBtn.addEventListener('click', function() {
         generatePoem(false); // Not a regeneration
@@ -893,14 +986,14 @@ document.addEventListener('DOMContentLoaded', function() {
         createFinalBtn.disabled = true;
         
         // Send the request to create the final image
-        fetch('/create-final-image', {
+        fetch('/create-final-image?include=urls', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
                 analysisId: state.analysisId,
-                //frameStyle: state.selectedFrame
+                frameStyle: state.selectedFrame
             })
         })
         .then(response => response.json())
@@ -914,8 +1007,8 @@ document.addEventListener('DOMContentLoaded', function() {
                 return;
             }
             
-            // Display the final creation
-            const finalImageSrc = `data:image/jpeg;base64,${data.finalImage}`;
+            // Display the final creation (served from the blob store, not inlined)
+            const finalImageSrc = data.finalImageUrl || `data:image/jpeg;base64,${data.finalImage}`;
             finalCreation.src = finalImageSrc;
             
             // Ensure proper orientation for mobile devices
@@ -1000,6 +1093,11 @@ document.addEventListener('DOMContentLoaded', function() {
             return false;
         }
 
+        // Count the download without delaying it
+        if (state.shareCode && navigator.sendBeacon) {
+            navigator.sendBeacon(`/shared/${state.shareCode}/download`);
+        }
+
         // Regular download logic for logged-in users
         const imageSrc = document.getElementById('finalCreation').src;
         const link = document.createElement('a');
@@ -0,0 +1,132 @@
+"""
+Asynchronous Vision + Gemini pipeline for Poem Vision AI.
+
+Runs image analysis and poem generation for an upload in a single call.
+Upstream requests from every Flask worker thread are multiplexed on one
+background asyncio event loop with a shared, connection-pooled HTTP client,
+and independent work (blob storage, perceptual hashing) overlaps with the
+Vision request instead of running after it.
+
+This saves the client's second HTTP round trip (/analyze-image followed by
+/generate-poem) and the per-request connection setup. It does not free the
+Flask worker: run_pipeline blocks the calling thread until Vision and Gemini
+have both answered, so worker occupancy per upload is unchanged.
+"""
+import os
+import asyncio
+import logging
+import threading
+import importlib.util
+import concurrent.futures
+from utils.image_analyzer import analyze_image_async
+from utils.poem_generator import generate_poem_async
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Connection pool limits for the shared async client
+PIPELINE_MAX_CONNECTIONS = int(os.environ.get("PIPELINE_MAX_CONNECTIONS", "100"))
+PIPELINE_MAX_KEEPALIVE = int(os.environ.get("PIPELINE_MAX_KEEPALIVE", "20"))
+
+# Use HTTP/2 when the h2 package is installed (set to 0 to force HTTP/1.1)
+PIPELINE_HTTP2 = os.environ.get("PIPELINE_HTTP2", "1") not in ("0", "false", "False")
+
+# Upper bound on how long a request thread waits for the whole pipeline
+PIPELINE_TIMEOUT = float(os.environ.get("PIPELINE_TIMEOUT", "45"))
+
+_loop = None
+_loop_lock = threading.Lock()
+_client = None
+
+
+def pipeline_available():
+    """Check whether the async HTTP client library (httpx) is installed."""
+    return importlib.util.find_spec("httpx") is not None
+
+
+def _get_loop():
+    """Return the background event loop, starting its thread on first use."""
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="async-pipeline", daemon=True)
+                thread.start()
+                _loop = loop
+    return _loop
+
+
+def _get_client():
+    """Return the shared async HTTP client (must be called on the pipeline loop)."""
+    global _client
+    if _client is None:
+        try:
+            import httpx
+        except ImportError:
+            raise RuntimeError("The async pipeline requires the httpx package to be installed")
+
+        http2 = PIPELINE_HTTP2 and importlib.util.find_spec("h2") is not None
+        _client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(max_connections=PIPELINE_MAX_CONNECTIONS,
+                                max_keepalive_connections=PIPELINE_MAX_KEEPALIVE))
+        logger.info(f"Created async pipeline client (http2={http2}, max_connections={PIPELINE_MAX_CONNECTIONS})")
+    return _client
+
+
+async def analyze_and_generate(image_bytes, poem_options, prepare=None, postprocess=None):
+    """
+    Analyze an image and generate a poem for it.
+
+    Args:
+        image_bytes (bytes): The uploaded image
+        poem_options (dict): Keyword arguments for generate_poem (poem_type,
+            poem_length, emphasis, custom_terms, custom_category, is_regeneration)
+        prepare (callable, optional): Blocking work to run in a thread while
+            the Vision request is in flight; its return value is passed back
+        postprocess (callable, optional): Applied to the analysis results
+            before they are used to build the poem prompt
+
+    Returns:
+        tuple: (analysis_results, poem, prepare_result); poem is None if
+        the analysis failed
+    """
+    client = _get_client()
+    loop = asyncio.get_running_loop()
+
+    analysis_task = analyze_image_async(image_bytes, client)
+    if prepare is not None:
+        analysis_results, prepare_result = await asyncio.gather(
+            analysis_task, loop.run_in_executor(None, prepare))
+    else:
+        analysis_results, prepare_result = await analysis_task, None
+
+    # Don't spend a Gemini call on a failed analysis
+    if not analysis_results or '_error' in analysis_results:
+        return analysis_results, None, prepare_result
+
+    if postprocess is not None:
+        analysis_results = postprocess(analysis_results)
+
+    poem = await generate_poem_async(client, analysis_results, **poem_options)
+    return analysis_results, poem, prepare_result
+
+
+def run_pipeline(image_bytes, poem_options, prepare=None, postprocess=None, timeout=PIPELINE_TIMEOUT):
+    """
+    Run analyze_and_generate on the background loop and wait for the result.
+
+    Safe to call from any Flask worker thread; see analyze_and_generate for
+    the arguments and return value. The calling thread is parked for the
+    whole Vision + Gemini round trip (up to timeout seconds); only the
+    upstream I/O is multiplexed on the shared loop.
+    """
+    future = asyncio.run_coroutine_threadsafe(
+        analyze_and_generate(image_bytes, poem_options, prepare=prepare, postprocess=postprocess),
+        _get_loop())
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
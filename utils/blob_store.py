@@ -0,0 +1,207 @@
+"""
+Content-addressed blob storage for Poem Vision AI.
+
+Image bytes are stored outside the database and keyed by the SHA-256 of
+their content, so identical uploads share a single blob and database rows
+only need to hold the 64-character key.
+"""
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Backend selection: 'local' (default) or 's3'
+BLOB_STORE_BACKEND = os.environ.get("BLOB_STORE_BACKEND", "local").lower()
+
+# Local filesystem backend settings
+BLOB_STORE_PATH = os.environ.get(
+    "BLOB_STORE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "instance", "blobs"))
+
+# S3-compatible backend settings (endpoint can point at MinIO or another local stand-in)
+BLOB_STORE_S3_BUCKET = os.environ.get("BLOB_STORE_S3_BUCKET", "poemvision-blobs")
+BLOB_STORE_S3_ENDPOINT = os.environ.get("BLOB_STORE_S3_ENDPOINT") or None
+BLOB_STORE_S3_PREFIX = os.environ.get("BLOB_STORE_S3_PREFIX", "blobs/")
+
+_blob_store = None
+_blob_store_lock = threading.Lock()
+
+
+class BlobNotFound(KeyError):
+    """Raised when a blob key does not exist in the store."""
+
+
+def compute_blob_key(data):
+    """Return the content-addressed key (SHA-256 hex digest) for the given bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_valid_blob_key(key):
+    """Check that a key looks like a SHA-256 hex digest."""
+    return (isinstance(key, str) and len(key) == 64
+            and all(c in "0123456789abcdef" for c in key))
+
+
+def guess_image_mimetype(data):
+    """Guess an image MIME type from the leading magic bytes."""
+    head = bytes(data[:12])
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "application/octet-stream"
+
+
+class BlobStore:
+    """Base class for blob storage backends."""
+
+    def put(self, data):
+        """
+        Store bytes and return their content-addressed key.
+
+        Storing the same content twice is a no-op and returns the same key.
+        """
+        key = compute_blob_key(data)
+        if not self.exists(key):
+            self._write(key, data)
+        return key
+
+    def get(self, key):
+        """Return the bytes stored under key, raising BlobNotFound if missing."""
+        raise NotImplementedError
+
+    def exists(self, key):
+        """Check whether a blob exists for the given key."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Delete a blob if it exists."""
+        raise NotImplementedError
+
+    def _write(self, key, data):
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    """Blob store backed by the local filesystem, sharded by key prefix."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        if not is_valid_blob_key(key):
+            raise BlobNotFound(key)
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise BlobNotFound(key)
+
+    def exists(self, key):
+        try:
+            return os.path.exists(self._path(key))
+        except BlobNotFound:
+            return False
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except (FileNotFoundError, BlobNotFound):
+            pass
+
+    def _write(self, key, data):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temp file first so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+class S3BlobStore(BlobStore):
+    """Blob store backed by an S3-compatible object store (AWS S3, MinIO, etc.)."""
+
+    def __init__(self, bucket, endpoint_url=None, prefix=""):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("The S3 blob store backend requires boto3 to be installed")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client_error = ClientError
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _object_key(self, key):
+        if not is_valid_blob_key(key):
+            raise BlobNotFound(key)
+        return f"{self.prefix}{key[:2]}/{key}"
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))
+            return response["Body"].read()
+        except self._client_error as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                raise BlobNotFound(key)
+            raise
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except BlobNotFound:
+            return False
+        except self._client_error as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404", "NotFound"):
+                return False
+            raise
+
+    def delete(self, key):
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+        except BlobNotFound:
+            pass
+
+    def _write(self, key, data):
+        self.client.put_object(Bucket=self.bucket,
+                               Key=self._object_key(key),
+                               Body=data,
+                               ContentType=guess_image_mimetype(data))
+
+
+def get_blob_store():
+    """Return the process-wide blob store configured from the environment."""
+    global _blob_store
+    if _blob_store is None:
+        with _blob_store_lock:
+            if _blob_store is None:
+                if BLOB_STORE_BACKEND == "s3":
+                    logger.info(f"Using S3 blob store (bucket={BLOB_STORE_S3_BUCKET}, endpoint={BLOB_STORE_S3_ENDPOINT})")
+                    _blob_store = S3BlobStore(BLOB_STORE_S3_BUCKET,
+                                              endpoint_url=BLOB_STORE_S3_ENDPOINT,
+                                              prefix=BLOB_STORE_S3_PREFIX)
+                else:
+                    logger.info(f"Using local blob store at {BLOB_STORE_PATH}")
+                    _blob_store = LocalBlobStore(BLOB_STORE_PATH)
+    return _blob_store
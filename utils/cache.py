@@ -0,0 +1,311 @@
+"""
+Caching utilities for Poem Vision AI.
+
+Provides a bounded, TTL-aware in-process LRU cache and a two-tier cache that
+puts the LRU in front of an optional shared backend (SQLite file or Redis),
+so results computed by one gunicorn worker can be reused by every worker.
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Shared cache backend, e.g. "redis://localhost:6379/0" or "sqlite:///instance/cache.db".
+# Leave empty to keep caches in-process only.
+CACHE_BACKEND_URL = os.environ.get("CACHE_BACKEND_URL", "")
+
+_MISSING = object()
+
+# Registry of named caches so their stats can be exposed in one place
+_caches = {}
+_caches_lock = threading.Lock()
+
+_shared_backend = None
+_shared_backend_lock = threading.Lock()
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache bounded by entry count (and optionally total bytes) with optional per-entry TTL.
+
+    With max_bytes set, callers pass each value's size to set(); least recently
+    used entries are evicted until both bounds hold.
+    """
+
+    def __init__(self, max_entries=1024, default_ttl=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value, size = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                self.bytes -= size
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, size=0):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._data[key] = (expires_at, value, size)
+            self.bytes += size
+            while len(self._data) > self.max_entries or (
+                    self.max_bytes is not None and self.bytes > self.max_bytes and self._data):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+
+    def purge_expired(self):
+        """Drop every expired entry; returns the number dropped."""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (expires_at, _, _) in self._data.items()
+                       if expires_at is not None and expires_at <= now]
+            for key in expired:
+                self.bytes -= self._data.pop(key)[2]
+        return len(expired)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCacheBackend:
+    """Shared cache backend stored in a SQLite file, usable by every process on a host."""
+
+    # Expired rows are purged once every this many writes
+    PURGE_INTERVAL = 500
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache_entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)")
+        conn.commit()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value, expires_at FROM cache_entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, expires_at))
+        self._writes += 1
+        if self._writes % self.PURGE_INTERVAL == 0:
+            conn.execute("DELETE FROM cache_entries WHERE expires_at IS NOT NULL AND expires_at <= ?",
+                         (time.time(),))
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+
+
+class RedisCacheBackend:
+    """Shared cache backend stored in Redis (or any Redis-protocol server)."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("The Redis cache backend requires the redis package to be installed")
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl=None):
+        if ttl:
+            self.client.set(key, value, ex=int(ttl))
+        else:
+            self.client.set(key, value)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+def create_backend(url):
+    """Create a shared cache backend from a URL, or return None for an empty URL."""
+    if not url:
+        return None
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCacheBackend(url)
+    if url.startswith("sqlite:///"):
+        return SQLiteCacheBackend(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported cache backend URL: {url}")
+
+
+def get_shared_backend():
+    """Return the process-wide shared cache backend configured by CACHE_BACKEND_URL."""
+    global _shared_backend
+    if _shared_backend is None and CACHE_BACKEND_URL:
+        with _shared_backend_lock:
+            if _shared_backend is None:
+                try:
+                    _shared_backend = create_backend(CACHE_BACKEND_URL)
+                    logger.info(f"Using shared cache backend: {CACHE_BACKEND_URL.split('@')[-1]}")
+                except Exception as e:
+                    logger.error(f"Shared cache backend unavailable, using in-process caches only: {str(e)}")
+                    _shared_backend = False
+    return _shared_backend or None
+
+
+class TieredCache:
+    """
+    Two-tier cache: a bounded in-process LRU in front of an optional shared backend.
+
+    Keys are namespaced by cache name and version, so bumping the version
+    invalidates every entry without touching the backend. Values must be
+    JSON-serializable because they are stored in the shared tier as JSON.
+    """
+
+    def __init__(self, name, max_entries=1024, ttl=None, version="", backend=_MISSING):
+        self.name = name
+        self.version = version
+        self.ttl = ttl
+        self.local = LRUCache(max_entries=max_entries, default_ttl=ttl)
+        self._backend = backend
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.errors = 0
+        register_cache(self)
+
+    @property
+    def backend(self):
+        if self._backend is _MISSING:
+            return get_shared_backend()
+        return self._backend
+
+    def _full_key(self, key):
+        return f"{self.name}:{self.version}:{key}"
+
+    def get(self, key, default=None):
+        full_key = self._full_key(key)
+        value = self.local.get(full_key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+
+        backend = self.backend
+        if backend is not None:
+            try:
+                raw = backend.get(full_key)
+                if raw is not None:
+                    value = json.loads(raw)
+                    self.local.set(full_key, value)
+                    self.shared_hits += 1
+                    return value
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Shared cache read failed for {self.name}: {str(e)}")
+
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        full_key = self._full_key(key)
+        self.local.set(full_key, value, ttl=ttl)
+        self.sets += 1
+
+        backend = self.backend
+        if backend is not None:
+            try:
+                backend.set(full_key, json.dumps(value).encode("utf-8"), ttl=ttl)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Shared cache write failed for {self.name}: {str(e)}")
+
+    def delete(self, key):
+        full_key = self._full_key(key)
+        self.local.delete(full_key)
+        backend = self.backend
+        if backend is not None:
+            try:
+                backend.delete(full_key)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Shared cache delete failed for {self.name}: {str(e)}")
+
+    def stats(self):
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            'version': self.version,
+            'local_entries': len(self.local),
+            'local_max_entries': self.local.max_entries,
+            'local_evictions': self.local.evictions,
+            'local_hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'sets': self.sets,
+            'errors': self.errors,
+            'hit_rate': round((self.hits + self.shared_hits) / lookups, 4) if lookups else 0.0,
+            'shared_backend': type(self.backend).__name__ if self.backend is not None else None
+        }
+
+
+def register_cache(cache):
+    """Register a named cache so it shows up in get_cache_stats()."""
+    with _caches_lock:
+        _caches[cache.name] = cache
+
+
+def get_cache_stats():
+    """Return stats for every registered cache, keyed by cache name."""
+    with _caches_lock:
+        caches = list(_caches.values())
+    return {cache.name: cache.stats() for cache in caches}
@@ -0,0 +1,201 @@
+"""
+Buffered view and download counters for creations.
+
+Incrementing Creation.view_count with a read-modify-write serializes every
+view of a popular creation on one row and loses updates when two workers
+write the same row. Instead, views and downloads are added to an in-process
+buffer and a background thread flushes them every COUNTER_FLUSH_INTERVAL
+seconds. Each flush runs one executemany UPDATE per counter, and each row
+update is an atomic `SET view_count = view_count + :n`. This means that
+concurrent flushes from several workers add up correctly.
+
+Reads merge the flushed value from the row with this process's pending
+increments (see merged_counts). Increments buffered by other workers become
+visible once they flush.
+"""
+import os
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import bindparam, case, func
+from models import db, Creation
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+COUNTER_FLUSH_INTERVAL = float(os.environ.get("COUNTER_FLUSH_INTERVAL", "5.0"))
+# Creations with pending increments before the flusher is woken early
+COUNTER_FLUSH_THRESHOLD = int(os.environ.get("COUNTER_FLUSH_THRESHOLD", "1000"))
+
+# creation_id -> {'views', 'downloads', 'last_viewed_at', 'last_downloaded_at'}
+_pending = {}
+_pending_lock = threading.Lock()
+_pending_ready = threading.Event()
+_counter_stats = {'views': 0, 'downloads': 0, 'flushed_rows': 0, 'flushes': 0, 'flush_errors': 0,
+                  'last_flush_at': None, 'last_flush_ms': None}
+_flusher_pid = None
+
+
+def _empty_counts():
+    return {'views': 0, 'downloads': 0, 'last_viewed_at': None, 'last_downloaded_at': None}
+
+
+def _record(app, creation_id, field, timestamp_field, count=1):
+    _ensure_flusher(app)
+    with _pending_lock:
+        counts = _pending.get(creation_id)
+        if counts is None:
+            counts = _pending[creation_id] = _empty_counts()
+        counts[field] += count
+        counts[timestamp_field] = datetime.utcnow()
+        _counter_stats[field] += count
+        if len(_pending) >= COUNTER_FLUSH_THRESHOLD:
+            _pending_ready.set()
+
+
+def record_view(creation_id, count=1, app=None):
+    """Buffer a view of a creation."""
+    _record(app or current_app._get_current_object(), creation_id, 'views', 'last_viewed_at', count)
+
+
+def record_download(creation_id, count=1, app=None):
+    """Buffer a download of a creation."""
+    _record(app or current_app._get_current_object(), creation_id, 'downloads', 'last_downloaded_at', count)
+
+
+def pending_counts(creation_id):
+    """Return this process's unflushed increments for a creation."""
+    with _pending_lock:
+        return dict(_pending.get(creation_id) or _empty_counts())
+
+
+def merged_counts(creation):
+    """
+    Return a creation's counters including this process's pending increments.
+
+    Returns:
+        dict: view_count, download_count, is_downloaded, last_viewed_at, last_downloaded_at
+    """
+    pending = pending_counts(creation.id)
+    last_viewed_at = max(filter(None, (creation.last_viewed_at, pending['last_viewed_at'])), default=None)
+    last_downloaded_at = max(filter(None, (creation.last_downloaded_at, pending['last_downloaded_at'])),
+                             default=None)
+    download_count = (creation.download_count or 0) + pending['downloads']
+    return {
+        'view_count': (creation.view_count or 0) + pending['views'],
+        'download_count': download_count,
+        'is_downloaded': bool(creation.is_downloaded or download_count),
+        'last_viewed_at': last_viewed_at,
+        'last_downloaded_at': last_downloaded_at
+    }
+
+
+def _ensure_flusher(app):
+    """Start the flusher thread in this process if it isn't running (e.g. after a fork)."""
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _pending_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+        # Increments copied from a parent process are flushed by the parent
+        _pending.clear()
+    thread = threading.Thread(target=_flusher_loop, args=(app,), name="counter-flusher", daemon=True)
+    thread.start()
+    atexit.register(flush_pending, app)
+    logger.info(f"Started creation counter flusher (interval={COUNTER_FLUSH_INTERVAL}s)")
+
+
+def _flusher_loop(app):
+    while True:
+        _pending_ready.wait(COUNTER_FLUSH_INTERVAL)
+        _pending_ready.clear()
+        flush_pending(app)
+
+
+def flush_pending(app):
+    """Swap out the pending increments and write them; failed batches are merged back."""
+    global _pending
+    with _pending_lock:
+        if not _pending:
+            return 0
+        batch, _pending = _pending, {}
+
+    start = time.perf_counter()
+    with app.app_context():
+        try:
+            flush_counts(batch)
+        except Exception as e:
+            db.session.rollback()
+            _counter_stats['flush_errors'] += 1
+            logger.error(f"Error flushing counters for {len(batch)} creations: {str(e)}", exc_info=True)
+            _restore(batch)
+            return 0
+        finally:
+            db.session.remove()
+
+    _counter_stats['flushed_rows'] += len(batch)
+    _counter_stats['flushes'] += 1
+    _counter_stats['last_flush_at'] = datetime.utcnow().isoformat()
+    _counter_stats['last_flush_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return len(batch)
+
+
+def _restore(batch):
+    """Put increments back after a failed flush so the next flush retries them."""
+    with _pending_lock:
+        for creation_id, counts in batch.items():
+            current = _pending.get(creation_id)
+            if current is None:
+                _pending[creation_id] = counts
+                continue
+            current['views'] += counts['views']
+            current['downloads'] += counts['downloads']
+            for field in ('last_viewed_at', 'last_downloaded_at'):
+                current[field] = max(filter(None, (current[field], counts[field])), default=None)
+
+
+def _latest(column, param):
+    # Keep the newer timestamp when another worker flushed a later one first
+    return case((column > bindparam(param), column), else_=bindparam(param))
+
+
+def flush_counts(batch):
+    """
+    Add a batch of increments to the creation rows in one transaction.
+
+    Args:
+        batch (dict): creation_id -> counts as buffered by record_view/record_download
+    """
+    table = Creation.__table__
+    views = [{'_id': creation_id, '_n': counts['views'], '_last': counts['last_viewed_at']}
+             for creation_id, counts in batch.items() if counts['views']]
+    downloads = [{'_id': creation_id, '_n': counts['downloads'], '_last': counts['last_downloaded_at']}
+                 for creation_id, counts in batch.items() if counts['downloads']]
+
+    # updated_at is set to itself so counter updates don't look like content changes
+    if views:
+        db.session.execute(table.update().where(table.c.id == bindparam('_id')).values(
+            view_count=func.coalesce(table.c.view_count, 0) + bindparam('_n'),
+            last_viewed_at=_latest(table.c.last_viewed_at, '_last'),
+            updated_at=table.c.updated_at
+        ), views)
+    if downloads:
+        db.session.execute(table.update().where(table.c.id == bindparam('_id')).values(
+            download_count=func.coalesce(table.c.download_count, 0) + bindparam('_n'),
+            is_downloaded=True,
+            last_downloaded_at=_latest(table.c.last_downloaded_at, '_last'),
+            updated_at=table.c.updated_at
+        ), downloads)
+    db.session.commit()
+
+
+def get_counter_stats():
+    """Return counters describing the pending buffer and its flushes."""
+    with _pending_lock:
+        pending = len(_pending)
+    return dict(_counter_stats, pending_creations=pending)
@@ -0,0 +1,255 @@
+"""
+Materialized daily fact tables for the admin analytics pages.
+
+Creations (by poem type, length and frame), transactions (by status) and
+user sessions are aggregated per day into small fact tables, which the
+dashboard, analytics and financial pages read instead of re-aggregating the
+raw tables on every request.
+
+Source rows change after they are created (a creation gets its poem and
+frame minutes later, a transaction moves from pending to completed), so
+facts are rebuilt per day rather than appended to: each refresh recomputes
+every day since the last refresh plus a lookback window of recent days.
+Older days are treated as final; `flask backfill-daily-facts` rebuilds any
+range from scratch.
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import func, case
+from models import (db, Creation, Transaction, UserSession, RollupWatermark,
+                    DailyCreationFact, DailyRevenueFact, DailySessionFact)
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Days before the last refresh that are recomputed, to pick up late changes
+DAILY_FACTS_LOOKBACK_DAYS = int(os.environ.get("DAILY_FACTS_LOOKBACK_DAYS", "3"))
+
+WATERMARK_NAME = 'daily_facts'
+
+
+def _day(column):
+    """Truncate a timestamp column to its day in the database's dialect."""
+    if db.engine.dialect.name == 'postgresql':
+        return func.date_trunc('day', column)
+    return func.date(column)
+
+
+def _as_date(value):
+    # date_trunc returns a datetime, SQLite's date() a 'YYYY-MM-DD' string
+    if isinstance(value, str):
+        return datetime.strptime(value[:10], '%Y-%m-%d').date()
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+def rebuild_facts(start, end):
+    """
+    Recompute every fact table for an inclusive range of days in one transaction.
+
+    Args:
+        start (date): First day to rebuild
+        end (date): Last day to rebuild
+
+    Returns:
+        int: The number of fact rows written
+    """
+    range_start = datetime.combine(start, datetime.min.time())
+    range_end = datetime.combine(end + timedelta(days=1), datetime.min.time())
+
+    for model in (DailyCreationFact, DailyRevenueFact, DailySessionFact):
+        model.query.filter(model.date >= start, model.date <= end).delete(synchronize_session=False)
+
+    creation_day = _day(Creation.created_at)
+    # Missing values are grouped as '' in SQL, so NULL and '' land in one fact row
+    dimensions = [func.coalesce(column, '') for column in (
+        Creation.poem_type, Creation.poem_length, Creation.frame_style)]
+    creation_rows = [{
+        'date': _as_date(day),
+        'poem_type': poem_type,
+        'poem_length': poem_length,
+        'frame_style': frame_style,
+        'creations': creations,
+        'time_saved_minutes': int(time_saved or 0)
+    } for day, poem_type, poem_length, frame_style, creations, time_saved in db.session.query(
+        creation_day,
+        *dimensions,
+        func.count(Creation.id),
+        func.sum(Creation.time_saved_minutes)
+    ).filter(
+        Creation.created_at >= range_start,
+        Creation.created_at < range_end
+    ).group_by(creation_day, *dimensions)]
+
+    transaction_day = _day(Transaction.created_at)
+    revenue_rows = [{
+        'date': _as_date(day),
+        'status': status,
+        'transactions': transactions,
+        'amount': float(amount or 0)
+    } for day, status, transactions, amount in db.session.query(
+        transaction_day,
+        Transaction.status,
+        func.count(Transaction.id),
+        func.sum(Transaction.amount)
+    ).filter(
+        Transaction.created_at >= range_start,
+        Transaction.created_at < range_end
+    ).group_by(transaction_day, Transaction.status)]
+
+    session_day = _day(UserSession.session_start)
+    session_rows = [{
+        'date': _as_date(day),
+        'sessions': sessions,
+        'active_users': active_users,
+        'completed_sessions': int(completed or 0),
+        'duration_seconds': int(duration or 0)
+    } for day, sessions, active_users, completed, duration in db.session.query(
+        session_day,
+        func.count(UserSession.id),
+        func.count(func.distinct(UserSession.user_id)),
+        func.sum(case((UserSession.duration_seconds.isnot(None), 1), else_=0)),
+        func.sum(UserSession.duration_seconds)
+    ).filter(
+        UserSession.session_start >= range_start,
+        UserSession.session_start < range_end
+    ).group_by(session_day)]
+
+    for model, rows in ((DailyCreationFact, creation_rows), (DailyRevenueFact, revenue_rows),
+                        (DailySessionFact, session_rows)):
+        if rows:
+            db.session.execute(model.__table__.insert(), rows)
+
+    db.session.commit()
+    return len(creation_rows) + len(revenue_rows) + len(session_rows)
+
+
+def refresh_facts(lookback_days=DAILY_FACTS_LOOKBACK_DAYS):
+    """
+    Bring the fact tables up to date.
+
+    Rebuilds every day from lookback_days before the last refresh through
+    today. The first refresh (no watermark yet) backfills all history.
+
+    Returns:
+        tuple: (first day rebuilt, last day rebuilt, fact rows written)
+    """
+    today = datetime.utcnow().date()
+    watermark = db.session.get(RollupWatermark, WATERMARK_NAME)
+    if watermark is None:
+        return backfill_facts()
+
+    start = min(datetime.fromordinal(watermark.position).date(), today) - timedelta(days=lookback_days)
+    rows = rebuild_facts(start, today)
+    _set_watermark(today)
+    logger.info(f"Refreshed daily facts for {start} to {today} ({rows} rows)")
+    return start, today, rows
+
+
+def backfill_facts(start=None, chunk_days=31):
+    """
+    Rebuild the fact tables from start (default: the earliest source row) through today.
+
+    Each chunk of days is rebuilt in its own transaction.
+
+    Returns:
+        tuple: (first day rebuilt, last day rebuilt, fact rows written)
+    """
+    today = datetime.utcnow().date()
+    if start is None:
+        earliest = [value for value in (
+            db.session.query(func.min(Creation.created_at)).scalar(),
+            db.session.query(func.min(Transaction.created_at)).scalar(),
+            db.session.query(func.min(UserSession.session_start)).scalar()
+        ) if value is not None]
+        start = min(earliest).date() if earliest else today
+
+    rows = 0
+    chunk_start = start
+    while chunk_start <= today:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), today)
+        rows += rebuild_facts(chunk_start, chunk_end)
+        logger.info(f"Backfilled daily facts for {chunk_start} to {chunk_end}")
+        chunk_start = chunk_end + timedelta(days=1)
+
+    _set_watermark(today)
+    return start, today, rows
+
+
+def _set_watermark(day):
+    watermark = db.session.get(RollupWatermark, WATERMARK_NAME)
+    if watermark is None:
+        db.session.add(RollupWatermark(name=WATERMARK_NAME, position=day.toordinal()))
+    else:
+        watermark.position = day.toordinal()
+    db.session.commit()
+
+
+def creation_breakdown(dimension):
+    """
+    Return all-time creation counts by poem_type, poem_length or frame_style.
+
+    Returns:
+        list: (value, count) tuples, excluding creations without a value
+    """
+    column = getattr(DailyCreationFact, dimension)
+    return db.session.query(
+        column, func.sum(DailyCreationFact.creations)
+    ).filter(column != '').group_by(column).all()
+
+
+def total_time_saved_minutes():
+    """Return the total estimated minutes saved across all creations."""
+    return int(db.session.query(func.sum(DailyCreationFact.time_saved_minutes)).scalar() or 0)
+
+
+def _fill_days(start, end, values):
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    return [(day, values.get(day, 0)) for day in days]
+
+
+def daily_creations(start, end):
+    """Return (date, creations) for every day in an inclusive range, including empty days."""
+    values = dict(db.session.query(
+        DailyCreationFact.date, func.sum(DailyCreationFact.creations)
+    ).filter(
+        DailyCreationFact.date >= start, DailyCreationFact.date <= end
+    ).group_by(DailyCreationFact.date).all())
+    return _fill_days(start, end, values)
+
+
+def daily_active_users(start, end):
+    """Return (date, distinct users with a session) for every day in an inclusive range."""
+    values = dict(db.session.query(
+        DailySessionFact.date, DailySessionFact.active_users
+    ).filter(
+        DailySessionFact.date >= start, DailySessionFact.date <= end
+    ).all())
+    return _fill_days(start, end, values)
+
+
+def daily_revenue(start, end, status='completed'):
+    """Return (date, amount) for every day in an inclusive range, for one transaction status."""
+    values = dict(db.session.query(
+        DailyRevenueFact.date, DailyRevenueFact.amount
+    ).filter(
+        DailyRevenueFact.date >= start, DailyRevenueFact.date <= end, DailyRevenueFact.status == status
+    ).all())
+    return _fill_days(start, end, values)
+
+
+def revenue_summary(start, end, status='completed'):
+    """
+    Return the transaction count and total amount for an inclusive range of days.
+
+    Returns:
+        tuple: (transaction count, total amount)
+    """
+    count, amount = db.session.query(
+        func.sum(DailyRevenueFact.transactions), func.sum(DailyRevenueFact.amount)
+    ).filter(
+        DailyRevenueFact.date >= start, DailyRevenueFact.date <= end, DailyRevenueFact.status == status
+    ).one()
+    return int(count or 0), float(amount or 0)
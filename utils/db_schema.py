@@ -0,0 +1,157 @@
+"""
+Lightweight schema helpers for Poem Vision AI.
+
+`db.create_all()` only creates missing tables, so columns added to existing
+models have to be added to existing databases by hand. These helpers issue
+the necessary `ALTER TABLE ... ADD COLUMN` statements, and rebuild SQLite
+tables where a constraint can't be altered in place.
+"""
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateTable
+from models import db
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+def ensure_columns(model, column_names):
+    """
+    Add any of the given model columns that are missing from the database table.
+
+    Args:
+        model: The SQLAlchemy model class
+        column_names (list): Names of model columns that should exist
+
+    Returns:
+        list: The names of the columns that were added
+    """
+    table = model.__table__
+    inspector = inspect(db.engine)
+    if not inspector.has_table(table.name):
+        return []
+
+    existing = {col['name'] for col in inspector.get_columns(table.name)}
+    added = []
+
+    for name in column_names:
+        if name in existing:
+            continue
+        column = table.columns[name]
+        column_type = column.type.compile(dialect=db.engine.dialect)
+        db.session.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{name}" {column_type}'))
+        added.append(name)
+        logger.info(f"Added missing column {table.name}.{name}")
+
+    if added:
+        db.session.commit()
+    return added
+
+
+def ensure_nullable(model, column_names):
+    """
+    Drop NOT NULL constraints that the model no longer declares.
+
+    PostgreSQL alters the columns in place. SQLite can't alter a column, so
+    the table is rebuilt from the model definition and its rows are copied
+    over (see _rebuild_sqlite_table). Other databases are left unchanged with
+    an error logged, since writes that rely on the relaxed columns will fail.
+
+    Returns:
+        list: The names of the columns that were relaxed
+    """
+    table = model.__table__
+    inspector = inspect(db.engine)
+    if not inspector.has_table(table.name):
+        return []
+
+    existing = {col['name']: col for col in inspector.get_columns(table.name)}
+    pending = [name for name in column_names
+               if name in existing and not existing[name].get('nullable', True)]
+    if not pending:
+        return []
+
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        _rebuild_sqlite_table(table, list(existing))
+        logger.info(f"Rebuilt {table.name} to drop NOT NULL on {', '.join(pending)}")
+        return pending
+    if dialect != 'postgresql':
+        logger.error(f"Cannot drop NOT NULL on {table.name}.{', '.join(pending)} for {dialect}; "
+                     f"recreate the table")
+        return []
+
+    for name in pending:
+        db.session.execute(text(f'ALTER TABLE "{table.name}" ALTER COLUMN "{name}" DROP NOT NULL'))
+        logger.info(f"Dropped NOT NULL constraint on {table.name}.{name}")
+    db.session.commit()
+    return pending
+
+
+def _rebuild_sqlite_table(table, existing_columns):
+    """
+    Recreate a SQLite table from its model definition, keeping its rows.
+
+    Follows SQLite's documented procedure for schema changes ALTER TABLE can't
+    make: create the new table under a temporary name, copy the rows, drop the
+    old table, rename the new one and recreate its indexes, all in one
+    transaction with foreign key enforcement off. Rows are copied as they are,
+    so existing foreign key violations are neither fixed nor rejected.
+    """
+    preparer = db.engine.dialect.identifier_preparer
+    name = preparer.format_table(table)
+    temp_name = preparer.quote(f"_{table.name}_rebuild")
+    create_sql = str(CreateTable(table).compile(dialect=db.engine.dialect)).strip()
+    create_sql = create_sql.replace(f"CREATE TABLE {name}", f"CREATE TABLE {temp_name}", 1)
+    columns = ', '.join(preparer.quote(column.name) for column in table.columns
+                        if column.name in existing_columns)
+
+    # The rebuild needs the database to itself
+    db.session.commit()
+    db.session.close()
+
+    with db.engine.connect() as conn:
+        # Foreign key enforcement can only be switched outside a transaction
+        conn.exec_driver_sql('PRAGMA foreign_keys=OFF')
+        conn.commit()
+        try:
+            conn.exec_driver_sql('BEGIN')
+            conn.exec_driver_sql(f'DROP TABLE IF EXISTS {temp_name}')
+            conn.exec_driver_sql(create_sql)
+            conn.exec_driver_sql(f'INSERT INTO {temp_name} ({columns}) SELECT {columns} FROM {name}')
+            conn.exec_driver_sql(f'DROP TABLE {name}')
+            conn.exec_driver_sql(f'ALTER TABLE {temp_name} RENAME TO {name}')
+            for index in table.indexes:
+                index.create(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.exec_driver_sql('PRAGMA foreign_keys=ON')
+            conn.commit()
+
+
+def ensure_indexes(model):
+    """
+    Create any indexes declared on the model that are missing from the database.
+
+    Returns:
+        list: The names of the indexes that were created
+    """
+    table = model.__table__
+    inspector = inspect(db.engine)
+    if not inspector.has_table(table.name):
+        return []
+
+    existing = {index['name'] for index in inspector.get_indexes(table.name)}
+    created = []
+
+    for index in table.indexes:
+        if index.name in existing:
+            continue
+        index.create(db.engine)
+        created.append(index.name)
+        logger.info(f"Created missing index {index.name} on {table.name}")
+
+    return created
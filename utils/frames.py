@@ -0,0 +1,183 @@
+"""
+Frame compositing for final images.
+
+Every style from membership.get_available_frames is rendered on the server,
+so a creation looks the same wherever it is shown or downloaded. Styles with
+an asset in static/frames are nine-sliced. The asset is scaled once per target
+width to the configured border thickness, and its corners, top/bottom edges
+and side strips are cached. A render of any height then only stretches the
+two thin side strips. Assets are decoded once per process (see
+preload_frames). Styles without an asset are drawn.
+"""
+import os
+import logging
+import threading
+from PIL import Image, ImageDraw, ImageFilter
+from utils.cache import LRUCache
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+FRAMES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'frames')
+
+# Asset file and border insets (left, top, right, bottom) in asset pixels. The
+# insets cover the frame's moulding and corner ornaments; everything inside
+# them is replaced by the image.
+FRAME_ASSETS = {
+    'classic': ('classic.jpg', (31, 31, 31, 31)),
+    'minimalist': ('minimalist.jpg', (32, 32, 32, 32)),
+    'elegant': ('elegant.jpg', (52, 52, 52, 52)),
+    'vintage': ('vintage.jpg', (52, 52, 52, 52)),
+    'ornate': ('ornate.jpg', (95, 85, 95, 85)),
+    'ornate-gold': ('ornate-gold.jpg', (50, 50, 50, 50)),
+    'ornate-brown': ('ornate-brown.jpg', (50, 50, 50, 50)),
+    'ornate-green': ('ornate-green.jpg', (80, 75, 80, 75)),
+    'futuristic': ('futuristic.jpg', (30, 30, 30, 30)),
+    'era': ('era.jpg', (20, 20, 20, 20)),
+    'red': ('red.jpg', (31, 31, 31, 31)),
+    'blue': ('blue.jpg', (26, 26, 26, 26)),
+    'light blue': ('light blue.jpg', (28, 28, 28, 28)),
+    'orange': ('orange.jpg', (28, 28, 28, 28)),
+    'purple': ('purple.jpg', (30, 30, 30, 30)),
+}
+
+# Thickness of the widest side of an asset frame, as a fraction of the image width
+FRAME_BORDER_RATIO = float(os.environ.get("FRAME_BORDER_RATIO", "0.07"))
+
+# Sliced frames cached per (style, width)
+FRAME_SLICE_CACHE_SIZE = int(os.environ.get("FRAME_SLICE_CACHE_SIZE", "64"))
+
+_assets = {}
+_assets_lock = threading.Lock()
+_slices = LRUCache(max_entries=FRAME_SLICE_CACHE_SIZE)
+
+
+def preload_frames():
+    """Decode every frame asset into memory; returns the number loaded."""
+    for style in FRAME_ASSETS:
+        _get_asset(style)
+    return len(_assets)
+
+
+def _get_asset(style):
+    asset = _assets.get(style)
+    if asset is None:
+        with _assets_lock:
+            asset = _assets.get(style)
+            if asset is None:
+                filename, _ = FRAME_ASSETS[style]
+                with Image.open(os.path.join(FRAMES_DIR, filename)) as source:
+                    asset = _assets[style] = source.convert('RGB')
+    return asset
+
+
+def _get_slices(style, width):
+    """Return the nine-slice pieces of an asset frame scaled for an image width."""
+    key = (style, width)
+    slices = _slices.get(key)
+    if slices is not None:
+        return slices
+
+    asset = _get_asset(style)
+    insets = FRAME_ASSETS[style][1]
+    scale = max(width * FRAME_BORDER_RATIO, 1) / max(insets)
+    scaled = asset.resize((max(round(asset.width * scale), 2), max(round(asset.height * scale), 2)),
+                          Image.LANCZOS)
+    left, top, right, bottom = [max(round(inset * scale), 1) for inset in insets]
+    sw, sh = scaled.size
+
+    slices = {
+        'insets': (left, top, right, bottom),
+        'corners': [
+            (scaled.crop((0, 0, left, top)), (0, 0)),
+            (scaled.crop((sw - right, 0, sw, top)), (left + width, 0)),
+            (scaled.crop((0, sh - bottom, left, sh)), (0, None)),
+            (scaled.crop((sw - right, sh - bottom, sw, sh)), (left + width, None)),
+        ],
+        # Horizontal edges only depend on the width, so they are stretched here once
+        'top': scaled.crop((left, 0, sw - right, top)).resize((width, top), Image.BILINEAR),
+        'bottom': scaled.crop((left, sh - bottom, sw - right, sh)).resize((width, bottom), Image.BILINEAR),
+        'left': scaled.crop((0, top, left, sh - bottom)),
+        'right': scaled.crop((sw - right, top, sw, sh - bottom)),
+    }
+    _slices.set(key, slices)
+    return slices
+
+
+def _nine_slice(img, style):
+    slices = _get_slices(style, img.width)
+    left, top, right, bottom = slices['insets']
+    framed = Image.new('RGB', (left + img.width + right, top + img.height + bottom))
+    framed.paste(img, (left, top))
+    framed.paste(slices['top'], (left, 0))
+    framed.paste(slices['bottom'], (left, top + img.height))
+    framed.paste(slices['left'].resize((left, img.height), Image.BILINEAR), (0, top))
+    framed.paste(slices['right'].resize((right, img.height), Image.BILINEAR), (left + img.width, top))
+    for corner, (x, y) in slices['corners']:
+        framed.paste(corner, (x, top + img.height if y is None else y))
+    return framed
+
+
+def _modern(img):
+    border = max(int(img.width * 0.02), 2)
+    framed = Image.new('RGB', (img.width + 2 * border, img.height + 2 * border), (33, 33, 33))
+    framed.paste(img, (border, border))
+    return framed
+
+
+def _polaroid(img):
+    side = max(int(img.width * 0.04), 4)
+    framed = Image.new('RGB', (img.width + 2 * side, img.height + side + side * 3), (250, 250, 248))
+    framed.paste(img, (side, side))
+    ImageDraw.Draw(framed).rectangle([(0, 0), (framed.width - 1, framed.height - 1)], outline=(220, 220, 220))
+    return framed
+
+
+def _shadow(img):
+    offset = max(int(img.width * 0.015), 3)
+    blur = offset * 2
+    margin = blur + offset
+    framed = Image.new('RGB', (img.width + 2 * margin, img.height + 2 * margin), (255, 255, 255))
+    # Blur a downscaled shadow mask; blurring at full size costs far more
+    factor = 4
+    mask = Image.new('L', (framed.width // factor, framed.height // factor), 0)
+    ImageDraw.Draw(mask).rectangle([((margin + offset) // factor, (margin + offset) // factor),
+                                    ((margin + offset + img.width) // factor,
+                                     (margin + offset + img.height) // factor)], fill=110)
+    mask = mask.filter(ImageFilter.GaussianBlur(max(blur // factor, 1))).resize(framed.size, Image.BILINEAR)
+    framed.paste((0, 0, 0), (0, 0, framed.width, framed.height), mask)
+    framed.paste(img, (margin, margin))
+    return framed
+
+
+_DRAWN = {'modern': _modern, 'polaroid': _polaroid, 'shadow': _shadow}
+
+
+def apply_frame(img, style):
+    """
+    Frame an RGB image in the given style.
+
+    Args:
+        img (PIL.Image.Image): The rendered photo and poem
+        style (str): A frame id from membership.get_available_frames, or None
+
+    Returns:
+        PIL.Image.Image: The framed image (img itself for 'none' and unknown styles)
+    """
+    if not style or style == 'none':
+        return img
+    if style in FRAME_ASSETS:
+        return _nine_slice(img, style)
+    if style in _DRAWN:
+        return _DRAWN[style](img)
+    logger.warning(f"Unknown frame style {style!r}, rendering without a frame")
+    return img
+
+
+def get_frame_cache_stats():
+    """Return the number of decoded assets and cached frame slices."""
+    return {
+        'assets': len(_assets),
+        'slice_entries': len(_slices),
+        'slice_evictions': _slices.evictions
+    }
@@ -0,0 +1,218 @@
+"""
+Shared outbound HTTP client for Poem Vision AI.
+
+Keeps one pooled requests.Session per upstream service (Vision, Gemini,
+SendGrid) so calls reuse keep-alive connections instead of paying a new TCP
+and TLS handshake each time, applies per-upstream timeouts and retry policies
+with jittered exponential backoff, and records per-upstream latency
+histograms and connection counts for the admin metrics endpoint.
+
+requests only speaks HTTP/1.1; the async pipeline's httpx client negotiates
+HTTP/2 when the h2 package is installed and reports into the same histograms.
+"""
+import os
+import time
+import bisect
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Connection pool sizing shared by every upstream session
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", "4"))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "20"))
+
+# Exponential backoff between retries: factor * 2**(retry - 1) seconds, plus up to `jitter` seconds
+HTTP_RETRY_BACKOFF = float(os.environ.get("HTTP_RETRY_BACKOFF", "0.3"))
+HTTP_RETRY_JITTER = float(os.environ.get("HTTP_RETRY_JITTER", "0.3"))
+
+
+def _upstream_config(name, read_timeout, retries, retry_statuses):
+    """Build an upstream config, letting HTTP_<NAME>_* environment variables override the defaults."""
+    prefix = f"HTTP_{name.upper()}_"
+    return {
+        'connect_timeout': float(os.environ.get(prefix + "CONNECT_TIMEOUT", "3.05")),
+        'read_timeout': float(os.environ.get(prefix + "READ_TIMEOUT", str(read_timeout))),
+        'retries': int(os.environ.get(prefix + "RETRIES", str(retries))),
+        'retry_statuses': retry_statuses
+    }
+
+
+# Per-upstream timeouts and retry policies. Connection failures are always
+# retried; read timeouts are not, since the request may already have been
+# processed. SendGrid only retries 429s because a 5xx may still have sent mail.
+UPSTREAMS = {
+    'vision': _upstream_config('vision', read_timeout=15, retries=2, retry_statuses=(429, 500, 502, 503, 504)),
+    'gemini': _upstream_config('gemini', read_timeout=15, retries=2, retry_statuses=(429, 500, 502, 503, 504)),
+    'sendgrid': _upstream_config('sendgrid', read_timeout=10, retries=2, retry_statuses=(429,)),
+}
+
+# Latency histogram bucket upper bounds in milliseconds
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+class LatencyHistogram:
+    """Thread-safe fixed-bucket latency histogram with status counters."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total_ms = 0.0
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, status):
+        elapsed_ms = seconds * 1000
+        index = bisect.bisect_left(self.buckets, elapsed_ms)
+        with self._lock:
+            self.counts[index] += 1
+            self.total_ms += elapsed_ms
+            self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+
+    def _percentile(self, fraction, count):
+        # Upper bound of the bucket containing the requested rank
+        rank = fraction * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return None
+
+    def stats(self):
+        with self._lock:
+            count = sum(self.counts)
+            buckets = {f"le_{bound}": n for bound, n in zip(self.buckets, self.counts)}
+            buckets['le_inf'] = self.counts[-1]
+            return {
+                'count': count,
+                'mean_ms': round(self.total_ms / count, 1) if count else 0.0,
+                'p50_ms': self._percentile(0.5, count) if count else None,
+                'p95_ms': self._percentile(0.95, count) if count else None,
+                'buckets': buckets,
+                'statuses': dict(self.statuses)
+            }
+
+
+def _make_retry(config):
+    options = dict(
+        total=config['retries'],
+        connect=config['retries'],
+        read=0,
+        status=config['retries'],
+        status_forcelist=config['retry_statuses'],
+        allowed_methods=frozenset(['GET', 'POST']),
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    try:
+        return Retry(backoff_jitter=HTTP_RETRY_JITTER, **options)
+    except TypeError:
+        # urllib3 < 2 has no built-in jitter
+        return Retry(**options)
+
+
+def get_session(upstream):
+    """
+    Return the pooled session for an upstream, creating it on first use.
+
+    Args:
+        upstream (str): One of the names in UPSTREAMS
+
+    Returns:
+        requests.Session: A session with pooled, retrying adapters mounted
+    """
+    session = _sessions.get(upstream)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(upstream)
+            if session is None:
+                config = UPSTREAMS[upstream]
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                      pool_maxsize=HTTP_POOL_MAXSIZE,
+                                      max_retries=_make_retry(config))
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _sessions[upstream] = session
+                logger.info(f"Created pooled HTTP session for {upstream} (pool_maxsize={HTTP_POOL_MAXSIZE})")
+    return session
+
+
+def get_timeout(upstream):
+    """Return the (connect, read) timeout tuple configured for an upstream."""
+    config = UPSTREAMS[upstream]
+    return (config['connect_timeout'], config['read_timeout'])
+
+
+def observe(upstream, seconds, status):
+    """Record the latency and outcome of a call to an upstream."""
+    histogram = _histograms.get(upstream)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(upstream, LatencyHistogram())
+    histogram.observe(seconds, status)
+
+
+def request(upstream, method, url, **kwargs):
+    """
+    Send a request to an upstream through its pooled session.
+
+    The upstream's timeout is used unless one is passed explicitly. Latency
+    and the response status (or exception name) are recorded either way.
+
+    Returns:
+        requests.Response: The response after any retries
+    """
+    kwargs.setdefault('timeout', get_timeout(upstream))
+    start = time.perf_counter()
+    try:
+        response = get_session(upstream).request(method, url, **kwargs)
+    except requests.exceptions.RequestException as e:
+        observe(upstream, time.perf_counter() - start, type(e).__name__)
+        raise
+    observe(upstream, time.perf_counter() - start, response.status_code)
+    return response
+
+
+def post(upstream, url, **kwargs):
+    """Send a POST request to an upstream; see request()."""
+    return request(upstream, 'POST', url, **kwargs)
+
+
+def _connection_stats(session):
+    # urllib3 counts new connections per host pool; fewer connections than
+    # requests means keep-alive connections are being reused
+    opened = 0
+    requests_sent = 0
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                requests_sent += pool.num_requests
+    return {'connections_opened': opened, 'requests_sent': requests_sent}
+
+
+def get_http_stats():
+    """Return latency histograms and connection reuse counters keyed by upstream."""
+    stats = {}
+    with _histograms_lock:
+        histograms = dict(_histograms)
+    for upstream, histogram in histograms.items():
+        stats[upstream] = {'latency': histogram.stats()}
+    for upstream, session in list(_sessions.items()):
+        stats.setdefault(upstream, {})['connections'] = _connection_stats(session)
+    return stats
@@ -1,5 +1,6 @@
 import os
 import io
+import asyncio
 import logging
 import random
 import requests
@@ -7,17 +8,47 @@ import base64
 import json
 import hashlib
 from PIL import Image, ImageStat
+from utils import http_client
 import time
 from functools import lru_cache
+from utils.cache import TieredCache, LRUCache
+from utils.perceptual_hash import (image_dhash, hash_to_hex, hex_to_hash, hash_chunks, hamming_distance,
+                                   MultiIndexHashIndex, STORED_CHUNK_LAYOUT, STORED_MAX_DISTANCE)
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# Basic (offline) analysis measures colors on a copy about this many pixels on the short side
+BASIC_ANALYSIS_SIZE = 256
+
 # Cache version to invalidate when needed
 ANALYSIS_CACHE_VERSION = "1.1"
 
-# Image analysis cache
-_analysis_cache = {}
+# Image analysis cache: bounded in-process LRU in front of the shared cache backend.
+# Entries are namespaced by ANALYSIS_CACHE_VERSION, so bumping it invalidates them all.
+ANALYSIS_CACHE_SIZE = int(os.environ.get("ANALYSIS_CACHE_SIZE", "256"))
+ANALYSIS_CACHE_TTL = int(os.environ.get("ANALYSIS_CACHE_TTL", str(30 * 24 * 3600)))
+_analysis_cache = TieredCache("analysis",
+                              max_entries=ANALYSIS_CACHE_SIZE,
+                              ttl=ANALYSIS_CACHE_TTL,
+                              version=ANALYSIS_CACHE_VERSION)
+
+# Near-duplicate reuse: an upload whose perceptual hash is within this many bits of a
+# previously analysed image reuses that analysis. Set to -1 to disable. Stored images
+# are searched up to STORED_MAX_DISTANCE bits; analyses made by this process up to any.
+PHASH_MATCH_THRESHOLD = int(os.environ.get("PHASH_MATCH_THRESHOLD", "4"))
+_phash_index = MultiIndexHashIndex(max_distance=max(PHASH_MATCH_THRESHOLD, 0))
+_phash_by_content = LRUCache(max_entries=ANALYSIS_CACHE_SIZE)
+_phash_stats = {'lookups': 0, 'matches': 0, 'errors': 0}
+
+# Optional callable(content_hash) -> analysis results, used when a near-duplicate
+# match is no longer in the analysis cache (for example after a restart)
+_analysis_loader = None
+
+# Optional callable(chunks) -> (phash hex, content hash) pairs of stored images that share
+# one of the (position, value) chunks of STORED_CHUNK_LAYOUT, so near-duplicates analysed
+# by other processes are found too
+_phash_candidate_loader = None
 
 # Google Vision API key - prioritize the dedicated API key environment variable
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY", "") or os.environ.get("GOOGLE_APPLICATION_CREDENTIALS", "")
@@ -32,6 +63,9 @@ else:
     VISION_API_AVAILABLE = False
     logger.warning("Google Cloud Vision API not available - using basic analysis only")
 
+# Vision API endpoint (overridable so tests and benchmarks can point at a local fake server)
+VISION_API_URL = os.environ.get("VISION_API_URL", "https://vision.googleapis.com/v1/images:annotate")
+
 def analyze_image(image_file):
     """
     Analyze an image using Google Cloud Vision AI with caching.
@@ -50,13 +84,10 @@ def analyze_image(image_file):
         # Read the image content
         content = image_file.read()
         
-        # Create a hash of the image content plus the version for cache lookup
-        content_hash = hashlib.md5(content + ANALYSIS_CACHE_VERSION.encode('utf-8')).hexdigest()
-        
-        # Check if we have this image in the cache
-        if content_hash in _analysis_cache:
-            logger.info(f"Using cached analysis result for image hash: {content_hash[:8]}...")
-            return _analysis_cache[content_hash]
+        # Check the exact and near-duplicate caches first
+        cached_results, content_hash, phash = lookup_cached_analysis(content)
+        if cached_results is not None:
+            return cached_results
         
         # If not in cache, perform the analysis
         if VISION_API_AVAILABLE == "REST":
@@ -68,8 +99,7 @@ def analyze_image(image_file):
             results = _analyze_image_basic(image_file)
         
         # Store the results in the cache before returning
-        _analysis_cache[content_hash] = results
-        logger.info(f"Stored analysis result in cache with key: {content_hash[:8]}...")
+        store_analysis(content_hash, phash, results)
         
         logger.debug(f"Image analysis results: {results}")
         return results
@@ -81,6 +111,159 @@ def analyze_image(image_file):
         results = _analyze_image_basic(image_file)
         return results
             
+def lookup_cached_analysis(image_content):
+    """
+    Look up analysis results for image bytes in the exact and near-duplicate caches.
+    
+    Args:
+        image_content: The binary content of the image file
+        
+    Returns:
+        tuple: (results or None, content hash, perceptual hash or None)
+    """
+    # Hash the image content for cache lookup (the cache namespaces keys by version)
+    content_hash = hashlib.sha256(image_content).hexdigest()
+    
+    # Check if we have this image in the local or shared cache
+    cached_results = _analysis_cache.get(content_hash)
+    if cached_results is not None:
+        logger.info(f"Using cached analysis result for image hash: {content_hash[:8]}...")
+        return cached_results, content_hash, None
+    
+    # Reuse the analysis of a perceptually near-identical image if we have one
+    phash = _compute_phash(image_content, content_hash)
+    if phash is not None and PHASH_MATCH_THRESHOLD >= 0:
+        similar_results = _find_similar_analysis(phash)
+        if similar_results is not None:
+            _analysis_cache.set(content_hash, similar_results)
+            return similar_results, content_hash, phash
+    
+    return None, content_hash, phash
+
+def is_reusable_analysis(results):
+    """
+    Check whether analysis results may be cached and reused for other uploads.
+    
+    Failures and basic-analysis fallbacks (e.g. during a Vision outage) are
+    never reused, so a transient error doesn't stick to an image and its
+    near-duplicates for the lifetime of the cache.
+    """
+    return bool(results) and '_error' not in results and not results.get('_fallback')
+
+def store_analysis(content_hash, phash, results):
+    """Cache fresh analysis results and index their perceptual hash (fallbacks are never cached)."""
+    if is_reusable_analysis(results):
+        _analysis_cache.set(content_hash, results)
+        logger.info(f"Stored analysis result in cache with key: {content_hash[:8]}...")
+        if phash is not None:
+            _phash_index.add(phash, content_hash)
+
+def get_image_phash(image_content):
+    """
+    Return the perceptual hash of an image as a hex string, or None if it can't be decoded.
+    
+    Hashes computed during analyze_image are memoized, so calling this for
+    the same upload afterwards does not decode the image again.
+    """
+    phash = _compute_phash(image_content, hashlib.sha256(image_content).hexdigest())
+    return hash_to_hex(phash) if phash is not None else None
+
+def set_analysis_loader(loader):
+    """Register a callable(content_hash) that loads persisted analysis results."""
+    global _analysis_loader
+    _analysis_loader = loader
+
+def set_phash_candidate_loader(loader):
+    """Register a callable(chunks) that loads stored perceptual hashes sharing a chunk with a query."""
+    global _phash_candidate_loader
+    _phash_candidate_loader = loader
+
+def get_phash_index_stats():
+    """Return match counters for the near-duplicate index (size counts hashes analysed by this process)."""
+    return dict(_phash_stats, size=len(_phash_index), threshold=PHASH_MATCH_THRESHOLD)
+
+def _compute_phash(image_content, content_hash):
+    """Compute (or fetch the memoized) integer dHash for image bytes."""
+    phash = _phash_by_content.get(content_hash)
+    if phash is None:
+        try:
+            phash = image_dhash(image_content)
+        except Exception as e:
+            _phash_stats['errors'] += 1
+            logger.warning(f"Could not compute perceptual hash: {str(e)}")
+            return None
+        _phash_by_content.set(content_hash, phash)
+    return phash
+
+def _similar_hashes(phash):
+    """Return (distance, content hash) of near-duplicates analysed here or stored, nearest first."""
+    matches = {content_hash: distance for distance, content_hash in _phash_index.search(phash, PHASH_MATCH_THRESHOLD)}
+    if _phash_candidate_loader is not None:
+        try:
+            candidates = _phash_candidate_loader(hash_chunks(phash, STORED_CHUNK_LAYOUT))
+        except Exception as e:
+            logger.warning(f"Could not load near-duplicate candidates: {str(e)}")
+            candidates = ()
+        radius = min(PHASH_MATCH_THRESHOLD, STORED_MAX_DISTANCE)
+        for phash_hex, content_hash in candidates:
+            distance = hamming_distance(phash, hex_to_hash(phash_hex))
+            if distance <= radius and distance < matches.get(content_hash, distance + 1):
+                matches[content_hash] = distance
+    return sorted((distance, content_hash) for content_hash, distance in matches.items())
+
+def _find_similar_analysis(phash):
+    """Return cached analysis results for the nearest indexed near-duplicate, if any."""
+    _phash_stats['lookups'] += 1
+    for distance, content_hash in _similar_hashes(phash):
+        results = _analysis_cache.get(content_hash)
+        if results is None and _analysis_loader is not None:
+            try:
+                results = _analysis_loader(content_hash)
+            except Exception as e:
+                logger.warning(f"Could not load analysis for {content_hash[:8]}: {str(e)}")
+                results = None
+            if is_reusable_analysis(results):
+                _analysis_cache.set(content_hash, results)
+        if is_reusable_analysis(results):
+            _phash_stats['matches'] += 1
+            logger.info(f"Reusing analysis of near-duplicate image {content_hash[:8]} (distance {distance})")
+            return results
+    return None
+
+VISION_FEATURES = [
+    {"type": "LABEL_DETECTION", "maxResults": 15},
+    {"type": "FACE_DETECTION", "maxResults": 10},
+    {"type": "OBJECT_LOCALIZATION", "maxResults": 15},
+    {"type": "LANDMARK_DETECTION", "maxResults": 5},
+    {"type": "IMAGE_PROPERTIES"},
+    {"type": "SAFE_SEARCH_DETECTION"}
+]
+
+# The annotate request around the image content, split where the base64 goes
+_VISION_BODY_HEAD, _VISION_BODY_TAIL = json.dumps(
+    {"requests": [{"image": {"content": "\0"}, "features": VISION_FEATURES}]}
+).encode('utf-8').split(b'\\u0000')
+
+def build_vision_request(image_content):
+    """
+    Build the Vision API annotate request body for an image.
+    
+    This is the only place an upload is base64-encoded. The encoded bytes are
+    spliced into the pre-serialized JSON (the base64 alphabet never needs
+    escaping), so the payload isn't copied into a str and through json.dumps.
+    
+    Args:
+        image_content: The binary content of the image file (any bytes-like object)
+        
+    Returns:
+        bytes: The JSON request body
+    """
+    return b''.join((_VISION_BODY_HEAD, base64.b64encode(image_content), _VISION_BODY_TAIL))
+
+def get_vision_api_url():
+    """Return the Vision API annotate URL including the API key."""
+    return f"{VISION_API_URL}?key={GOOGLE_API_KEY}"
+
 def _analyze_image_rest_api(image_content):
     """
     Analyze an image using the Google Cloud Vision REST API with an API key.
@@ -92,40 +275,21 @@ def _analyze_image_rest_api(image_content):
         dict: A dictionary containing the analysis results
     """
     try:
-        # Base64 encode the image
-        encoded_image = base64.b64encode(image_content).decode('utf-8')
-        
         # Prepare the request
-        request_data = {
-            "requests": [
-                {
-                    "image": {
-                        "content": encoded_image
-                    },
-                    "features": [
-                        {"type": "LABEL_DETECTION", "maxResults": 15},
-                        {"type": "FACE_DETECTION", "maxResults": 10},
-                        {"type": "OBJECT_LOCALIZATION", "maxResults": 15},
-                        {"type": "LANDMARK_DETECTION", "maxResults": 5},
-                        {"type": "IMAGE_PROPERTIES"},
-                        {"type": "SAFE_SEARCH_DETECTION"}
-                    ]
-                }
-            ]
-        }
+        body = build_vision_request(image_content)
         
         # Make the API request
-        url = f"https://vision.googleapis.com/v1/images:annotate?key={GOOGLE_API_KEY}"
+        url = get_vision_api_url()
         headers = {"Content-Type": "application/json"}
         
         # Log the request for debugging
-        logger.debug(f"Making Vision API request to: {url}")
+        logger.debug(f"Making Vision API request to: {VISION_API_URL}")
         logger.debug(f"Request headers: {headers}")
-        logger.debug(f"Request data length: {len(json.dumps(request_data))} characters")
+        logger.debug(f"Request body length: {len(body)} bytes")
         
         # Make the API request with a timeout
         try:
-            response = requests.post(url, headers=headers, json=request_data, timeout=15)
+            response = http_client.post('vision', url, headers=headers, data=body)
             
             # Process the results
             if response.status_code != 200:
@@ -135,7 +299,7 @@ def _analyze_image_rest_api(image_content):
             # Log the full response for debugging
             logger.debug(f"Vision API raw response: {response.text[:1000]}...")
         except requests.exceptions.Timeout:
-            logger.error("Vision API request timed out after 15 seconds")
+            logger.error(f"Vision API request timed out after {http_client.UPSTREAMS['vision']['read_timeout']} seconds")
             return _analyze_image_basic(io.BytesIO(image_content))
         except requests.exceptions.RequestException as e:
             logger.error(f"Vision API request exception: {str(e)}")
@@ -149,72 +313,7 @@ def _analyze_image_rest_api(image_content):
             logger.error(f"API returned error: {vision_data['error']}")
             return _analyze_image_basic(io.BytesIO(image_content))
         
-        # Extract the annotations
-        annotations = vision_data["responses"][0]
-        
-        # Process the results
-        results = {}
-        
-        # Process labels
-        results['labels'] = []
-        if 'labelAnnotations' in annotations:
-            for label in annotations['labelAnnotations']:
-                results['labels'].append({
-                    'description': label['description'],
-                    'score': round(label['score'] * 100, 2)
-                })
-        
-        # Process faces
-        results['faces'] = []
-        if 'faceAnnotations' in annotations:
-            for face in annotations['faceAnnotations']:
-                results['faces'].append({
-                    'joy': face['joyLikelihood'],
-                    'sorrow': face['sorrowLikelihood'],
-                    'anger': face['angerLikelihood'],
-                    'surprise': face['surpriseLikelihood'],
-                    'headwear': face.get('headwearLikelihood', 'UNKNOWN')
-                })
-        
-        # Process objects
-        results['objects'] = []
-        if 'localizedObjectAnnotations' in annotations:
-            for obj in annotations['localizedObjectAnnotations']:
-                results['objects'].append({
-                    'name': obj['name'],
-                    'score': round(obj['score'] * 100, 2)
-                })
-        
-        # Process landmarks
-        results['landmarks'] = []
-        if 'landmarkAnnotations' in annotations:
-            for landmark in annotations['landmarkAnnotations']:
-                results['landmarks'].append({
-                    'description': landmark['description'],
-                    'score': round(landmark['score'] * 100, 2)
-                })
-        
-        # Process image properties (colors)
-        results['colors'] = []
-        if 'imagePropertiesAnnotation' in annotations:
-            colors = annotations['imagePropertiesAnnotation']['dominantColors']['colors']
-            for color in colors[:5]:  # Top 5 colors
-                rgb = color['color']
-                hex_color = f'#{rgb.get("red", 0):02x}{rgb.get("green", 0):02x}{rgb.get("blue", 0):02x}'
-                results['colors'].append({
-                    'hex': hex_color,
-                    'score': round(color['score'] * 100, 2)
-                })
-        
-        # Process safe search
-        if 'safeSearchAnnotation' in annotations:
-            ss = annotations['safeSearchAnnotation']
-            results['safe_search'] = {
-                'adult': ss.get('adult', 'UNKNOWN'),
-                'medical': ss.get('medical', 'UNKNOWN'),
-                'violence': ss.get('violence', 'UNKNOWN')
-            }
-        
+        results = parse_vision_response(vision_data)
         logger.debug(f"Image analysis results: {results}")
         return results
     
@@ -223,6 +322,148 @@ def _analyze_image_rest_api(image_content):
         # If there's an error with the Vision API, fall back to basic analysis
         return _analyze_image_basic(io.BytesIO(image_content))
 
+async def analyze_image_async(image_content, client):
+    """
+    Asynchronous variant of analyze_image used by the single-request pipeline.
+    
+    Shares the exact and near-duplicate caches with analyze_image; CPU-bound
+    steps (hashing, base64 encoding, basic analysis) run in the event loop's
+    executor so they don't stall other in-flight requests.
+    
+    Args:
+        image_content: The binary content of the image file
+        client: An httpx.AsyncClient used for the Vision API request
+        
+    Returns:
+        dict: A dictionary containing the analysis results
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        cached_results, content_hash, phash = await loop.run_in_executor(None, lookup_cached_analysis, image_content)
+        if cached_results is not None:
+            return cached_results
+        
+        if VISION_API_AVAILABLE == "REST":
+            results = await _analyze_image_rest_api_async(image_content, client)
+        else:
+            logger.warning("Google Cloud Vision API not available. Using basic analysis.")
+            results = await loop.run_in_executor(None, _analyze_image_basic, io.BytesIO(image_content))
+        
+        store_analysis(content_hash, phash, results)
+        return results
+    
+    except Exception as e:
+        logger.error(f"Error analyzing image: {str(e)}", exc_info=True)
+        return await loop.run_in_executor(None, _analyze_image_basic, io.BytesIO(image_content))
+
+async def _analyze_image_rest_api_async(image_content, client):
+    """Call the Vision REST API with an async client, falling back to basic analysis on failure."""
+    loop = asyncio.get_running_loop()
+    
+    # Encoding a multi-megabyte image is CPU work, keep it off the event loop
+    body = await loop.run_in_executor(None, build_vision_request, image_content)
+    
+    start = time.perf_counter()
+    try:
+        response = await client.post(get_vision_api_url(),
+                                     content=body,
+                                     headers={"Content-Type": "application/json"},
+                                     timeout=http_client.UPSTREAMS['vision']['read_timeout'])
+    except Exception as e:
+        http_client.observe('vision', time.perf_counter() - start, type(e).__name__)
+        logger.error(f"Vision API request failed ({type(e).__name__}): {str(e)}")
+        return await loop.run_in_executor(None, _analyze_image_basic, io.BytesIO(image_content))
+    http_client.observe('vision', time.perf_counter() - start, response.status_code)
+    
+    if response.status_code != 200:
+        logger.error(f"API error: {response.status_code} - {response.text[:200]}")
+        return await loop.run_in_executor(None, _analyze_image_basic, io.BytesIO(image_content))
+    
+    vision_data = response.json()
+    if 'error' in vision_data:
+        logger.error(f"API returned error: {vision_data['error']}")
+        return await loop.run_in_executor(None, _analyze_image_basic, io.BytesIO(image_content))
+    
+    return parse_vision_response(vision_data)
+
+def parse_vision_response(vision_data):
+    """
+    Convert a Vision API annotate response into our analysis results format.
+    
+    Args:
+        vision_data (dict): The parsed JSON response from the Vision API
+        
+    Returns:
+        dict: A dictionary containing the analysis results
+    """
+    # Extract the annotations
+    annotations = vision_data["responses"][0]
+    
+    # Process the results
+    results = {}
+    
+    # Process labels
+    results['labels'] = []
+    if 'labelAnnotations' in annotations:
+        for label in annotations['labelAnnotations']:
+            results['labels'].append({
+                'description': label['description'],
+                'score': round(label['score'] * 100, 2)
+            })
+    
+    # Process faces
+    results['faces'] = []
+    if 'faceAnnotations' in annotations:
+        for face in annotations['faceAnnotations']:
+            results['faces'].append({
+                'joy': face['joyLikelihood'],
+                'sorrow': face['sorrowLikelihood'],
+                'anger': face['angerLikelihood'],
+                'surprise': face['surpriseLikelihood'],
+                'headwear': face.get('headwearLikelihood', 'UNKNOWN')
+            })
+    
+    # Process objects
+    results['objects'] = []
+    if 'localizedObjectAnnotations' in annotations:
+        for obj in annotations['localizedObjectAnnotations']:
+            results['objects'].append({
+                'name': obj['name'],
+                'score': round(obj['score'] * 100, 2)
+            })
+    
+    # Process landmarks
+    results['landmarks'] = []
+    if 'landmarkAnnotations' in annotations:
+        for landmark in annotations['landmarkAnnotations']:
+            results['landmarks'].append({
+                'description': landmark['description'],
+                'score': round(landmark['score'] * 100, 2)
+            })
+    
+    # Process image properties (colors)
+    results['colors'] = []
+    if 'imagePropertiesAnnotation' in annotations:
+        colors = annotations['imagePropertiesAnnotation']['dominantColors']['colors']
+        for color in colors[:5]:  # Top 5 colors
+            rgb = color['color']
+            hex_color = f'#{rgb.get("red", 0):02x}{rgb.get("green", 0):02x}{rgb.get("blue", 0):02x}'
+            results['colors'].append({
+                'hex': hex_color,
+                'score': round(color['score'] * 100, 2)
+            })
+    
+    # Process safe search
+    if 'safeSearchAnnotation' in annotations:
+        ss = annotations['safeSearchAnnotation']
+        results['safe_search'] = {
+            'adult': ss.get('adult', 'UNKNOWN'),
+            'medical': ss.get('medical', 'UNKNOWN'),
+            'violence': ss.get('violence', 'UNKNOWN')
+        }
+    
+    return results
+
 def _analyze_image_basic(image_file):
     """
     Basic image analysis using PIL when the Vision API is not available.
@@ -242,8 +483,16 @@ def _analyze_image_basic(image_file):
         format_type = image.format
         mode = image.mode
         
+        # The average color doesn't need full resolution: decode JPEGs at a
+        # reduced DCT scale and shrink everything else before measuring
+        image.draft('RGB', (BASIC_ANALYSIS_SIZE, BASIC_ANALYSIS_SIZE))
+        image = image.convert('RGB')
+        factor = min(image.width, image.height) // BASIC_ANALYSIS_SIZE
+        if factor > 1:
+            image = image.reduce(factor)
+
         # Calculate basic color statistics using ImageStat
-        stat = ImageStat.Stat(image.convert('RGB'))
+        stat = ImageStat.Stat(image)
         avg_color = stat.mean
         
         # Convert RGB averages to hex
@@ -295,6 +544,9 @@ def _analyze_image_basic(image_file):
                 'score': round(score, 2)
             })
         
+        # Marks the results as a stand-in for Vision, so they are never cached
+        results['_fallback'] = True
+        
         logger.debug(f"Basic image analysis results: {results}")
         return results
         
@@ -314,4 +566,4 @@ def _analyze_image_basic(image_file):
                 {'hex': '#7f7f7f', 'score': 100.0}  # Medium gray
             ],
             '_error': str(e)
-        }
\ No newline at end of file
+        }
@@ -0,0 +1,135 @@
+"""
+Upload normalization for Poem Vision AI.
+
+Every uploaded photo is decoded once at ingest. It is rotated upright from its
+EXIF orientation, capped to UPLOAD_MAX_EDGE on its long side and re-encoded
+without EXIF/XMP metadata. The normalized bytes are what gets analyzed, hashed,
+stored and rendered, so later stages never see a 12 MP original or have to
+transpose it again, and the Vision request carries a much smaller payload.
+"""
+import io
+import os
+import logging
+import threading
+from PIL import Image, ImageCms
+from utils.renderer import decode_for_size, oriented_size, RESAMPLE_REDUCING_GAP
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Longest side of a stored upload; Vision labels are no better on larger images
+UPLOAD_MAX_EDGE = int(os.environ.get("UPLOAD_MAX_EDGE", "2048"))
+
+# Output format ("JPEG" or "WEBP") and encoder quality of normalized uploads
+UPLOAD_FORMAT = os.environ.get("UPLOAD_FORMAT", "JPEG").upper()
+UPLOAD_QUALITY = int(os.environ.get("UPLOAD_QUALITY", "88"))
+
+_stats_lock = threading.Lock()
+_ingest_stats = {'uploads': 0, 'passthrough': 0, 'bytes_in': 0, 'bytes_out': 0, 'rejected': 0}
+
+
+def _needs_reencode(img, width, height):
+    """Whether an opened upload differs from what normalization would produce."""
+    if img.format != UPLOAD_FORMAT or max(width, height) > UPLOAD_MAX_EDGE:
+        return True
+    if img.mode not in ('RGB', 'L'):
+        return True
+    return bool(img.getexif()) or any(key in img.info for key in ('xmp', 'comment'))
+
+
+def _to_rgb(img):
+    """Flatten transparency onto white and convert to RGB."""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB') if img.mode != 'RGB' else img
+
+
+def _profile_space(icc_profile):
+    """Return the colour space of an ICC profile ('RGB', 'CMYK', 'GRAY'), or None if it can't be read."""
+    try:
+        return ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)).profile.xcolor_space.strip()
+    except (OSError, ImageCms.PyCMSError):
+        return None
+
+
+def _to_srgb(img, icc_profile):
+    """Convert a CMYK or grayscale image to sRGB through its embedded profile."""
+    if img.mode not in ('CMYK', 'L'):
+        return img
+    try:
+        return ImageCms.profileToProfile(img, ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)),
+                                         ImageCms.createProfile('sRGB'), outputMode='RGB')
+    except (OSError, ValueError, ImageCms.PyCMSError) as e:
+        logger.warning(f"Could not apply {img.mode} colour profile, converting without it: {e}")
+        return img
+
+
+def normalize_upload(source):
+    """
+    Decode an upload once and return it upright, size-capped and metadata-free.
+
+    Uploads that are already in the normalized form are returned unchanged, so
+    re-uploading a stored image doesn't re-encode (and degrade) it. A file is
+    decoded straight from disk (e.g. a spooled multipart upload), so the raw
+    upload is only read into memory if it is kept as is.
+
+    Args:
+        source (bytes or file): The uploaded image, as bytes or a seekable binary file
+
+    Returns:
+        bytes: The normalized image
+
+    Raises:
+        ValueError: If the upload is not an image Pillow can decode
+    """
+    stream = io.BytesIO(source) if isinstance(source, bytes) else source
+    stream.seek(0, os.SEEK_END)
+    size_in = stream.tell()
+    stream.seek(0)
+    try:
+        img = Image.open(stream)
+        width, height = oriented_size(img)
+        passthrough = not _needs_reencode(img, width, height)
+        if passthrough:
+            # verify() doesn't decode JPEG scan data; a full decode rejects truncated files
+            img.load()
+            stream.seek(0)
+            normalized = source if isinstance(source, bytes) else stream.read()
+        else:
+            scale = min(1.0, UPLOAD_MAX_EDGE / max(width, height))
+            size = (max(round(width * scale), 1), max(round(height * scale), 1))
+            icc_profile = img.info.get('icc_profile')
+            img = decode_for_size(img, *size)
+            if icc_profile and _profile_space(icc_profile) != 'RGB':
+                # A CMYK or gray profile doesn't describe the RGB output, so apply it instead of keeping it
+                img = _to_srgb(img, icc_profile)
+                icc_profile = None
+            img = _to_rgb(img)
+            if img.size != size:
+                img = img.resize(size, Image.LANCZOS, reducing_gap=RESAMPLE_REDUCING_GAP)
+            output = io.BytesIO()
+            # Only an RGB colour profile is carried over; EXIF (GPS, camera, orientation) is dropped
+            img.save(output, format=UPLOAD_FORMAT, quality=UPLOAD_QUALITY, icc_profile=icc_profile)
+            normalized = output.getvalue()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        with _stats_lock:
+            _ingest_stats['rejected'] += 1
+        raise ValueError(f"Unsupported or corrupt image: {e}") from e
+
+    with _stats_lock:
+        _ingest_stats['uploads'] += 1
+        _ingest_stats['passthrough'] += passthrough
+        _ingest_stats['bytes_in'] += size_in
+        _ingest_stats['bytes_out'] += len(normalized)
+    logger.info(f"Normalized upload {width}x{height} ({size_in/1024:.1f} KB) "
+                f"to {len(normalized)/1024:.1f} KB")
+    return normalized
+
+
+def get_ingest_stats():
+    """Return counters for normalized uploads and the bytes they saved."""
+    with _stats_lock:
+        return dict(_ingest_stats)
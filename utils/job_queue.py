@@ -0,0 +1,228 @@
+"""
+Database-backed background job queue for Poem Vision AI.
+
+Routes enqueue slow work (LLM calls, image rendering) as Job rows and return
+a job id straight away. One or more `flask run-worker` processes claim queued
+jobs with an atomic conditional UPDATE, so several workers can share the
+queue on SQLite or PostgreSQL without running a job twice.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from models import db, Job
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# A running job that hasn't finished after this many seconds is assumed to
+# belong to a dead worker and is requeued (up to JOB_MAX_ATTEMPTS times)
+JOB_STALE_AFTER = int(os.environ.get("JOB_STALE_AFTER", "300"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+
+# Registered job handlers: job_type -> callable(payload) -> JSON-serializable result
+_handlers = {}
+
+
+def job_handler(job_type):
+    """Decorator registering a function as the handler for a job type."""
+    def decorator(func):
+        _handlers[job_type] = func
+        return func
+    return decorator
+
+
+def make_idempotency_key(job_type, *parts):
+    """Derive a stable idempotency key from a job type and its inputs."""
+    data = json.dumps([job_type] + list(parts), sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def enqueue(job_type, payload, idempotency_key=None, reuse_finished=True, user_id=None, creation_id=None):
+    """
+    Queue a job, or return the existing job with the same idempotency key.
+
+    Args:
+        job_type (str): A registered job type
+        payload (dict): JSON-serializable handler arguments
+        idempotency_key (str, optional): Key identifying duplicate submissions
+        reuse_finished (bool): If True, a succeeded job with the same key is
+            returned as well; if False, only queued or running jobs are reused
+            (so a later, deliberate resubmission runs again)
+        user_id (int, optional): Owner of the job
+        creation_id (int, optional): Creation the job works on
+
+    Returns:
+        tuple: (job, created) where created is False for a deduplicated job
+    """
+    if idempotency_key:
+        statuses = ['queued', 'running', 'succeeded'] if reuse_finished else ['queued', 'running']
+        existing = Job.query.filter(
+            Job.idempotency_key == idempotency_key,
+            Job.job_type == job_type,
+            Job.status.in_(statuses)
+        ).order_by(Job.created_at.desc()).first()
+        if existing:
+            logger.info(f"Reusing job {existing.id} for idempotency key {idempotency_key[:12]}...")
+            return existing, False
+
+    job = Job(id=str(uuid.uuid4()),
+              job_type=job_type,
+              status='queued',
+              payload=payload,
+              idempotency_key=idempotency_key,
+              user_id=user_id,
+              creation_id=creation_id)
+    db.session.add(job)
+    db.session.commit()
+    logger.info(f"Queued {job_type} job {job.id}")
+    return job, True
+
+
+def claim_next_job(worker_id):
+    """
+    Atomically claim the oldest queued job for a worker.
+
+    Returns:
+        Job: The claimed job, or None if the queue is empty
+    """
+    candidates = db.session.query(Job.id).filter(
+        Job.status == 'queued'
+    ).order_by(Job.created_at.asc()).limit(10).all()
+
+    for (job_id,) in candidates:
+        # Only one worker's UPDATE can match while the job is still queued
+        claimed = Job.query.filter(Job.id == job_id, Job.status == 'queued').update({
+            'status': 'running',
+            'locked_by': worker_id,
+            'started_at': datetime.utcnow(),
+            'attempts': Job.attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+    return None
+
+
+def requeue_stale_jobs():
+    """Requeue (or fail) running jobs whose worker appears to have died."""
+    cutoff = datetime.utcnow() - timedelta(seconds=JOB_STALE_AFTER)
+    stale = Job.query.filter(Job.status == 'running', Job.started_at < cutoff).all()
+    for job in stale:
+        logger.warning(f"Job {job.id} on worker {job.locked_by} is stale (attempt {job.attempts})")
+        if (job.attempts or 0) >= JOB_MAX_ATTEMPTS:
+            job.status = 'failed'
+            job.error = 'Job timed out'
+            job.finished_at = datetime.utcnow()
+        else:
+            job.status = 'queued'
+            job.locked_by = None
+    if stale:
+        db.session.commit()
+    return len(stale)
+
+
+def run_job(job):
+    """Run a claimed job's handler and record its result or error."""
+    job_id = job.id
+    handler = _handlers.get(job.job_type)
+    start = time.time()
+    try:
+        if handler is None:
+            raise ValueError(f"No handler registered for job type {job.job_type}")
+        result = handler(job.payload or {})
+        job = db.session.get(Job, job_id)
+        job.status = 'succeeded'
+        job.result = result
+        logger.info(f"Job {job_id} ({job.job_type}) succeeded in {time.time() - start:.2f}s")
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.status = 'failed'
+        job.error = str(e)
+        logger.error(f"Job {job_id} ({job.job_type}) failed: {str(e)}", exc_info=True)
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    return job
+
+
+def run_worker(poll_interval=0.5, burst=False, worker_id=None):
+    """
+    Process jobs until interrupted (or until the queue is empty in burst mode).
+
+    Must be called inside an application context.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    logger.info(f"Job worker {worker_id} started (handlers: {', '.join(sorted(_handlers))})")
+    last_stale_check = 0
+    processed = 0
+
+    while True:
+        if time.time() - last_stale_check > 30:
+            requeue_stale_jobs()
+            last_stale_check = time.time()
+
+        job = claim_next_job(worker_id)
+        if job is None:
+            if burst:
+                break
+            # Release the connection while idle
+            db.session.remove()
+            time.sleep(poll_interval)
+            continue
+
+        run_job(job)
+        processed += 1
+        # Start each job with a clean session so no state leaks between jobs
+        db.session.remove()
+
+    logger.info(f"Job worker {worker_id} processed {processed} jobs")
+    return processed
+
+
+def stream_job_events(job_id, serialize, timeout=60, interval=0.5):
+    """
+    Yield server-sent events for a job until it finishes or the timeout passes.
+
+    Args:
+        job_id (str): The job to follow
+        serialize (callable): Converts a Job into the dict sent to the client
+        timeout (float): Maximum seconds to keep the stream open
+        interval (float): Seconds between status checks
+
+    Yields:
+        str: SSE-formatted messages ("status" events, then a final "result")
+    """
+    deadline = time.time() + timeout
+    last_status = None
+
+    while True:
+        db.session.expire_all()
+        job = db.session.get(Job, job_id)
+        if job is None:
+            yield f"event: error\ndata: {json.dumps({'error': 'Job not found'})}\n\n"
+            return
+
+        data = serialize(job)
+        finished = job.is_finished
+        # Don't hold a pooled connection between polls
+        db.session.close()
+
+        if finished:
+            yield f"event: result\ndata: {json.dumps(data)}\n\n"
+            return
+        if data['status'] != last_status:
+            last_status = data['status']
+            yield f"event: status\ndata: {json.dumps(data)}\n\n"
+        else:
+            # Comment line keeps proxies from closing an idle stream
+            yield ": keep-alive\n\n"
+
+        if time.time() >= deadline:
+            yield f"event: timeout\ndata: {json.dumps(data)}\n\n"
+            return
+        time.sleep(interval)
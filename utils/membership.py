@@ -176,12 +176,20 @@ def cancel_membership(user_id):
         }
 
 
-def get_user_creations(user_id, limit=10):
-    """Get a list of creations for a specific user."""
+def get_user_creations(user_id, limit=10, include_payload=False):
+    """
+    Get a list of creations for a specific user.
+
+    Image and analysis payload columns are deferred unless include_payload is set.
+    """
     from models import Creation
+    from sqlalchemy.orm import undefer_group
 
     try:
-        creations = Creation.query.filter_by(user_id=user_id).order_by(
+        query = Creation.query.filter_by(user_id=user_id)
+        if include_payload:
+            query = query.options(undefer_group('payload'))
+        creations = query.order_by(
             Creation.created_at.desc()).limit(limit).all()
         return creations
     except Exception as e:
@@ -0,0 +1,172 @@
+"""
+Perceptual hashing for Poem Vision AI.
+
+Computes 64-bit difference hashes (dHash) of images so that re-encoded,
+resized or lightly edited copies of the same photo hash to nearby values,
+and provides a multi-index hash table for finding all stored hashes within
+a small Hamming distance of a query hash. The same chunking is used to keep
+the index in the database (see models.ImageHashChunk).
+"""
+import io
+import logging
+import threading
+from PIL import Image, ImageOps
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# dHash grid size: hash_size x hash_size comparisons gives a hash_size**2-bit hash
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def hamming_distance(a, b):
+    """Return the number of differing bits between two integer hashes."""
+    return bin(a ^ b).count("1")
+
+
+def dhash(image, hash_size=HASH_SIZE):
+    """
+    Compute the difference hash of a PIL image.
+
+    The image is reduced to a (hash_size + 1) x hash_size grayscale grid and
+    each bit records whether a pixel is brighter than its right neighbour.
+
+    Args:
+        image: A PIL Image
+        hash_size (int): Grid size; the hash has hash_size**2 bits
+
+    Returns:
+        int: The hash as an unsigned integer
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def image_dhash(image_bytes, hash_size=HASH_SIZE):
+    """
+    Compute the difference hash of encoded image bytes.
+
+    JPEGs are decoded at reduced scale via draft mode, since only a tiny
+    grayscale thumbnail is needed.
+
+    Args:
+        image_bytes (bytes): Encoded image data
+        hash_size (int): Grid size; the hash has hash_size**2 bits
+
+    Returns:
+        int: The hash as an unsigned integer
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img.draft("L", (hash_size * 8, hash_size * 8))
+        img = ImageOps.exif_transpose(img)
+        return dhash(img, hash_size)
+
+
+def chunk_layout(max_distance, bits=HASH_BITS):
+    """
+    Split a hash into max_distance + 1 disjoint bit chunks of near-equal width.
+
+    Returns:
+        list: (shift, mask) pairs, one per chunk
+    """
+    if max_distance < 0 or max_distance >= bits:
+        raise ValueError(f"max_distance must be between 0 and {bits - 1}")
+    chunk_count = max_distance + 1
+    layout = []
+    start = 0
+    for i in range(chunk_count):
+        width = bits // chunk_count + (1 if i < bits % chunk_count else 0)
+        layout.append((start, (1 << width) - 1))
+        start += width
+    return layout
+
+
+def hash_chunks(hash_value, layout):
+    """Return the (position, chunk value) pairs of a hash under a chunk_layout()."""
+    return [(position, (hash_value >> shift) & mask) for position, (shift, mask) in enumerate(layout)]
+
+
+def hash_to_hex(value, bits=HASH_BITS):
+    """Format an integer hash as a fixed-width hex string for storage."""
+    return format(value, f"0{bits // 4}x")
+
+
+def hex_to_hash(value):
+    """Parse a hex hash string produced by hash_to_hex."""
+    return int(value, 16)
+
+
+# Chunking of the index kept in the database, which supports searches up to this radius.
+# Changing it invalidates the stored chunks.
+STORED_MAX_DISTANCE = 4
+STORED_CHUNK_LAYOUT = chunk_layout(STORED_MAX_DISTANCE)
+
+
+class MultiIndexHashIndex:
+    """
+    Index of fixed-width hashes supporting Hamming-radius search.
+
+    Each hash is split into max_distance + 1 disjoint bit chunks and every
+    chunk is indexed in its own table. By the pigeonhole principle any hash
+    within max_distance bits of a query matches it exactly on at least one
+    chunk, so a search only has to verify the hashes sharing a chunk with the
+    query instead of scanning the whole index. At 64 bits and a radius of 4
+    each chunk is 12-13 bits wide, which keeps candidate lists short even
+    with hundreds of thousands of hashes.
+    """
+
+    def __init__(self, max_distance=4, bits=HASH_BITS):
+        self._chunks = chunk_layout(max_distance, bits)
+        self.max_distance = max_distance
+        self.bits = bits
+
+        self._tables = [{} for _ in self._chunks]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def add(self, hash_value, value):
+        """Index a hash, associating it with value (replacing any previous value)."""
+        with self._lock:
+            if hash_value not in self._values:
+                for table, (shift, mask) in zip(self._tables, self._chunks):
+                    table.setdefault((hash_value >> shift) & mask, []).append(hash_value)
+            self._values[hash_value] = value
+
+    def search(self, hash_value, max_distance=None):
+        """
+        Find indexed hashes within max_distance bits of hash_value.
+
+        Args:
+            hash_value (int): The query hash
+            max_distance (int): Search radius, at most the index's max_distance
+
+        Returns:
+            list: (distance, value) tuples sorted from nearest to farthest
+        """
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+
+        matches = []
+        seen = set()
+        with self._lock:
+            for table, (shift, mask) in zip(self._tables, self._chunks):
+                for candidate in table.get((hash_value >> shift) & mask, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    distance = hamming_distance(hash_value, candidate)
+                    if distance <= max_distance:
+                        matches.append((distance, self._values[candidate]))
+
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+    def __len__(self):
+        return len(self._values)
@@ -3,7 +3,10 @@ import logging
 import requests
 import json
 import random
+import time
 import hashlib
+from utils import http_client
+from utils.cache import TieredCache
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -11,16 +14,42 @@ logger = logging.getLogger(__name__)
 # Template version to invalidate cache when templates change
 TEMPLATE_VERSION = "2.8"  # Updated to generate only a single pickup line with simplified templates
 
-# Poem generation cache
-_poem_cache = {}
+# Generated poem cache: bounded in-process LRU in front of the shared cache backend.
+# Entries are namespaced by TEMPLATE_VERSION, so bumping it invalidates them all.
+POEM_CACHE_SIZE = int(os.environ.get("POEM_CACHE_SIZE", "1024"))
+POEM_CACHE_TTL = int(os.environ.get("POEM_CACHE_TTL", str(7 * 24 * 3600)))
+_poem_cache = TieredCache("poem",
+                          max_entries=POEM_CACHE_SIZE,
+                          ttl=POEM_CACHE_TTL,
+                          version=TEMPLATE_VERSION)
+
+# Negative cache for template poems served because the Gemini API failed. Entries
+# live briefly and stay in-process, so a burst of identical requests during an
+# outage doesn't wait on the API again and again, but the API is retried soon after.
+POEM_FALLBACK_CACHE_SIZE = int(os.environ.get("POEM_FALLBACK_CACHE_SIZE", "256"))
+POEM_FALLBACK_TTL = int(os.environ.get("POEM_FALLBACK_TTL", "60"))
+_poem_fallback_cache = TieredCache("poem_fallback",
+                                   max_entries=POEM_FALLBACK_CACHE_SIZE,
+                                   ttl=POEM_FALLBACK_TTL,
+                                   version=TEMPLATE_VERSION,
+                                   backend=None)
 
 # Get the API key from environment variable
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")
 # Update to use the correct API endpoint 
 # The API might have changed, so we provide both v1beta and v1 endpoints
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+# (both overridable so tests and benchmarks can point at a local fake server)
+GEMINI_API_URL = os.environ.get(
+    "GEMINI_API_URL",
+    "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent")
 # Fallback URL if the main one doesn't work
-GEMINI_API_URL_FALLBACK = "https://generativelanguage.googleapis.com/v1/models/gemini-2.0-flash:generateContent"
+GEMINI_API_URL_FALLBACK = os.environ.get(
+    "GEMINI_API_URL_FALLBACK",
+    "https://generativelanguage.googleapis.com/v1/models/gemini-2.0-flash:generateContent")
+# Streaming endpoint used by stream_poem (server-sent events with alt=sse)
+GEMINI_STREAM_URL = os.environ.get(
+    "GEMINI_STREAM_URL",
+    GEMINI_API_URL.replace(":generateContent", ":streamGenerateContent"))
 
 # Poem length configurations
 POEM_LENGTHS = {
@@ -414,44 +443,24 @@ def generate_poem(analysis_results, poem_type, poem_length, emphasis, custom_ter
     logger.info(f"Generating poem of type: '{poem_type}', length: '{poem_length}'")
     if poem_type.lower() in ['pickup', 'flirt']:
         logger.info("PICKUP LINE detected - Will generate hilarious pickup lines")
+    cache_key = None
     try:
         # Create a unique cache key based on all inputs
-        # First, convert emphasis list to a stable string representation
-        emphasis_str = ','.join(sorted(emphasis)) if emphasis else 'none'
-
-        # Create a simplified version of analysis_results that contains only the essential elements
-        # This makes the cache key more stable across similar images
-        simple_analysis = {}
-        if 'labels' in analysis_results:
-            simple_analysis['labels'] = [label['description'] for label in analysis_results['labels'][:5]]
-        if 'objects' in analysis_results:
-            simple_analysis['objects'] = [obj['name'] for obj in analysis_results['objects'][:5]]
-
-        # Create a hash of all the inputs
-        cache_key_data = {
-            'analysis': simple_analysis,
-            'poem_type': poem_type,
-            'poem_length': poem_length,
-            'emphasis': emphasis_str,
-            'custom_terms': custom_terms,
-            'custom_category': custom_category,
-            'template_version': TEMPLATE_VERSION  # Add version to invalidate cache when templates change
-        }
-
-        # Convert to string and hash
-        cache_key = hashlib.md5(json.dumps(cache_key_data, sort_keys=True).encode('utf-8')).hexdigest()
+        cache_key = make_poem_cache_key(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
 
         # Check if we have a cached poem for this input
-        if not is_regeneration and cache_key in _poem_cache:
-            logger.info(f"Using cached poem for key: {cache_key[:8]}...")
-            return _poem_cache[cache_key]
+        if not is_regeneration:
+            cached_poem = get_cached_poem(cache_key)
+            if cached_poem is not None:
+                logger.info(f"Using cached poem for key: {cache_key[:8]}...")
+                return cached_poem
 
         # Check if API key is available
         if not GEMINI_API_KEY:
             logger.warning("Gemini API key not found in environment variables. Using template poem.")
             poem = _generate_template_poem(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
             # Store in cache before returning
-            _poem_cache[cache_key] = poem
+            cache_poem(cache_key, poem)
             return poem
 
         # Create a detailed prompt based on the analysis and user preferences
@@ -462,53 +471,27 @@ def generate_poem(analysis_results, poem_type, poem_length, emphasis, custom_ter
         headers = {
             "Content-Type": "application/json",
         }
-
-        # Specifically tune parameters for poetry:
-        # - Increased temperature for more creative language
-        # - Higher topK to consider more diverse word choices
-        # - Slightly reduced topP to focus on more likely language constructs for poetry
-        # - Increased maxOutputTokens to allow for longer, more expressive poems
-        data = {
-            "contents": [{
-                "parts": [{
-                    "text": prompt
-                }]
-            }],
-            "generationConfig": {
-                "temperature": 0.85,  
-                "topK": 60,           
-                "topP": 0.92,        
-                "maxOutputTokens": 1000, 
-                "stopSequences": ["Title:", "--", "###"], 
-            },
-            "safetySettings": [
-                # Adjust safety settings to allow humor while blocking truly harmful content
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
-            ]
-        }
+        data = build_gemini_request(prompt)
 
         # Make the API request - try the main endpoint first, then the fallback
         try:
             # First attempt with primary endpoint (v1beta)
             logger.info(f"Sending request to Gemini API (primary endpoint) with prompt of length {len(prompt)}")
-            response = requests.post(
+            response = http_client.post(
+                'gemini',
                 f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
                 headers=headers,
-                json=data,
-                timeout=15  
+                json=data
             )
 
             # If main endpoint fails with 404, try the fallback endpoint
             if response.status_code == 404:
                 logger.warning("Primary Gemini API endpoint returned 404, trying fallback endpoint")
-                response = requests.post(
+                response = http_client.post(
+                    'gemini',
                     f"{GEMINI_API_URL_FALLBACK}?key={GEMINI_API_KEY}",
                     headers=headers,
-                    json=data,
-                    timeout=15
+                    json=data
                 )
 
             # Process the response with enhanced error handling and parsing
@@ -518,169 +501,354 @@ def generate_poem(analysis_results, poem_type, poem_length, emphasis, custom_ter
                     logger.debug(f"Received successful response from Gemini API")
 
                     # Extract the poem from the response
-                    # Handling multiple possible response formats
-
-                    # Format 1: v1beta API format
-                    if 'candidates' in response_data and len(response_data['candidates']) > 0:
-                        if 'content' in response_data['candidates'][0] and 'parts' in response_data['candidates'][0]['content']:
-                            parts = response_data['candidates'][0]['content']['parts']
-                            if parts and 'text' in parts[0]:
-                                generated_text = parts[0]['text']
-                                # Clean up the poem - remove any title-like elements
-                                poem_lines = generated_text.strip().split('\n')
-
-                                # If the first line looks like a title (short, possibly followed by empty line)
-                                if len(poem_lines) > 2 and len(poem_lines[0]) < 50 and not poem_lines[1].strip():
-                                    poem_lines = poem_lines[2:]  # Skip potential title and blank line
-
-                                # Join the remaining lines
-                                poem = '\n'.join(poem_lines).strip()
-
-                                # Post-process: clean up extra quotation marks at beginning/end that the model sometimes adds
-                                poem = poem.strip('"')
-
-                                # Store in cache before returning
-                                _poem_cache[cache_key] = poem
-                                logger.info(f"Stored poem in cache with key: {cache_key[:8]}...")
-                                return poem
-
-                    # Format 2: Alternative API format
-                    elif 'result' in response_data and 'response' in response_data['result']:
-                        generated_text = response_data['result']['response'].strip()
-                        # Clean up the poem - remove any title-like elements
-                        poem_lines = generated_text.strip().split('\n')
-
-                        # If the first line looks like a title (short, possibly followed by empty line)
-                        if len(poem_lines) > 2 and len(poem_lines[0]) < 50 and not poem_lines[1].strip():
-                            poem_lines = poem_lines[2:]  # Skip potential title and blank line
-
-                        # Join the remaining lines
-                        poem = '\n'.join(poem_lines).strip()
-
-                        # Post-process: clean up extra quotation marks at beginning/end that the model sometimes adds
-                        poem = poem.strip('"')
-
+                    poem = extract_poem(response_data)
+                    if poem is not None:
                         # Store in cache before returning
-                        _poem_cache[cache_key] = poem
+                        cache_poem(cache_key, poem)
                         logger.info(f"Stored poem in cache with key: {cache_key[:8]}...")
                         return poem
 
-                    # Format 3: Direct text in the response (simplified format)
-                    elif 'text' in response_data:
-                        generated_text = response_data['text'].strip()
-                        # Clean up the poem - remove any title-like elements
-                        poem_lines = generated_text.strip().split('\n')
-
-                        # If the first line looks like a title (short, possibly followed by empty line)
-                        if len(poem_lines) > 2 and len(poem_lines[0]) < 50 and not poem_lines[1].strip():
-                            poem_lines = poem_lines[2:]  # Skip potential title and blank line
-
-                        # Join the remaining lines
-                        poem = '\n'.join(poem_lines).strip()
-
-                        # Post-process: clean up extra quotation marks at beginning/end that the model sometimes adds
-                        poem = poem.strip('"')
-
-                        # Store in cache before returning
-                        _poem_cache[cache_key] = poem
-                        logger.info(f"Stored poem in cache with key: {cache_key[:8]}...")
-                        return poem
-
-                    # More flexible search through the response for text content
-                    else:
-                        # Dump the response to string and search for it
-                        response_str = json.dumps(response_data)
-                        possible_poems = []
-
-                        # Look for common patterns in the response that might contain the poem
-                        for key in ['text', 'content', 'message', 'poem', 'generated']:
-                            if f'"{key}":' in response_str:
-                                # Extract the content after this key
-                                start_idx = response_str.find(f'"{key}":') + len(f'"{key}":')
-                                if response_str[start_idx].strip() == '"':
-                                    # It's a string value
-                                    end_idx = response_str.find('"', start_idx + 1)
-                                    while end_idx > 0 and response_str[end_idx-1] == '\\':
-                                        end_idx = response_str.find('"', end_idx + 1)
-                                    if end_idx > 0:
-                                        possible_poems.append(response_str[start_idx+1:end_idx])
-
-                        if possible_poems:
-                            # Use the longest poem found as likely the most complete
-                            poem = max(possible_poems, key=len).strip()
-                            # Clean up the poem - remove any title-like elements
-                            poem_lines = poem.strip().split('\n')
-
-                            # If the first line looks like a title (short, possibly followed by empty line)
-                            if len(poem_lines) > 2 and len(poem_lines[0]) < 50 and not poem_lines[1].strip():
-                                poem_lines = poem_lines[2:]  # Skip potential title and blank line
-
-                            # Join the remaining lines
-                            poem = '\n'.join(poem_lines).strip()
-
-                            # Post-process: clean up extra quotation marks at beginning/end that the model sometimes adds
-                            poem = poem.strip('"')
-
-                            # Store in cache before returning
-                            _poem_cache[cache_key] = poem
-                            logger.info(f"Stored poem in cache with key: {cache_key[:8]}...")
-                            return poem
-
                     # If we get here, the response structure was unexpected
                     logger.error(f"Unexpected response structure: {json.dumps(response_data)[:500]}...")
-                    poem = _generate_template_poem(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
-                    # Store in cache before returning
-                    _poem_cache[cache_key] = poem
-                    logger.info(f"Stored template poem in cache with key: {cache_key[:8]}...")
-                    return poem
+                    return _fallback_poem(cache_key, analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
 
                 except (json.JSONDecodeError, KeyError, TypeError) as e:
                     # Error parsing the JSON response
                     logger.error(f"Error parsing API response: {str(e)}")
                     logger.error(f"Raw response: {response.text[:500]}...")
-                    poem = _generate_template_poem(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
-                    # Store in cache before returning
-                    _poem_cache[cache_key] = poem
-                    logger.info(f"Stored JSON parse error fallback poem in cache with key: {cache_key[:8]}...")
-                    return poem
+                    return _fallback_poem(cache_key, analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
             else:
                 logger.error(f"API error: {response.status_code} - {response.text[:200]}...")
                 # Log the request that was sent for debugging
                 logger.error(f"Request data: {json.dumps(data)[:500]}...")
-                poem = _generate_template_poem(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
-                # Store in cache before returning
-                _poem_cache[cache_key] = poem
-                logger.info(f"Stored fallback poem in cache with key: {cache_key[:8]}...")
-                return poem
+                return _fallback_poem(cache_key, analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
         except requests.exceptions.Timeout:
             logger.error("Gemini API request timed out")
-            # Create a timeout-specific cache key
-            timeout_key = hashlib.md5(f"timeout:{poem_type}:{str(emphasis)}:{custom_terms}".encode('utf-8')).hexdigest()
-            poem = _generate_template_poem(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
-            # Store in cache before returning
-            _poem_cache[timeout_key] = poem
-            logger.info(f"Stored timeout fallback poem in cache with key: {timeout_key[:8]}...")
-            return poem
+            return _fallback_poem(cache_key, analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
         except requests.exceptions.RequestException as e:
             logger.error(f"Request exception when calling Gemini API: {str(e)}")
-            # Create a request error-specific cache key
-            error_key = hashlib.md5(f"reqerror:{poem_type}:{str(emphasis)}:{custom_terms}".encode('utf-8')).hexdigest()
-            poem = _generate_template_poem(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
-            # Store in cache before returning
-            _poem_cache[error_key] = poem
-            logger.info(f"Stored request error fallback poem in cache with key: {error_key[:8]}...")
-            return poem
+            return _fallback_poem(cache_key, analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
 
     except Exception as e:
         logger.error(f"Error generating poem: {str(e)}", exc_info=True)
-        # Create a simple cache key for the error fallback case
-        simple_key = hashlib.md5(f"{poem_type}:{str(emphasis)}:{custom_terms}".encode('utf-8')).hexdigest()
+        return _fallback_poem(cache_key, analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
+
+async def generate_poem_async(client, analysis_results, poem_type, poem_length, emphasis, custom_terms='', custom_category='', is_regeneration=False):
+    """
+    Asynchronous variant of generate_poem used by the single-request pipeline.
+
+    Uses the same prompt, request parameters, post-processing and cache as
+    generate_poem, but sends the Gemini request through an async HTTP client.
+
+    Args:
+        client: An httpx.AsyncClient used for the Gemini API request
+        (remaining arguments as for generate_poem)
+
+    Returns:
+        str: The generated poem
+    """
+    cache_key = make_poem_cache_key(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
+
+    if not is_regeneration:
+        cached_poem = get_cached_poem(cache_key)
+        if cached_poem is not None:
+            logger.info(f"Using cached poem for key: {cache_key[:8]}...")
+            return cached_poem
+
+    if not GEMINI_API_KEY:
+        logger.warning("Gemini API key not found in environment variables. Using template poem.")
         poem = _generate_template_poem(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
-        # Store in cache before returning
-        _poem_cache[simple_key] = poem
-        logger.info(f"Stored general error fallback poem in cache with key: {simple_key[:8]}...")
+        cache_poem(cache_key, poem)
         return poem
 
+    prompt = _create_prompt(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
+    data = build_gemini_request(prompt)
+
+    timeout = http_client.UPSTREAMS['gemini']['read_timeout']
+    start = time.perf_counter()
+    try:
+        logger.info(f"Sending async request to Gemini API with prompt of length {len(prompt)}")
+        response = await client.post(f"{GEMINI_API_URL}?key={GEMINI_API_KEY}", json=data, timeout=timeout)
+        if response.status_code == 404:
+            logger.warning("Primary Gemini API endpoint returned 404, trying fallback endpoint")
+            response = await client.post(f"{GEMINI_API_URL_FALLBACK}?key={GEMINI_API_KEY}", json=data, timeout=timeout)
+        http_client.observe('gemini', time.perf_counter() - start, response.status_code)
+
+        if response.status_code == 200:
+            poem = extract_poem(response.json())
+            if poem is not None:
+                cache_poem(cache_key, poem)
+                logger.info(f"Stored poem in cache with key: {cache_key[:8]}...")
+                return poem
+            logger.error(f"Unexpected response structure: {response.text[:500]}...")
+        else:
+            logger.error(f"API error: {response.status_code} - {response.text[:200]}...")
+    except Exception as e:
+        http_client.observe('gemini', time.perf_counter() - start, type(e).__name__)
+        logger.error(f"Gemini API request failed ({type(e).__name__}): {str(e)}")
+
+    return _fallback_poem(cache_key, analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
+
+def stream_poem(analysis_results, poem_type, poem_length, emphasis, custom_terms='', custom_category='', is_regeneration=False):
+    """
+    Generate a poem with Gemini's streaming endpoint, yielding text as it arrives.
+
+    Yields ('token', text) tuples for each chunk of raw model output, then a
+    single ('done', poem) tuple with the final poem. The final poem has gone
+    through the same title and quote cleanup as generate_poem, so clients
+    should replace the streamed text with it. Cached poems, template poems
+    and the fallback after a failed stream only produce the 'done' event.
+
+    Args:
+        (as for generate_poem)
+
+    Yields:
+        tuple: (event, text)
+    """
+    cache_key = make_poem_cache_key(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
+
+    if not is_regeneration:
+        cached_poem = get_cached_poem(cache_key)
+        if cached_poem is not None:
+            logger.info(f"Using cached poem for key: {cache_key[:8]}...")
+            yield 'done', cached_poem
+            return
+
+    if not GEMINI_API_KEY:
+        logger.warning("Gemini API key not found in environment variables. Using template poem.")
+        poem = _generate_template_poem(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
+        cache_poem(cache_key, poem)
+        yield 'done', poem
+        return
+
+    prompt = _create_prompt(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
+    data = build_gemini_request(prompt)
+
+    chunks = []
+    completed = False
+    start = time.perf_counter()
+    try:
+        logger.info(f"Sending streaming request to Gemini API with prompt of length {len(prompt)}")
+        response = http_client.post(
+            'gemini',
+            f"{GEMINI_STREAM_URL}?alt=sse&key={GEMINI_API_KEY}",
+            json=data,
+            stream=True
+        )
+        try:
+            if response.status_code == 200:
+                # SSE is always UTF-8; requests would otherwise assume Latin-1 for text/*
+                response.encoding = 'utf-8'
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith('data:'):
+                        continue
+                    text = _extract_stream_text(json.loads(line[5:]))
+                    if text:
+                        if not chunks:
+                            logger.info(f"First poem tokens after {time.perf_counter() - start:.2f}s")
+                        chunks.append(text)
+                        yield 'token', text
+                completed = True
+            else:
+                logger.error(f"API error: {response.status_code} - {response.text[:200]}...")
+        finally:
+            response.close()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.error(f"Gemini streaming request failed ({type(e).__name__}): {str(e)}")
+
+    generated_text = ''.join(chunks)
+    if completed and generated_text.strip():
+        poem = clean_poem_text(generated_text)
+        cache_poem(cache_key, poem)
+        logger.info(f"Streamed poem in {time.perf_counter() - start:.2f}s, stored in cache with key: {cache_key[:8]}...")
+        yield 'done', poem
+        return
+
+    # A failed or empty stream falls back to a template poem
+    yield 'done', _fallback_poem(cache_key, analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
+
+def _extract_stream_text(chunk):
+    """Return the text contained in one streamGenerateContent chunk."""
+    candidates = chunk.get('candidates') or []
+    if not candidates:
+        return ''
+    parts = candidates[0].get('content', {}).get('parts') or []
+    return ''.join(part.get('text', '') for part in parts)
+
+def make_poem_cache_key(analysis_results, poem_type, poem_length, emphasis, custom_terms='', custom_category=''):
+    """
+    Build the poem cache key for a set of generation inputs.
+
+    Only the top labels and objects of the analysis are included, which makes
+    the key stable across similar images.
+
+    Returns:
+        str: The cache key
+    """
+    # First, convert emphasis list to a stable string representation
+    emphasis_str = ','.join(sorted(emphasis)) if emphasis else 'none'
+
+    # Create a simplified version of analysis_results that contains only the essential elements
+    simple_analysis = {}
+    if 'labels' in analysis_results:
+        simple_analysis['labels'] = [label['description'] for label in analysis_results['labels'][:5]]
+    if 'objects' in analysis_results:
+        simple_analysis['objects'] = [obj['name'] for obj in analysis_results['objects'][:5]]
+
+    # Create a hash of all the inputs
+    cache_key_data = {
+        'analysis': simple_analysis,
+        'poem_type': poem_type,
+        'poem_length': poem_length,
+        'emphasis': emphasis_str,
+        'custom_terms': custom_terms,
+        'custom_category': custom_category,
+        'template_version': TEMPLATE_VERSION  # Add version to invalidate cache when templates change
+    }
+
+    # Convert to string and hash
+    return hashlib.md5(json.dumps(cache_key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_cached_poem(cache_key):
+    """Return the cached poem (or a recent fallback poem) for a cache key, or None."""
+    poem = _poem_cache.get(cache_key)
+    if poem is None:
+        poem = _poem_fallback_cache.get(cache_key)
+    return poem
+
+def cache_poem(cache_key, poem):
+    """Store a generated poem under a cache key."""
+    _poem_cache.set(cache_key, poem)
+
+def _fallback_poem(cache_key, analysis_results, poem_type, poem_length, emphasis, custom_terms='', custom_category=''):
+    """
+    Generate a template poem after a Gemini API failure.
+
+    The poem goes into the short-lived negative cache, never the main poem
+    cache, so a real poem replaces it as soon as the API recovers.
+    """
+    poem = _generate_template_poem(analysis_results, poem_type, poem_length, emphasis, custom_terms, custom_category)
+    if cache_key is not None:
+        _poem_fallback_cache.set(cache_key, poem)
+        logger.info(f"Stored fallback poem in negative cache with key: {cache_key[:8]}...")
+    return poem
+
+def build_gemini_request(prompt):
+    """
+    Build the Gemini generateContent request body for a prompt.
+
+    Args:
+        prompt (str): The poem prompt
+
+    Returns:
+        dict: The JSON request body
+    """
+    # Specifically tune parameters for poetry:
+    # - Increased temperature for more creative language
+    # - Higher topK to consider more diverse word choices
+    # - Slightly reduced topP to focus on more likely language constructs for poetry
+    # - Increased maxOutputTokens to allow for longer, more expressive poems
+    return {
+        "contents": [{
+            "parts": [{
+                "text": prompt
+            }]
+        }],
+        "generationConfig": {
+            "temperature": 0.85,  
+            "topK": 60,           
+            "topP": 0.92,        
+            "maxOutputTokens": 1000, 
+            "stopSequences": ["Title:", "--", "###"], 
+        },
+        "safetySettings": [
+            # Adjust safety settings to allow humor while blocking truly harmful content
+            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_ONLY_HIGH"},
+            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
+        ]
+    }
+
+def clean_poem_text(generated_text):
+    """
+    Clean up generated poem text.
+
+    Removes a leading title-like line and stray quotation marks that the
+    model sometimes adds around the poem.
+
+    Args:
+        generated_text (str): The raw text returned by the model
+
+    Returns:
+        str: The cleaned poem
+    """
+    # Clean up the poem - remove any title-like elements
+    poem_lines = generated_text.strip().split('\n')
+
+    # If the first line looks like a title (short, possibly followed by empty line)
+    if len(poem_lines) > 2 and len(poem_lines[0]) < 50 and not poem_lines[1].strip():
+        poem_lines = poem_lines[2:]  # Skip potential title and blank line
+
+    # Join the remaining lines
+    poem = '\n'.join(poem_lines).strip()
+
+    # Post-process: clean up extra quotation marks at beginning/end that the model sometimes adds
+    return poem.strip('"')
+
+def extract_poem(response_data):
+    """
+    Extract and clean the poem from a Gemini API response.
+
+    Handles the v1beta candidates format as well as a few alternative
+    response shapes.
+
+    Args:
+        response_data (dict): The parsed JSON response
+
+    Returns:
+        str: The cleaned poem, or None if no poem text was found
+    """
+    # Format 1: v1beta API format
+    if 'candidates' in response_data and len(response_data['candidates']) > 0:
+        if 'content' in response_data['candidates'][0] and 'parts' in response_data['candidates'][0]['content']:
+            parts = response_data['candidates'][0]['content']['parts']
+            if parts and 'text' in parts[0]:
+                return clean_poem_text(parts[0]['text'])
+        return None
+
+    # Format 2: Alternative API format
+    if 'result' in response_data and 'response' in response_data['result']:
+        return clean_poem_text(response_data['result']['response'])
+
+    # Format 3: Direct text in the response (simplified format)
+    if 'text' in response_data:
+        return clean_poem_text(response_data['text'])
+
+    # More flexible search through the response for text content
+    # Dump the response to string and search for it
+    response_str = json.dumps(response_data)
+    possible_poems = []
+
+    # Look for common patterns in the response that might contain the poem
+    for key in ['text', 'content', 'message', 'poem', 'generated']:
+        if f'"{key}":' in response_str:
+            # Extract the content after this key
+            start_idx = response_str.find(f'"{key}":') + len(f'"{key}":')
+            if response_str[start_idx].strip() == '"':
+                # It's a string value
+                end_idx = response_str.find('"', start_idx + 1)
+                while end_idx > 0 and response_str[end_idx-1] == '\\':
+                    end_idx = response_str.find('"', end_idx + 1)
+                if end_idx > 0:
+                    possible_poems.append(response_str[start_idx+1:end_idx])
+
+    if possible_poems:
+        # Use the longest poem found as likely the most complete
+        return clean_poem_text(max(possible_poems, key=len))
+
+    return None
+
 def _generate_template_poem(analysis_results, poem_type, poem_length, emphasis, custom_terms='', custom_category=''):
     """
     Generate a poem based on templates when the API is not available.
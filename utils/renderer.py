@@ -0,0 +1,313 @@
+"""
+Final image renderer for Poem Vision AI.
+
+Lays a poem out below the photo and renders the result. Fonts are loaded once
+per process and cached by (path, size), and each cached font keeps a table of
+glyph advances. Line widths are therefore sums of cached advances, not repeated
+font.getlength() calls on growing prefixes. The font size is the largest size
+(found by binary search) at which the wrapped poem fits the text area.
+"""
+import io
+import os
+import logging
+import threading
+from PIL import Image, ImageDraw, ImageFont, ImageOps, ExifTags
+from utils.frames import apply_frame
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Serif fonts tried in order; the first one that loads is used for every render
+FONT_PATHS = [
+    "/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf", "Georgia.ttf",
+    "times.ttf", "Times New Roman.ttf", "DejaVuSerif.ttf",
+    "LiberationSerif-Regular.ttf"
+]
+
+MAX_RENDER_WIDTH = 1000
+IMAGE_MARGIN = 20
+MAX_FONT_SIZE = 32
+MIN_FONT_SIZE = 12
+LINE_SPACING = 1.5
+
+# The poem's text block may be at most this many times as tall as the photo
+# area; longer poems get a smaller font instead of an ever taller image
+MAX_TEXT_AREA_RATIO = float(os.environ.get("MAX_TEXT_AREA_RATIO", "1.5"))
+
+# Large photos are shrunk by integer reduce() steps until they are within this
+# factor of the target size, and only the rest is done with LANCZOS
+RESAMPLE_REDUCING_GAP = float(os.environ.get("RESAMPLE_REDUCING_GAP", "2.0"))
+
+# EXIF orientations that swap width and height
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+_fonts = {}
+_fonts_lock = threading.Lock()
+_font_path = None
+
+
+class FontMetrics:
+    """A loaded font with lazily filled glyph advance widths and line height."""
+
+    def __init__(self, font, size):
+        self.font = font
+        self.size = size
+        self.advances = {}
+        bbox = font.getbbox("Mg")
+        self.line_height = int((bbox[3] - bbox[1]) * LINE_SPACING)
+
+    def advance(self, char):
+        width = self.advances.get(char)
+        if width is None:
+            width = self.advances[char] = self.font.getlength(char)
+        return width
+
+    def width(self, text):
+        """Width of a single line of text, summed from cached glyph advances."""
+        advance = self.advance
+        return sum(advance(char) for char in text)
+
+
+def _find_font_path():
+    global _font_path
+    if _font_path is None:
+        for path in FONT_PATHS:
+            try:
+                ImageFont.truetype(path, size=MAX_FONT_SIZE)
+            except OSError:
+                continue
+            _font_path = path
+            break
+        else:
+            _font_path = ''
+            logger.warning("No serif font found, using the default font")
+    return _font_path
+
+
+def get_font(size, path=None):
+    """
+    Return the cached FontMetrics for a font path and size.
+
+    Args:
+        size (int): Point size
+        path (str, optional): Font file; defaults to the first loadable FONT_PATHS entry
+
+    Returns:
+        FontMetrics: The font and its glyph advance table
+    """
+    path = _find_font_path() if path is None else path
+    key = (path, size)
+    metrics = _fonts.get(key)
+    if metrics is None:
+        with _fonts_lock:
+            metrics = _fonts.get(key)
+            if metrics is None:
+                font = ImageFont.truetype(path, size=size) if path else ImageFont.load_default()
+                metrics = _fonts[key] = FontMetrics(font, size)
+    return metrics
+
+
+def oriented_size(img):
+    """Return an opened image's (width, height) after its EXIF orientation is applied."""
+    width, height = img.size
+    if img.getexif().get(ExifTags.Base.Orientation, 1) in _TRANSPOSED_ORIENTATIONS:
+        return height, width
+    return width, height
+
+
+def decode_for_size(img, width, height):
+    """
+    Decode an opened image for display at (width, height), in display orientation.
+
+    JPEGs are decoded at the smallest DCT scale (1/2, 1/4 or 1/8) that still
+    covers RESAMPLE_REDUCING_GAP times the requested size, so a 12 MP photo
+    is never fully decoded for a 1000px render. Other formats decode fully.
+    The result is EXIF-transposed but not resized.
+
+    Args:
+        img (PIL.Image.Image): An image from Image.open() that hasn't been loaded yet
+        width (int): Display width (after EXIF rotation)
+        height (int): Display height (after EXIF rotation)
+
+    Returns:
+        PIL.Image.Image: The decoded, upright image
+    """
+    if img.format == 'JPEG':
+        if img.getexif().get(ExifTags.Base.Orientation, 1) in _TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        img.draft('RGB', (int(width * RESAMPLE_REDUCING_GAP), int(height * RESAMPLE_REDUCING_GAP)))
+    # Fix orientation based on EXIF data
+    return ImageOps.exif_transpose(img)
+
+
+def _break_word(word, metrics, max_width):
+    """Split a word wider than max_width into pieces that fit."""
+    parts = []
+    current, current_width = '', 0
+    for char in word:
+        char_width = metrics.advance(char)
+        if current and current_width + char_width > max_width:
+            parts.append(current)
+            current, current_width = char, char_width
+        else:
+            current += char
+            current_width += char_width
+    if current:
+        parts.append(current)
+    return parts
+
+
+def wrap_line(line, metrics, max_width):
+    """
+    Wrap one poem line to max_width.
+
+    Words are kept whole where possible; words wider than a line are split at
+    hyphens, or between characters if they have none.
+
+    Returns:
+        list: The wrapped lines
+    """
+    space = metrics.advance(' ')
+    lines = []
+    current, current_width = '', 0
+
+    def add(piece, piece_width, joined=False):
+        # joined pieces continue a hyphenated word, so no space goes before them
+        nonlocal current, current_width
+        separator, separator_width = ('', 0) if joined else (' ', space)
+        width = current_width + separator_width + piece_width if current else piece_width
+        if width <= max_width:
+            current = current + separator + piece if current else piece
+            current_width = width
+            return
+        if current:
+            lines.append(current)
+        current, current_width = piece, piece_width
+
+    for word in line.split():
+        word_width = metrics.width(word)
+        if word_width <= max_width:
+            add(word, word_width)
+            continue
+
+        if '-' in word:
+            pieces = word.split('-')
+            pieces = [piece + '-' for piece in pieces[:-1]] + pieces[-1:]
+        else:
+            pieces = [word]
+        for i, piece in enumerate(pieces):
+            piece_width = metrics.width(piece)
+            if piece_width <= max_width:
+                add(piece, piece_width, joined=i > 0)
+                continue
+            if current:
+                lines.append(current)
+            broken = _break_word(piece, metrics, max_width)
+            lines.extend(broken[:-1])
+            current, current_width = broken[-1], metrics.width(broken[-1])
+
+    if current:
+        lines.append(current)
+    return lines
+
+
+def layout_poem(raw_lines, max_width, max_height, max_size=MAX_FONT_SIZE, min_size=MIN_FONT_SIZE):
+    """
+    Pick the largest font size at which the wrapped poem fits max_height.
+
+    Taller text only ever needs a smaller font, so the size is found by
+    binary search between min_size and max_size. If even min_size doesn't
+    fit, min_size is used and the text area grows.
+
+    Returns:
+        tuple: (FontMetrics, wrapped lines)
+    """
+    def fit(size):
+        metrics = get_font(size)
+        wrapped = [wrapped_line for line in raw_lines for wrapped_line in wrap_line(line, metrics, max_width)]
+        return metrics, wrapped, len(wrapped) * metrics.line_height <= max_height
+
+    metrics, wrapped, fits = fit(max_size)
+    if fits or max_size <= min_size:
+        return metrics, wrapped
+
+    best = fit(min_size)[:2]
+    low, high = min_size + 1, max_size - 1
+    while low <= high:
+        size = (low + high) // 2
+        metrics, wrapped, fits = fit(size)
+        if fits:
+            best = (metrics, wrapped)
+            low = size + 1
+        else:
+            high = size - 1
+    return best
+
+
+def render_poem_image(image_bytes, poem_text, frame_style=None):
+    """
+    Render the photo with the poem below it, framed in the chosen style.
+
+    Args:
+        image_bytes (bytes): The original photo
+        poem_text (str): The poem
+        frame_style (str, optional): Frame id (see utils.frames); None or 'none' for no frame
+
+    Returns:
+        bytes: The final image as a JPEG
+    """
+    img = Image.open(io.BytesIO(image_bytes))
+    original_width, original_height = oriented_size(img)
+    target_width = min(original_width, MAX_RENDER_WIDTH)
+    image_width = target_width - 2 * IMAGE_MARGIN
+    image_height = int(original_height * (image_width / original_width))
+    img = decode_for_size(img, image_width, image_height)
+    img_resized = img.resize((image_width, image_height), Image.LANCZOS, reducing_gap=RESAMPLE_REDUCING_GAP)
+
+    raw_lines = [line for line in poem_text.strip().split("\n") if line.strip()]
+
+    side_margin = int(target_width * 0.08)
+    max_text_width = target_width - 2 * side_margin
+    image_area_height = image_height + 2 * IMAGE_MARGIN
+    base_font_size = max(min(int(target_width * 0.045), MAX_FONT_SIZE), 1)
+
+    metrics, wrapped_lines = layout_poem(raw_lines, max_text_width,
+                                         int(image_area_height * MAX_TEXT_AREA_RATIO),
+                                         max_size=base_font_size,
+                                         min_size=min(MIN_FONT_SIZE, base_font_size))
+    total_text_height = len(wrapped_lines) * metrics.line_height
+    text_area_height = total_text_height + metrics.size * 2
+
+    final_img = Image.new("RGB", (target_width, image_area_height + text_area_height), (255, 255, 255))
+    final_img.paste(img_resized, (IMAGE_MARGIN, IMAGE_MARGIN))
+    draw = ImageDraw.Draw(final_img)
+
+    # Separator between the photo and the poem
+    separator_y = image_area_height - IMAGE_MARGIN
+    draw.rectangle([(IMAGE_MARGIN, separator_y), (target_width - IMAGE_MARGIN, separator_y + 2)],
+                   fill=(240, 240, 240))
+
+    text_y = image_area_height + (text_area_height - total_text_height) // 2
+    for i, line in enumerate(wrapped_lines):
+        line_y = text_y + i * metrics.line_height
+        # Draw with subtle shadow for readability
+        if _font_path:
+            draw.text((side_margin + 1, line_y + 1), line, fill=(200, 200, 200), font=metrics.font)
+        draw.text((side_margin, line_y), line, fill=(0, 0, 0), font=metrics.font)
+
+    final_img = apply_frame(final_img, frame_style)
+
+    output = io.BytesIO()
+    final_img.save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+
+def get_font_cache_stats():
+    """Return the number of cached fonts and glyph advances."""
+    with _fonts_lock:
+        fonts = list(_fonts.values())
+    return {
+        'font_path': _font_path,
+        'fonts': len(fonts),
+        'glyph_advances': sum(len(metrics.advances) for metrics in fonts)
+    }
@@ -0,0 +1,224 @@
+"""
+Response cache for Poem Vision AI views.
+
+Caches rendered responses (status, headers and body) in a bounded in-process
+LRU, limited by entry count and total bytes, in front of the optional shared
+cache backend (see utils.cache), so every worker can serve a page rendered by
+any other worker.
+
+Entries are grouped by tags (e.g. "gallery" or "shared:<share_code>"). Each
+tag has a generation token that is part of the cache key; invalidating a tag
+replaces its token, which orphans every cached variant of the tagged views at
+once. With a shared backend the tokens live in the backend, so an
+invalidation in one worker is seen by all of them on their next request.
+"""
+import os
+import json
+import uuid
+import logging
+import threading
+from flask import Response
+from utils.cache import LRUCache, get_shared_backend, register_cache
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Bounds of the in-process tier
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "512"))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Larger responses (e.g. JSON with embedded images) are never cached
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))
+
+# Set RESPONSE_CACHE_SHARED=0 to keep cached responses in-process even when a shared backend is configured
+RESPONSE_CACHE_SHARED = os.environ.get("RESPONSE_CACHE_SHARED", "1") != "0"
+
+# Headers that belong to one client and must not be replayed to others
+_UNCACHEABLE_HEADERS = {'set-cookie'}
+
+# Expired local entries are purged once every this many writes
+_PURGE_INTERVAL = 100
+
+
+class ResponseCache:
+    """Two-tier cache of complete Flask responses with tag-based invalidation."""
+
+    def __init__(self, name="response", max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES, max_entry_bytes=RESPONSE_CACHE_MAX_ENTRY_BYTES,
+                 shared=RESPONSE_CACHE_SHARED):
+        self.name = name
+        self.local = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self.max_entry_bytes = max_entry_bytes
+        self.shared = shared
+        # Generation tokens of tags, used when there is no shared backend
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.skipped = 0
+        self.invalidations = 0
+        self.errors = 0
+        register_cache(self)
+
+    @property
+    def backend(self):
+        return get_shared_backend() if self.shared else None
+
+    def _generation(self, tag):
+        backend = self.backend
+        if backend is not None:
+            try:
+                token = backend.get(f"{self.name}:gen:{tag}")
+                return token.decode("ascii") if isinstance(token, bytes) else (token or "0")
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Shared cache read failed for {self.name} tag {tag}: {str(e)}")
+        with self._lock:
+            return self._generations.get(tag, "0")
+
+    def make_key(self, path, query_args, variant, tags=()):
+        """
+        Build the cache key of one response variant.
+
+        Args:
+            path (str): Request path
+            query_args (iterable): (name, value) pairs of the query string
+            variant (tuple): Everything else the response depends on, such as
+                the negotiated format and the session's user id
+            tags (iterable): Tags whose current generations are part of the key
+
+        Returns:
+            str: The cache key
+        """
+        parts = {
+            'path': path,
+            'query': sorted(query_args),
+            'variant': list(variant),
+            'tags': {tag: self._generation(tag) for tag in sorted(tags)}
+        }
+        return json.dumps(parts, sort_keys=True, separators=(',', ':'))
+
+    def get(self, key):
+        """Return a fresh Response for a cached key, or None."""
+        entry = self.local.get(key)
+        if entry is not None:
+            self.hits += 1
+            return self._build(*entry)
+
+        backend = self.backend
+        if backend is not None:
+            try:
+                raw = backend.get(f"{self.name}:{key}")
+                if raw is not None:
+                    entry = self._decode(raw)
+                    self.local.set(key, entry, size=len(entry[2]))
+                    self.shared_hits += 1
+                    return self._build(*entry)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Shared cache read failed for {self.name}: {str(e)}")
+
+        self.misses += 1
+        return None
+
+    def set(self, key, response, ttl):
+        """
+        Cache a response if it is cacheable.
+
+        Only complete (non-streamed) 200 responses no larger than
+        max_entry_bytes are stored; per-client headers are dropped.
+
+        Returns:
+            bool: Whether the response was cached
+        """
+        if response.status_code != 200 or response.is_streamed:
+            return False
+        body = response.get_data()
+        if len(body) > self.max_entry_bytes:
+            self.skipped += 1
+            return False
+
+        headers = [(name, value) for name, value in response.headers.items()
+                   if name.lower() not in _UNCACHEABLE_HEADERS]
+        entry = (response.status_code, headers, body)
+        self.local.set(key, entry, ttl=ttl, size=len(body))
+        self.sets += 1
+        if self.sets % _PURGE_INTERVAL == 0:
+            self.local.purge_expired()
+
+        backend = self.backend
+        if backend is not None:
+            try:
+                backend.set(f"{self.name}:{key}", self._encode(entry), ttl=ttl)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Shared cache write failed for {self.name}: {str(e)}")
+        return True
+
+    def invalidate(self, *tags):
+        """Invalidate every cached response carrying any of the given tags."""
+        backend = self.backend
+        for tag in tags:
+            token = uuid.uuid4().hex
+            with self._lock:
+                self._generations[tag] = token
+            if backend is not None:
+                try:
+                    backend.set(f"{self.name}:gen:{tag}", token.encode("ascii"))
+                except Exception as e:
+                    self.errors += 1
+                    logger.warning(f"Shared cache invalidation failed for {self.name} tag {tag}: {str(e)}")
+            self.invalidations += 1
+            logger.debug(f"Invalidated cached responses tagged {tag}")
+
+    def clear(self):
+        """Drop every cached response in this process."""
+        self.local.clear()
+        with self._lock:
+            self._generations.clear()
+
+    @staticmethod
+    def _build(status, headers, body):
+        return Response(body, status=status, headers=headers)
+
+    @staticmethod
+    def _encode(entry):
+        status, headers, body = entry
+        meta = json.dumps({'status': status, 'headers': headers}).encode("utf-8")
+        return len(meta).to_bytes(4, "big") + meta + body
+
+    @staticmethod
+    def _decode(raw):
+        raw = bytes(raw)
+        length = int.from_bytes(raw[:4], "big")
+        meta = json.loads(raw[4:4 + length])
+        return meta['status'], [tuple(header) for header in meta['headers']], raw[4 + length:]
+
+    def stats(self):
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            'local_entries': len(self.local),
+            'local_max_entries': self.local.max_entries,
+            'local_bytes': self.local.bytes,
+            'local_max_bytes': self.local.max_bytes,
+            'local_evictions': self.local.evictions,
+            'local_hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'sets': self.sets,
+            'skipped_too_large': self.skipped,
+            'invalidations': self.invalidations,
+            'errors': self.errors,
+            'hit_rate': round((self.hits + self.shared_hits) / lookups, 4) if lookups else 0.0,
+            'shared_backend': type(self.backend).__name__ if self.backend is not None else None
+        }
+
+
+_response_cache = ResponseCache()
+
+
+def get_response_cache():
+    """Return the process-wide response cache."""
+    return _response_cache
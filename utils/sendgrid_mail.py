@@ -3,8 +3,8 @@ SendGrid email utility functions for Poem Vision.
 """
 import os
 import json
-import requests
 from flask import current_app
+from utils import http_client
 
 def send_email(
     to_email,
@@ -105,8 +105,9 @@ def send_email(
         
         current_app.logger.debug(f"Sending email via SendGrid API with from: {sender_email}")
         
-        # Send message using direct requests
-        response = requests.post(
+        # Send message through the pooled SendGrid session
+        response = http_client.post(
+            'sendgrid',
             "https://api.sendgrid.com/v3/mail/send",
             headers={
                 "Authorization": f"Bearer {sendgrid_api_key}",
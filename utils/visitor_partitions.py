@@ -0,0 +1,373 @@
+"""
+Time-partitioned storage and retention for the visitor log.
+
+On PostgreSQL the visitor_log table is a native range-partitioned table with
+one partition per calendar month, so queries filtered on timestamp only scan
+the months they cover, and old months are removed by detaching and dropping
+their partition instead of a large DELETE. Other databases (SQLite in
+development) keep a single table indexed on timestamp; retention deletes the
+old rows and compacts the file with VACUUM.
+
+Months older than the retention period are archived to compressed files
+(CSV.gz, or Parquet when pyarrow is installed) before they are removed. A
+month is only removed once the visitor statistics rollup has processed it.
+"""
+import os
+import csv
+import gzip
+import logging
+from datetime import datetime
+from sqlalchemy import inspect, text, select
+from models import db, VisitorLog, RollupWatermark
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Months of visitor log to keep in the database (including the current month)
+VISITOR_LOG_RETENTION_MONTHS = int(os.environ.get("VISITOR_LOG_RETENTION_MONTHS", "13"))
+# Where archived months are written
+VISITOR_LOG_ARCHIVE_DIR = os.environ.get("VISITOR_LOG_ARCHIVE_DIR", "archives/visitor_log")
+# Partitions to create ahead of the current month, so inserts never land in the default partition
+PARTITION_MONTHS_AHEAD = 3
+
+TABLE_NAME = VisitorLog.__table__.name
+ARCHIVE_COLUMNS = ['id', 'visitor_id', 'timestamp', 'page_visited', 'session_id',
+                   'time_spent_seconds', 'referrer']
+ARCHIVE_BATCH_SIZE = 5000
+# Timestamp given to legacy rows that have none when they are moved into partitions
+UNDATED_TIMESTAMP = datetime(1970, 1, 1)
+
+
+def _month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    """Return the name of the partition holding a month, e.g. visitor_log_y2025m03."""
+    return f"{TABLE_NAME}_y{month.year:04d}m{month.month:02d}"
+
+
+def uses_native_partitions():
+    """Check whether the database supports native table partitioning (PostgreSQL)."""
+    return db.engine.dialect.name == 'postgresql'
+
+
+def is_partitioned():
+    """Check whether visitor_log is already a partitioned table."""
+    if not uses_native_partitions():
+        return False
+    return bool(db.session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = :name"), {'name': TABLE_NAME}).scalar())
+
+
+def _create_partitioned_table(sequence_exists=False):
+    # The model's primary key is id; partitioned tables need the partition key in
+    # every unique constraint, so the table's primary key is (id, timestamp)
+    if not sequence_exists:
+        db.session.execute(text(f"CREATE SEQUENCE IF NOT EXISTS {TABLE_NAME}_id_seq"))
+    db.session.execute(text(f"""
+        CREATE TABLE {TABLE_NAME} (
+            id BIGINT NOT NULL DEFAULT nextval('{TABLE_NAME}_id_seq'),
+            visitor_id INTEGER NOT NULL REFERENCES site_visitor (id) ON DELETE CASCADE,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            page_visited VARCHAR(255) NOT NULL,
+            session_id VARCHAR(64),
+            time_spent_seconds INTEGER,
+            referrer VARCHAR(255),
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """))
+    db.session.execute(text(f"ALTER SEQUENCE {TABLE_NAME}_id_seq OWNED BY {TABLE_NAME}.id"))
+    for index in VisitorLog.__table__.indexes:
+        columns = ', '.join(column.name for column in index.columns)
+        db.session.execute(text(f"CREATE INDEX {index.name} ON {TABLE_NAME} ({columns})"))
+    db.session.execute(text(f"CREATE TABLE {TABLE_NAME}_default PARTITION OF {TABLE_NAME} DEFAULT"))
+
+
+def prepare_storage():
+    """
+    Create visitor_log as a partitioned table on a new PostgreSQL database.
+
+    Must run before db.create_all(), which would otherwise create a plain
+    table. The tables visitor_log references are created first.
+    """
+    if not uses_native_partitions() or inspect(db.engine).has_table(TABLE_NAME):
+        return False
+
+    other_tables = [table for table in db.metadata.sorted_tables if table.name != TABLE_NAME]
+    db.metadata.create_all(db.engine, tables=other_tables)
+    _create_partitioned_table()
+    db.session.commit()
+    logger.info(f"Created partitioned {TABLE_NAME} table")
+    return True
+
+
+def ensure_partitions(start=None, months_ahead=PARTITION_MONTHS_AHEAD):
+    """
+    Create monthly partitions from start (default: this month) through months_ahead.
+
+    Returns:
+        list: Names of the partitions that were created
+    """
+    if not is_partitioned():
+        return []
+
+    existing = set(_partition_months())
+    month = _month_start(start or datetime.utcnow())
+    last = _add_months(_month_start(datetime.utcnow()), months_ahead)
+    created = []
+    while month <= last:
+        if month not in existing:
+            created.append(_create_partition(month))
+        month = _add_months(month, 1)
+
+    if created:
+        db.session.commit()
+        logger.info(f"Created visitor log partitions: {', '.join(created)}")
+    return created
+
+
+def _create_partition(month):
+    name = partition_name(month)
+    db.session.execute(text(
+        f"CREATE TABLE {name} PARTITION OF {TABLE_NAME} "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{_add_months(month, 1):%Y-%m-%d}')"))
+    return name
+
+
+def _partition_months():
+    """Return the months that have their own partition (PostgreSQL only)."""
+    names = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :name"), {'name': TABLE_NAME}).scalars()
+    months = []
+    prefix = f"{TABLE_NAME}_y"
+    for name in names:
+        if name.startswith(prefix):
+            months.append(datetime(int(name[len(prefix):len(prefix) + 4]), int(name[-2:]), 1))
+    return sorted(months)
+
+
+def migrate_to_partitions():
+    """
+    Convert an existing plain visitor_log table into a partitioned one (PostgreSQL).
+
+    The old table is renamed, a partitioned table with partitions covering
+    every logged month is created, the rows are copied across in one
+    transaction and the old table is dropped. IDs and the ID sequence are kept;
+    rows without a timestamp are copied as UNDATED_TIMESTAMP.
+
+    Returns:
+        int: The number of rows copied, or None if there was nothing to migrate
+    """
+    if not uses_native_partitions() or is_partitioned():
+        return None
+
+    legacy = f"{TABLE_NAME}_legacy"
+    db.session.execute(text(f"ALTER TABLE {TABLE_NAME} RENAME TO {legacy}"))
+    # The primary key index name would clash with the new table's
+    db.session.execute(text(f"ALTER TABLE {legacy} RENAME CONSTRAINT {TABLE_NAME}_pkey TO {legacy}_pkey"))
+    for index in VisitorLog.__table__.indexes:
+        db.session.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+    db.session.execute(text(f"ALTER SEQUENCE {TABLE_NAME}_id_seq OWNED BY NONE"))
+    _create_partitioned_table(sequence_exists=True)
+
+    first = db.session.execute(text(f"SELECT MIN(timestamp) FROM {legacy}")).scalar()
+    if first is not None:
+        month = _month_start(first)
+        last = _add_months(_month_start(datetime.utcnow()), PARTITION_MONTHS_AHEAD)
+        while month <= last:
+            _create_partition(month)
+            month = _add_months(month, 1)
+
+    # The partition key can't be NULL: rows without a timestamp are kept in the default
+    # partition under UNDATED_TIMESTAMP, where retention archives them like any old month
+    undated = db.session.execute(text(f"SELECT COUNT(*) FROM {legacy} WHERE timestamp IS NULL")).scalar()
+    if undated:
+        logger.warning(f"Migrating {undated} visitor log rows without a timestamp as {UNDATED_TIMESTAMP:%Y-%m-%d}")
+
+    columns = ', '.join(ARCHIVE_COLUMNS)
+    selected = ', '.join('COALESCE(timestamp, :undated)' if column == 'timestamp' else column
+                         for column in ARCHIVE_COLUMNS)
+    copied = db.session.execute(text(
+        f"INSERT INTO {TABLE_NAME} ({columns}) SELECT {selected} FROM {legacy}"),
+        {'undated': UNDATED_TIMESTAMP}).rowcount
+    db.session.execute(text(f"DROP TABLE {legacy}"))
+    db.session.commit()
+    logger.info(f"Migrated {copied} visitor log rows into monthly partitions ({undated} undated)")
+    ensure_partitions()
+    return copied
+
+
+def logged_months():
+    """Return the months that currently hold visitor log rows, oldest first."""
+    if is_partitioned():
+        months = [month for month in _partition_months()
+                  if db.session.execute(text(f"SELECT 1 FROM {partition_name(month)} LIMIT 1")).scalar()]
+        # Rows outside every monthly partition end up in the default partition
+        stray = db.session.execute(text(
+            f"SELECT DISTINCT date_trunc('month', timestamp) FROM {TABLE_NAME}_default")).scalars()
+        return sorted(set(months) | {_month_start(month) for month in stray})
+
+    first = db.session.query(db.func.min(VisitorLog.timestamp)).scalar()
+    last = db.session.query(db.func.max(VisitorLog.timestamp)).scalar()
+    if first is None:
+        return []
+    months = []
+    month = _month_start(first)
+    while month <= last:
+        # Each probe is an index range lookup on timestamp
+        if db.session.query(VisitorLog.id).filter(
+                VisitorLog.timestamp >= month,
+                VisitorLog.timestamp < _add_months(month, 1)).first():
+            months.append(month)
+        month = _add_months(month, 1)
+    return months
+
+
+def archive_month(month, archive_dir=VISITOR_LOG_ARCHIVE_DIR, file_format='csv'):
+    """
+    Write one month of the visitor log to a compressed archive file.
+
+    The file is written under a temporary name and renamed when complete, so
+    a partial archive is never mistaken for a finished one.
+
+    Args:
+        month (datetime): First day of the month
+        archive_dir (str): Directory for archive files
+        file_format (str): 'csv' for CSV.gz or 'parquet' (requires pyarrow)
+
+    Returns:
+        tuple: (path, row count)
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    extension = 'csv.gz' if file_format == 'csv' else 'parquet'
+    path = os.path.join(archive_dir, f"{partition_name(month)}.{extension}")
+    temp_path = path + '.tmp'
+
+    table = VisitorLog.__table__
+    query = select(*[table.c[name] for name in ARCHIVE_COLUMNS]).where(
+        table.c.timestamp >= month,
+        table.c.timestamp < _add_months(month, 1)
+    ).order_by(table.c.id).execution_options(yield_per=ARCHIVE_BATCH_SIZE)
+    result = db.session.execute(query)
+
+    if file_format == 'parquet':
+        rows = _write_parquet(result, temp_path)
+    else:
+        rows = 0
+        with gzip.open(temp_path, 'wt', newline='', encoding='utf-8') as archive:
+            writer = csv.writer(archive)
+            writer.writerow(ARCHIVE_COLUMNS)
+            for partition in result.partitions():
+                writer.writerows(partition)
+                rows += len(partition)
+
+    os.replace(temp_path, path)
+    logger.info(f"Archived {rows} visitor log rows for {month:%Y-%m} to {path}")
+    return path, rows
+
+
+def _write_parquet(result, path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet archives require the pyarrow package to be installed")
+
+    schema = pa.schema([
+        ('id', pa.int64()), ('visitor_id', pa.int64()), ('timestamp', pa.timestamp('us')),
+        ('page_visited', pa.string()), ('session_id', pa.string()),
+        ('time_spent_seconds', pa.float64()), ('referrer', pa.string())
+    ])
+    rows = 0
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for partition in result.partitions():
+            columns = list(zip(*partition))
+            writer.write_table(pa.table(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema))
+            rows += len(partition)
+    return rows
+
+
+def drop_month(month):
+    """
+    Remove one month of the visitor log from the database.
+
+    Detaches and drops the month's partition when it has one; otherwise the
+    rows are deleted in batches.
+
+    Returns:
+        int: The number of rows removed
+    """
+    start, end = month, _add_months(month, 1)
+    count = VisitorLog.query.filter(VisitorLog.timestamp >= start, VisitorLog.timestamp < end).count()
+
+    if is_partitioned() and month in _partition_months():
+        name = partition_name(month)
+        db.session.execute(text(f"ALTER TABLE {TABLE_NAME} DETACH PARTITION {name}"))
+        db.session.execute(text(f"DROP TABLE {name}"))
+        db.session.commit()
+    else:
+        while True:
+            ids = [row[0] for row in db.session.query(VisitorLog.id).filter(
+                VisitorLog.timestamp >= start, VisitorLog.timestamp < end).limit(ARCHIVE_BATCH_SIZE)]
+            if not ids:
+                break
+            VisitorLog.query.filter(VisitorLog.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+
+    logger.info(f"Dropped {count} visitor log rows for {month:%Y-%m}")
+    return count
+
+
+def compact():
+    """Reclaim space after dropping rows (VACUUM; not needed after dropping partitions)."""
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if uses_native_partitions():
+            connection.execute(text(f"VACUUM ANALYZE {TABLE_NAME}"))
+        else:
+            connection.execute(text("VACUUM"))
+    logger.info("Compacted visitor log storage")
+
+
+def apply_retention(retention_months=VISITOR_LOG_RETENTION_MONTHS, archive_dir=VISITOR_LOG_ARCHIVE_DIR,
+                    file_format='csv', dry_run=False):
+    """
+    Archive and drop every month older than the retention period.
+
+    A month is skipped if the visitor statistics rollup hasn't processed all
+    of its rows yet, since they could no longer be counted once dropped.
+
+    Returns:
+        list: (month, archive path, rows) for each month that was (or, in a
+        dry run, would be) archived and dropped
+    """
+    cutoff = _add_months(_month_start(datetime.utcnow()), -(retention_months - 1))
+    watermark = db.session.get(RollupWatermark, 'visitor_log')
+    rolled_up_to = watermark.position if watermark else 0
+
+    processed = []
+    for month in logged_months():
+        if month >= cutoff:
+            break
+        last_id = db.session.query(db.func.max(VisitorLog.id)).filter(
+            VisitorLog.timestamp >= month, VisitorLog.timestamp < _add_months(month, 1)).scalar()
+        if last_id is not None and last_id > rolled_up_to:
+            logger.warning(f"Skipping {month:%Y-%m}: visitor stats rollup hasn't reached it yet")
+            continue
+        if dry_run:
+            processed.append((month, None, None))
+            continue
+
+        path, rows = archive_month(month, archive_dir, file_format)
+        drop_month(month)
+        processed.append((month, path, rows))
+    return processed
@@ -3,295 +3,696 @@ Visitor tracking utility functions for the Poem Vision AI application.
 This module handles the tracking and analysis of site visitors.
 """
 
-from datetime import datetime, timedelta
+import os
+import time
 import uuid
-from flask import request, session
-from sqlalchemy import func, desc
-from models import db, SiteVisitor, VisitorLog, VisitorStats, User
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from flask import request, session, current_app
+from sqlalchemy import func, bindparam
+from models import db, SiteVisitor, VisitorLog, VisitorStats, VisitorSketch, RollupWatermark, User
+from utils.hyperloglog import HyperLogLog
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+
+# Write-behind buffer for page views: requests only append an event in memory
+# and a background thread writes them to the database in batches.
+VISIT_BUFFER_SIZE = int(os.environ.get("VISIT_BUFFER_SIZE", "10000"))
+VISIT_FLUSH_INTERVAL = float(os.environ.get("VISIT_FLUSH_INTERVAL", "2.0"))
+VISIT_FLUSH_BATCH = int(os.environ.get("VISIT_FLUSH_BATCH", "500"))
+# What to discard when the buffer is full: 'newest' drops the incoming event,
+# 'oldest' drops the event that has waited longest
+VISIT_BUFFER_DROP = os.environ.get("VISIT_BUFFER_DROP", "newest")
+
+# Incremental statistics rollup: the flusher rolls new visits into VisitorStats
+# every VISITOR_ROLLUP_INTERVAL seconds (0 disables; use `flask rollup-visitor-stats`).
+# Visits younger than VISITOR_ROLLUP_LAG seconds wait for the next run, so rows
+# other processes are still flushing aren't skipped by the watermark.
+VISITOR_ROLLUP_INTERVAL = float(os.environ.get("VISITOR_ROLLUP_INTERVAL", "60"))
+VISITOR_ROLLUP_LAG = int(os.environ.get("VISITOR_ROLLUP_LAG", "30"))
+VISITOR_ROLLUP_BATCH = int(os.environ.get("VISITOR_ROLLUP_BATCH", "20000"))
 
+# HyperLogLog precision per sketch dimension; the relative standard error is
+# 1.04 / sqrt(2**precision): 1.6% site-wide, 3.3% per page and per referrer
+SKETCH_PRECISION = {'site': 12, 'page': 10, 'referrer': 10}
 
-def track_visitor(user_id=None):
+_visit_buffer = deque()
+_visit_buffer_lock = threading.Lock()
+_visit_buffer_ready = threading.Event()
+_visit_buffer_stats = {'recorded': 0, 'dropped': 0, 'flushed': 0, 'flush_batches': 0,
+                       'flush_errors': 0, 'last_flush_at': None, 'last_flush_ms': None}
+_flusher_pid = None
+
+
+def record_visit(user_id=None, time_spent_seconds=None):
     """
-    Track a visitor to the site.
+    Buffer a page view for the current request.
+
+    Nothing is written to the database here; the background flusher stores
+    buffered visits in batches (see flush_visits). If the buffer is full the
+    event is dropped according to VISIT_BUFFER_DROP and counted.
 
     Args:
         user_id (int): The ID of the logged-in user, if any
+        time_spent_seconds (float): Time spent serving the page
 
     Returns:
-        tuple: A tuple containing (visitor_id, is_new_visitor)
+        bool: True if the visit was buffered, False if it was dropped
     """
-    ip_address = request.remote_addr
-    user_agent = request.user_agent.string
-    referrer = request.referrer
-
-    # Validate the user_id to avoid FK violations
-    if user_id is not None:
-        user = db.session.get(User, user_id)
-        if not user:
-            user_id = None  # Reset to avoid FK violation
-
     # Create or get a visitor session ID
     if 'visitor_session_id' not in session:
         session['visitor_session_id'] = str(uuid.uuid4())
-    session_id = session['visitor_session_id']
-
-    # Check if this is a returning visitor
-    visitor = SiteVisitor.query.filter_by(
-        ip_address=ip_address,
-        user_agent=user_agent
-    ).first()
-
-    is_new_visitor = False
-
-    try:
-        if visitor:
-            # Update existing visitor
-            visitor.last_visit = datetime.utcnow()
-            visitor.visit_count += 1
-            if user_id and not visitor.user_id:
-                visitor.user_id = user_id
+
+    event = {
+        'ip_address': request.remote_addr,
+        'user_agent': (request.user_agent.string or '')[:255],
+        'referrer': (request.referrer or '')[:255] or None,
+        'user_id': user_id,
+        'page_visited': request.path[:255],
+        'session_id': session['visitor_session_id'],
+        'timestamp': datetime.utcnow(),
+        'time_spent_seconds': time_spent_seconds
+    }
+
+    _ensure_flusher(current_app._get_current_object())
+
+    with _visit_buffer_lock:
+        if len(_visit_buffer) >= VISIT_BUFFER_SIZE:
+            _visit_buffer_stats['dropped'] += 1
+            if VISIT_BUFFER_DROP != 'oldest':
+                return False
+            _visit_buffer.popleft()
+        _visit_buffer.append(event)
+        _visit_buffer_stats['recorded'] += 1
+        if len(_visit_buffer) >= VISIT_FLUSH_BATCH:
+            _visit_buffer_ready.set()
+    return True
+
+
+def _ensure_flusher(app):
+    """Start the flusher thread in this process if it isn't running (e.g. after a fork)."""
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _visit_buffer_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+        # Events copied from a parent process were already counted there
+        _visit_buffer.clear()
+    thread = threading.Thread(target=_flusher_loop, args=(app,), name="visit-flusher", daemon=True)
+    thread.start()
+    atexit.register(_flush_buffer, app)
+    logger.info(f"Started visitor flusher (buffer={VISIT_BUFFER_SIZE}, batch={VISIT_FLUSH_BATCH}, "
+                f"interval={VISIT_FLUSH_INTERVAL}s)")
+
+
+def _flusher_loop(app):
+    last_rollup = time.time()
+    while True:
+        # Wake up early when a full batch is waiting
+        _visit_buffer_ready.wait(VISIT_FLUSH_INTERVAL)
+        _visit_buffer_ready.clear()
+        _flush_buffer(app)
+
+        if VISITOR_ROLLUP_INTERVAL > 0 and time.time() - last_rollup >= VISITOR_ROLLUP_INTERVAL:
+            last_rollup = time.time()
+            with app.app_context():
+                try:
+                    update_visitor_stats()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Error rolling up visitor stats: {str(e)}", exc_info=True)
+                finally:
+                    db.session.remove()
+
+
+def _flush_buffer(app):
+    """Drain the buffer, writing it in batches of VISIT_FLUSH_BATCH."""
+    while True:
+        with _visit_buffer_lock:
+            batch = [_visit_buffer.popleft() for _ in range(min(VISIT_FLUSH_BATCH, len(_visit_buffer)))]
+        if not batch:
+            return
+
+        start = time.perf_counter()
+        with app.app_context():
+            try:
+                flush_visits(batch)
+            except Exception as e:
+                db.session.rollback()
+                _visit_buffer_stats['flush_errors'] += 1
+                requeued = _requeue(batch)
+                logger.error(f"Error flushing {len(batch)} buffered visits ({requeued} requeued): {str(e)}",
+                             exc_info=True)
+                return
+            finally:
+                db.session.remove()
+
+        _visit_buffer_stats['flushed'] += len(batch)
+        _visit_buffer_stats['flush_batches'] += 1
+        _visit_buffer_stats['last_flush_at'] = datetime.utcnow().isoformat()
+        _visit_buffer_stats['last_flush_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+
+def _requeue(batch):
+    """
+    Put a batch back at the front of the buffer after a failed flush.
+
+    Visits recorded meanwhile keep their place; if the buffer can't hold the
+    whole batch again, its oldest events are dropped and counted.
+
+    Returns:
+        int: The number of events requeued
+    """
+    with _visit_buffer_lock:
+        space = max(VISIT_BUFFER_SIZE - len(_visit_buffer), 0)
+        kept = batch[len(batch) - space:] if space < len(batch) else batch
+        _visit_buffer_stats['dropped'] += len(batch) - len(kept)
+        _visit_buffer.extendleft(reversed(kept))
+    return len(kept)
+
+
+def flush_visits(events):
+    """
+    Write a batch of buffered visits in a single transaction.
+
+    SiteVisitor rows (one per IP address and user agent) are upserted: existing
+    visitors get one executemany UPDATE that adds the batch's visit count, new
+    visitors one bulk INSERT. The VisitorLog rows are then bulk inserted.
+
+    Args:
+        events (list): Event dicts produced by record_visit()
+    """
+    visitor_table = SiteVisitor.__table__
+
+    # Drop user IDs that don't exist to avoid FK violations
+    user_ids = {event['user_id'] for event in events if event['user_id'] is not None}
+    if user_ids:
+        valid_user_ids = {row[0] for row in db.session.query(User.id).filter(User.id.in_(user_ids))}
+    else:
+        valid_user_ids = set()
+
+    # Aggregate the batch per visitor
+    visitors = {}
+    for event in events:
+        key = (event['ip_address'], event['user_agent'])
+        user_id = event['user_id'] if event['user_id'] in valid_user_ids else None
+        visitor = visitors.get(key)
+        if visitor is None:
+            visitors[key] = {'count': 1, 'first': event['timestamp'], 'last': event['timestamp'],
+                             'user_id': user_id, 'referrer': event['referrer']}
         else:
-            # Create new visitor
-            is_new_visitor = True
-            visitor = SiteVisitor(
-                ip_address=ip_address,
-                user_agent=user_agent,
-                first_visit=datetime.utcnow(),
-                last_visit=datetime.utcnow(),
-                visit_count=1,
-                user_id=user_id,
-                referrer=referrer
-            )
-            db.session.add(visitor)
+            visitor['count'] += 1
+            visitor['last'] = max(visitor['last'], event['timestamp'])
+            visitor['user_id'] = visitor['user_id'] or user_id
+
+    visitor_ids = _lookup_visitor_ids(visitors.keys())
+
+    updates = [{'_id': visitor_ids[key], '_count': visitor['count'], '_last': visitor['last'],
+                '_user_id': visitor['user_id']}
+               for key, visitor in visitors.items() if key in visitor_ids]
+    if updates:
+        db.session.execute(
+            visitor_table.update()
+            .where(visitor_table.c.id == bindparam('_id'))
+            .values(visit_count=visitor_table.c.visit_count + bindparam('_count'),
+                    last_visit=bindparam('_last'),
+                    user_id=func.coalesce(visitor_table.c.user_id, bindparam('_user_id'))),
+            updates)
+
+    inserts = [{'ip_address': key[0], 'user_agent': key[1], 'first_visit': visitor['first'],
+                'last_visit': visitor['last'], 'visit_count': visitor['count'],
+                'user_id': visitor['user_id'], 'referrer': visitor['referrer']}
+               for key, visitor in visitors.items() if key not in visitor_ids]
+    if inserts:
+        db.session.execute(visitor_table.insert(), inserts)
+        visitor_ids.update(_lookup_visitor_ids([(row['ip_address'], row['user_agent']) for row in inserts]))
+
+    db.session.execute(VisitorLog.__table__.insert(), [{
+        'visitor_id': visitor_ids[(event['ip_address'], event['user_agent'])],
+        'timestamp': event['timestamp'],
+        'page_visited': event['page_visited'],
+        'session_id': event['session_id'],
+        'time_spent_seconds': event['time_spent_seconds'],
+        'referrer': event['referrer']
+    } for event in events])
+
+    db.session.commit()
+
 
-        db.session.commit()
+def _lookup_visitor_ids(keys):
+    """Map (ip_address, user_agent) pairs to existing SiteVisitor IDs (the oldest row wins)."""
+    keys = set(keys)
+    ids = {}
+    ip_addresses = list({ip for ip, _ in keys})
+    for i in range(0, len(ip_addresses), 500):
+        rows = db.session.query(SiteVisitor.id, SiteVisitor.ip_address, SiteVisitor.user_agent).filter(
+            SiteVisitor.ip_address.in_(ip_addresses[i:i + 500])
+        ).order_by(SiteVisitor.id.desc())
+        for visitor_id, ip_address, user_agent in rows:
+            if (ip_address, user_agent) in keys:
+                ids[(ip_address, user_agent)] = visitor_id
+    return ids
 
-        # Create a visitor log entry
-        visitor_log = VisitorLog(
-            visitor_id=visitor.id,
-            page_visited=request.path,
-            session_id=session_id
-        )
-        db.session.add(visitor_log)
-        db.session.commit()
 
-    except Exception as e:
+def get_visit_buffer_stats():
+    """Return write-behind buffer counters for the admin metrics endpoint."""
+    with _visit_buffer_lock:
+        stats = dict(_visit_buffer_stats, pending=len(_visit_buffer))
+    stats.update(max_size=VISIT_BUFFER_SIZE, drop_policy=VISIT_BUFFER_DROP)
+    return stats
+
+
+def _period_starts(day):
+    """Return (period, start date) pairs for the day, month and year containing a date."""
+    return (('day', day), ('month', day.replace(day=1)), ('year', day.replace(month=1, day=1)))
+
+
+def _get_watermark(name):
+    """Return the processed position for a rollup source, or None if it has never run."""
+    watermark = db.session.get(RollupWatermark, name)
+    return watermark.position if watermark else None
+
+
+def _advance_watermark(name, old_position, new_position):
+    """
+    Move a watermark forward, failing if another process moved it first.
+
+    Returns:
+        bool: True if the watermark was still at old_position and has been advanced
+    """
+    if old_position is None:
+        db.session.add(RollupWatermark(name=name, position=new_position))
+        db.session.flush()
+        return True
+    updated = RollupWatermark.query.filter_by(name=name, position=old_position).update(
+        {'position': new_position, 'updated_at': datetime.utcnow()}, synchronize_session=False)
+    return updated == 1
+
+
+def _take_settled(rows, cutoff):
+    # Rows are in ID order; stop at the first one newer than the cutoff so rows
+    # still being written by other processes aren't skipped past
+    for i, row in enumerate(rows):
+        if row[1] > cutoff:
+            return rows[:i]
+    return rows
+
+
+def _rollup_batch():
+    """
+    Aggregate the next batch of unprocessed visits into VisitorStats.
+
+    Visits after the VisitorLog watermark and visitors after the SiteVisitor
+    watermark are added to the day, month and year rows, distinct visitors
+    are merged into the per-period sketches (site-wide, per page and per
+    referrer), and both watermarks advance in the same transaction. If
+    another process advanced them first the batch is rolled back.
+
+    Returns:
+        bool: True if a full batch was processed and more rows may be waiting
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=VISITOR_ROLLUP_LAG)
+    log_mark = _get_watermark('visitor_log')
+    visitor_mark = _get_watermark('site_visitor')
+
+    visitor_start = visitor_mark or 0
+    if log_mark is None:
+        rebuild_from = _reset_rollups()
+        if visitor_mark is None and rebuild_from is not None:
+            # Visitors first seen before the rebuilt periods are already counted
+            visitor_start = db.session.query(func.max(SiteVisitor.id)).filter(
+                SiteVisitor.first_visit < datetime.combine(rebuild_from, datetime.min.time())
+            ).scalar() or 0
+
+    logs = db.session.query(VisitorLog.id, VisitorLog.timestamp, VisitorLog.visitor_id,
+                            VisitorLog.time_spent_seconds, VisitorLog.page_visited,
+                            VisitorLog.referrer).filter(
+        VisitorLog.id > (log_mark or 0)
+    ).order_by(VisitorLog.id.asc()).limit(VISITOR_ROLLUP_BATCH).all()
+    new_visitors = db.session.query(SiteVisitor.id, SiteVisitor.first_visit).filter(
+        SiteVisitor.id > visitor_start
+    ).order_by(SiteVisitor.id.asc()).limit(VISITOR_ROLLUP_BATCH).all()
+
+    settled_logs = _take_settled(logs, cutoff)
+    settled_visitors = _take_settled(new_visitors, cutoff)
+    if not settled_logs and not settled_visitors:
+        db.session.rollback()
+        return False
+
+    # Aggregate the batch per period in memory
+    totals = {}
+    sketches = {}
+    for _, timestamp, visitor_id, time_spent, page, referrer in settled_logs:
+        dimensions = [('site', ''), ('page', page)]
+        if referrer:
+            dimensions.append(('referrer', referrer))
+        for key in _period_starts(timestamp.date()):
+            total = totals.setdefault(key, {'visits': 0, 'new': 0, 'duration_total': 0.0, 'duration_count': 0})
+            total['visits'] += 1
+            if time_spent is not None:
+                total['duration_total'] += time_spent
+                total['duration_count'] += 1
+            for dimension, value in dimensions:
+                sketch = sketches.get(key + (dimension, value))
+                if sketch is None:
+                    sketch = sketches[key + (dimension, value)] = _BatchSketch(dimension)
+                sketch.add(visitor_id)
+    for _, first_visit in settled_visitors:
+        for key in _period_starts(first_visit.date()):
+            total = totals.setdefault(key, {'visits': 0, 'new': 0, 'duration_total': 0.0, 'duration_count': 0})
+            total['new'] += 1
+
+    site_sketches = _merge_sketches(sketches)
+
+    for (period, date), total in totals.items():
+        stats = VisitorStats.query.filter_by(date=date, period=period).first()
+        if not stats:
+            stats = _empty_stats(date, period)
+            db.session.add(stats)
+
+        sketch = site_sketches.get((period, date))
+
+        stats.total_visits = (stats.total_visits or 0) + total['visits']
+        stats.new_visitors = (stats.new_visitors or 0) + total['new']
+        stats.duration_total = (stats.duration_total or 0.0) + total['duration_total']
+        stats.duration_count = (stats.duration_count or 0) + total['duration_count']
+        if stats.duration_count:
+            stats.average_duration = stats.duration_total / stats.duration_count
+        stats.unique_visitors = sketch.count() if sketch else (stats.unique_visitors or 0)
+        stats.returning_visitors = max(stats.unique_visitors - stats.new_visitors, 0)
+
+    # Both watermarks are created on the first run, even if one source had no rows yet
+    advanced = True
+    if settled_logs or log_mark is None:
+        advanced = _advance_watermark('visitor_log', log_mark,
+                                      settled_logs[-1][0] if settled_logs else 0)
+    if advanced and (settled_visitors or visitor_mark is None):
+        advanced = _advance_watermark('site_visitor', visitor_mark,
+                                      settled_visitors[-1][0] if settled_visitors else visitor_start)
+    if not advanced:
         db.session.rollback()
-        # Optional: log the error
-        print(f"[Visitor Tracking Error] {e}")
-        raise
+        logger.info("Visitor rollup watermark moved by another process; skipping batch")
+        return False
+
+    db.session.commit()
+    logger.info(f"Rolled up {len(settled_logs)} visits and {len(settled_visitors)} new visitors")
+    return len(settled_logs) == VISITOR_ROLLUP_BATCH or len(settled_visitors) == VISITOR_ROLLUP_BATCH
+
+
+class _BatchSketch:
+    """Distinct visitors and visit count for one sketch key within a rollup batch."""
+
+    def __init__(self, dimension):
+        self.hll = HyperLogLog(precision=SKETCH_PRECISION[dimension])
+        self.visits = 0
+
+    def add(self, visitor_id):
+        self.hll.add(visitor_id)
+        self.visits += 1
+
 
-    return visitor.id, is_new_visitor
+def _merge_sketches(sketches):
+    """
+    Merge a batch's sketches into the stored VisitorSketch rows.
+
+    Args:
+        sketches (dict): (period, date, dimension, value) -> _BatchSketch
+
+    Returns:
+        dict: (period, date) -> merged site-wide HyperLogLog
+    """
+    by_period = {}
+    for period, date, dimension, value in sketches:
+        by_period.setdefault((period, date), set()).add((dimension, value))
 
+    site_sketches = {}
+    for (period, date), keys in by_period.items():
+        # One query per period loads every stored sketch the batch touches
+        values = {value for _, value in keys}
+        rows = {(row.dimension, row.value): row for row in VisitorSketch.query.filter(
+            VisitorSketch.period == period,
+            VisitorSketch.date == date,
+            VisitorSketch.value.in_(values))}
+
+        for dimension, value in keys:
+            batch = sketches[(period, date, dimension, value)]
+            row = rows.get((dimension, value))
+            if row:
+                batch.hll.merge(HyperLogLog.from_bytes(row.registers))
+                row.registers = batch.hll.to_bytes()
+                row.visits = (row.visits or 0) + batch.visits
+            else:
+                db.session.add(VisitorSketch(period=period, date=date, dimension=dimension, value=value,
+                                             registers=batch.hll.to_bytes(), visits=batch.visits))
+            if dimension == 'site':
+                site_sketches[(period, date)] = batch.hll
+    return site_sketches
+
+
+def _reset_rollups():
+    """
+    Clear rollup rows that will be rebuilt from the raw logs.
+
+    Runs whenever the VisitorLog watermark is missing: the first time the
+    incremental rollup sees a database, and after `flask rollup-visitor-stats
+    --rebuild`. Only periods from the month of the earliest retained log
+    onwards can be rebuilt, so rows for earlier periods (whose logs retention
+    may have archived and dropped) are kept. The year the cutoff falls in is
+    kept minus the visits of its rebuilt months; its sketches can take the
+    replayed visitors again because merging a HyperLogLog is idempotent.
+
+    Returns:
+        date: The first day being rebuilt, or None if there is nothing to rebuild
+    """
+    earliest = db.session.query(func.min(VisitorLog.timestamp)).scalar()
+    if earliest is None:
+        earliest = db.session.query(func.min(SiteVisitor.first_visit)).scalar()
+    if earliest is None:
+        return None
+
+    cutoff = earliest.date().replace(day=1)
+    year_start = cutoff.replace(month=1)
+    next_year = year_start.replace(year=year_start.year + 1)
+    first_rebuilt_year = year_start if cutoff == year_start else next_year
+
+    if cutoff > year_start:
+        year = VisitorStats.query.filter_by(period='year', date=year_start).first()
+        if year:
+            for month in VisitorStats.query.filter(VisitorStats.period == 'month',
+                                                   VisitorStats.date >= cutoff,
+                                                   VisitorStats.date < next_year):
+                year.total_visits = max((year.total_visits or 0) - (month.total_visits or 0), 0)
+                year.new_visitors = max((year.new_visitors or 0) - (month.new_visitors or 0), 0)
+                year.duration_total = max((year.duration_total or 0.0) - (month.duration_total or 0.0), 0.0)
+                year.duration_count = max((year.duration_count or 0) - (month.duration_count or 0), 0)
+            year.average_duration = year.duration_total / year.duration_count if year.duration_count else None
+
+        year_sketches = {(row.dimension, row.value): row for row in VisitorSketch.query.filter_by(
+            period='year', date=year_start)}
+        for month in VisitorSketch.query.filter(VisitorSketch.period == 'month',
+                                                VisitorSketch.date >= cutoff,
+                                                VisitorSketch.date < next_year):
+            row = year_sketches.get((month.dimension, month.value))
+            if row:
+                row.visits = max((row.visits or 0) - (month.visits or 0), 0)
+
+    for model in (VisitorStats, VisitorSketch):
+        model.query.filter(model.period.in_(('day', 'month')), model.date >= cutoff).delete(
+            synchronize_session=False)
+        model.query.filter(model.period == 'year', model.date >= first_rebuilt_year).delete(
+            synchronize_session=False)
+    logger.info(f"Reset visitor rollups from {cutoff}; earlier periods are kept")
+    return cutoff
+
+
+def _empty_stats(date, period):
+    return VisitorStats(date=date, period=period, unique_visitors=0, total_visits=0,
+                        new_visitors=0, returning_visitors=0, duration_total=0.0, duration_count=0)
 
 
 def update_visitor_stats():
     """
-    Update the visitor statistics for the current day, month, and year.
-    This should be called periodically (e.g., via a scheduled task).
+    Roll visits recorded since the last run into the visitor statistics.
+
+    Only VisitorLog and SiteVisitor rows past the stored watermarks are
+    read, so the cost depends on the traffic since the last run rather than
+    on the size of the period. Called by the visit flusher every
+    VISITOR_ROLLUP_INTERVAL seconds and by `flask rollup-visitor-stats`.
+
+    Returns:
+        dict: The current 'daily', 'monthly' and 'yearly' VisitorStats rows
+    """
+    while _rollup_batch():
+        pass
+    return get_current_visitor_stats()
+
+
+def get_current_visitor_stats():
+    """
+    Return the precomputed statistics rows for the current day, month and year.
+
+    Periods without any recorded visits get empty, unsaved rows.
     """
     today = datetime.utcnow().date()
-    
-    # Get today's stats record or create a new one
-    daily_stats = VisitorStats.query.filter_by(
-        date=today,
-        period='day'
-    ).first()
-    
-    if not daily_stats:
-        daily_stats = VisitorStats(
-            date=today,
-            period='day'
-        )
-        db.session.add(daily_stats)
-    
-    # Get this month's stats record or create a new one
-    month_start = datetime(today.year, today.month, 1).date()
-    monthly_stats = VisitorStats.query.filter_by(
-        date=month_start,
-        period='month'
-    ).first()
-    
-    if not monthly_stats:
-        monthly_stats = VisitorStats(
-            date=month_start,
-            period='month'
-        )
-        db.session.add(monthly_stats)
-    
-    # Get this year's stats record or create a new one
-    year_start = datetime(today.year, 1, 1).date()
-    yearly_stats = VisitorStats.query.filter_by(
-        date=year_start,
-        period='year'
-    ).first()
-    
-    if not yearly_stats:
-        yearly_stats = VisitorStats(
-            date=year_start,
-            period='year'
-        )
-        db.session.add(yearly_stats)
-    
-    # Calculate stats for today
-    today_start = datetime.combine(today, datetime.min.time())
-    today_end = datetime.combine(today, datetime.max.time())
-    
-    # Count unique visitors today
-    daily_unique = db.session.query(func.count(func.distinct(VisitorLog.visitor_id))).filter(
-        VisitorLog.timestamp.between(today_start, today_end)
-    ).scalar() or 0
-    
-    # Count total visits today
-    daily_visits = VisitorLog.query.filter(
-        VisitorLog.timestamp.between(today_start, today_end)
-    ).count()
-    
-    # Count new visitors today
-    daily_new = SiteVisitor.query.filter(
-        SiteVisitor.first_visit.between(today_start, today_end)
-    ).count()
-    
-    # Update daily stats
-    daily_stats.unique_visitors = daily_unique
-    daily_stats.total_visits = daily_visits
-    daily_stats.new_visitors = daily_new
-    daily_stats.returning_visitors = daily_unique - daily_new if daily_unique > daily_new else 0
-    
-    # Calculate average duration for today
-    durations = db.session.query(VisitorLog.time_spent_seconds).filter(
-        VisitorLog.timestamp.between(today_start, today_end),
-        VisitorLog.time_spent_seconds.isnot(None)
-    ).all()
-    
-    if durations:
-        avg_duration = sum(d[0] for d in durations) / len(durations)
-        daily_stats.average_duration = avg_duration
-    
-    # Calculate stats for this month
-    month_start_dt = datetime.combine(month_start, datetime.min.time())
-    month_end = today_end
-    
-    # Count unique visitors this month
-    monthly_unique = db.session.query(func.count(func.distinct(VisitorLog.visitor_id))).filter(
-        VisitorLog.timestamp.between(month_start_dt, month_end)
-    ).scalar() or 0
-    
-    # Count total visits this month
-    monthly_visits = VisitorLog.query.filter(
-        VisitorLog.timestamp.between(month_start_dt, month_end)
-    ).count()
-    
-    # Count new visitors this month
-    monthly_new = SiteVisitor.query.filter(
-        SiteVisitor.first_visit.between(month_start_dt, month_end)
-    ).count()
-    
-    # Update monthly stats
-    monthly_stats.unique_visitors = monthly_unique
-    monthly_stats.total_visits = monthly_visits
-    monthly_stats.new_visitors = monthly_new
-    monthly_stats.returning_visitors = monthly_unique - monthly_new if monthly_unique > monthly_new else 0
-    
-    # Calculate average duration for this month
-    month_durations = db.session.query(VisitorLog.time_spent_seconds).filter(
-        VisitorLog.timestamp.between(month_start_dt, month_end),
-        VisitorLog.time_spent_seconds.isnot(None)
-    ).all()
-    
-    if month_durations:
-        month_avg_duration = sum(d[0] for d in month_durations) / len(month_durations)
-        monthly_stats.average_duration = month_avg_duration
-    
-    # Calculate stats for this year
-    year_start_dt = datetime.combine(year_start, datetime.min.time())
-    year_end = today_end
-    
-    # Count unique visitors this year
-    yearly_unique = db.session.query(func.count(func.distinct(VisitorLog.visitor_id))).filter(
-        VisitorLog.timestamp.between(year_start_dt, year_end)
-    ).scalar() or 0
-    
-    # Count total visits this year
-    yearly_visits = VisitorLog.query.filter(
-        VisitorLog.timestamp.between(year_start_dt, year_end)
-    ).count()
-    
-    # Count new visitors this year
-    yearly_new = SiteVisitor.query.filter(
-        SiteVisitor.first_visit.between(year_start_dt, year_end)
-    ).count()
-    
-    # Update yearly stats
-    yearly_stats.unique_visitors = yearly_unique
-    yearly_stats.total_visits = yearly_visits
-    yearly_stats.new_visitors = yearly_new
-    yearly_stats.returning_visitors = yearly_unique - yearly_new if yearly_unique > yearly_new else 0
-    
-    # Calculate average duration for this year
-    year_durations = db.session.query(VisitorLog.time_spent_seconds).filter(
-        VisitorLog.timestamp.between(year_start_dt, year_end),
-        VisitorLog.time_spent_seconds.isnot(None)
-    ).all()
-    
-    if year_durations:
-        year_avg_duration = sum(d[0] for d in year_durations) / len(year_durations)
-        yearly_stats.average_duration = year_avg_duration
-    
-    # Commit all changes
-    db.session.commit()
-    
-    return {
-        'daily': daily_stats,
-        'monthly': monthly_stats,
-        'yearly': yearly_stats
-    }
+    stats = {}
+    for name, (period, date) in zip(('daily', 'monthly', 'yearly'), _period_starts(today)):
+        stats[name] = VisitorStats.query.filter_by(date=date, period=period).first() or _empty_stats(date, period)
+    return stats
+
+
+def _cover_range(start, end):
+    """
+    Split an inclusive date range into the fewest whole years, months and days.
+
+    Returns:
+        list: (period, start date) pairs whose periods exactly tile the range
+    """
+    parts = []
+    day = start
+    while day <= end:
+        if day.month == 1 and day.day == 1 and datetime(day.year, 12, 31).date() <= end:
+            parts.append(('year', day))
+            day = datetime(day.year + 1, 1, 1).date()
+            continue
+        next_month = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+        if day.day == 1 and next_month - timedelta(days=1) <= end:
+            parts.append(('month', day))
+            day = next_month
+            continue
+        parts.append(('day', day))
+        day += timedelta(days=1)
+    return parts
+
+
+def _load_range_sketches(start, end, dimension, values=None):
+    """Load the stored sketches tiling a date range, optionally for specific values only."""
+    by_period = {}
+    for period, period_start in _cover_range(start, end):
+        by_period.setdefault(period, []).append(period_start)
+
+    rows = []
+    for period, dates in by_period.items():
+        query = VisitorSketch.query.filter(
+            VisitorSketch.dimension == dimension,
+            VisitorSketch.period == period,
+            VisitorSketch.date.in_(dates))
+        if values is not None:
+            query = query.filter(VisitorSketch.value.in_(values))
+        rows.extend(query.all())
+    return rows
+
+
+def count_unique_visitors(start, end, dimension='site', value=''):
+    """
+    Estimate the distinct visitors over any date range.
+
+    The range is tiled with whole years, months and days, and their stored
+    sketches are merged, so at most a few dozen small rows are read however
+    long the range is. The estimate has a relative standard error of
+    get_sketch_error(dimension) (about 1.6% site-wide, 3.3% per page or
+    referrer); ranges with only a few hundred visitors are near exact.
+
+    Args:
+        start (date): First day of the range
+        end (date): Last day of the range (inclusive)
+        dimension (str): 'site', 'page' or 'referrer'
+        value (str): The page path or referrer URL ('' for the site)
+
+    Returns:
+        dict: unique_visitors, visits and relative_error
+    """
+    merged = HyperLogLog(precision=SKETCH_PRECISION[dimension])
+    visits = 0
+    for row in _load_range_sketches(start, end, dimension, [value]):
+        merged.merge(HyperLogLog.from_bytes(row.registers))
+        visits += row.visits or 0
+    return {'unique_visitors': merged.count(), 'visits': visits,
+            'relative_error': round(get_sketch_error(dimension), 4)}
+
+
+def get_unique_breakdown(dimension, start, end, limit=10):
+    """
+    Return the top pages or referrers in a date range with their unique visitors.
+
+    Values are ranked by visits; distinct visitors are estimated by merging
+    each value's sketches over the range.
+
+    Args:
+        dimension (str): 'page' or 'referrer'
+        start (date): First day of the range
+        end (date): Last day of the range (inclusive)
+        limit (int): The number of values to return
+
+    Returns:
+        list: (value, visits, unique_visitors) tuples, most visited first
+    """
+    totals = {}
+    merged = {}
+    for row in _load_range_sketches(start, end, dimension):
+        totals[row.value] = totals.get(row.value, 0) + (row.visits or 0)
+        merged.setdefault(row.value, []).append(row.registers)
+
+    top = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+    breakdown = []
+    for value, visits in top:
+        sketch = HyperLogLog(precision=SKETCH_PRECISION[dimension])
+        for registers in merged[value]:
+            sketch.merge(HyperLogLog.from_bytes(registers))
+        breakdown.append((value, visits, sketch.count()))
+    return breakdown
+
+
+def get_sketch_error(dimension='site'):
+    """Return the relative standard error of unique visitor estimates for a dimension."""
+    return HyperLogLog.relative_error(SKETCH_PRECISION[dimension])
+
+
+def _all_time_range():
+    earliest = db.session.query(func.min(VisitorSketch.date)).scalar()
+    today = datetime.utcnow().date()
+    return (earliest or today), today
 
 
 def get_page_popularity(limit=10):
     """
     Get the most popular pages on the site.
-    
+
+    Read from the per-page sketches rather than scanning VisitorLog.
+
     Args:
         limit (int): The number of pages to return
-        
+
     Returns:
         list: A list of tuples containing (page_url, visit_count)
     """
-    popular_pages = db.session.query(
-        VisitorLog.page_visited,
-        func.count(VisitorLog.id).label('visits')
-    ).group_by(
-        VisitorLog.page_visited
-    ).order_by(
-        desc('visits')
-    ).limit(limit).all()
-    
-    return popular_pages
+    start, end = _all_time_range()
+    return [(page, visits) for page, visits, _ in get_unique_breakdown('page', start, end, limit)]
 
 
 def get_referrer_stats(limit=10):
     """
     Get the most common referrers to the site.
-    
+
+    Read from the per-referrer sketches rather than scanning SiteVisitor.
+
     Args:
         limit (int): The number of referrers to return
-        
+
     Returns:
-        list: A list of tuples containing (referrer_url, visitor_count)
+        list: A list of tuples containing (referrer_url, visitor_count), where
+        visitor_count is the estimated number of distinct visitors
     """
-    referrer_stats = db.session.query(
-        SiteVisitor.referrer,
-        func.count(SiteVisitor.id).label('visitors')
-    ).filter(
-        SiteVisitor.referrer.isnot(None)
-    ).group_by(
-        SiteVisitor.referrer
-    ).order_by(
-        desc('visitors')
-    ).limit(limit).all()
-    
-    return referrer_stats
+    start, end = _all_time_range()
+    breakdown = get_unique_breakdown('referrer', start, end, limit * 2)
+    breakdown.sort(key=lambda item: item[2], reverse=True)
+    return [(referrer, visitors) for referrer, _, visitors in breakdown[:limit]]
 
 
 def populate_demo_data():